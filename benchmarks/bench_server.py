@@ -0,0 +1,361 @@
+"""Load test for neutron-server.
+
+Runs `neutron.server.app` in this process with small local stand-ins for the
+model, the web search and the vector store, drives `/ask` and `/ask/stream`
+at a fixed concurrency, and prints the results as JSON. Nothing is
+downloaded, so it runs on a CPU-only machine without network access.
+
+    python benchmarks/bench_server.py --requests 64 --concurrency 8 --output bench.json
+
+Arguments the benchmark does not know are passed on to the server, for
+example `--max-batch-size 4 --no-prefix-cache`. Compare the JSON files of two
+commits to see the effect of a change.
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+import requests
+import torch
+import uvicorn
+from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from neutron import server, vector_index  # noqa: E402
+
+TOOLS = ["nmap", "sqlmap", "hydra", "gobuster", "nikto", "metasploit", "john", "hashcat"]
+TASKS = [
+    "scan all TCP ports of {host}",
+    "enumerate the services running on {host}",
+    "brute force the SSH login of {host}",
+    "find hidden directories on the web server at {host}",
+    "test the login form of {host} for SQL injection",
+    "crack the password hashes dumped from {host}",
+]
+CORPUS = [
+    f"Use `{tool}` to {task.format(host='10.0.0.1')}. Check the output for open ports, versions and credentials."
+    for tool in TOOLS
+    for task in TASKS
+]
+
+
+class StubSearch:
+    """Stands in for DuckDuckGo, answering after a fixed delay."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def run(self, question: str) -> str:
+        time.sleep(self.delay)
+        return " ".join(CORPUS[hash(question) % len(CORPUS) :][:3])
+
+
+def build_tokenizer(context_window: int) -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=2000,
+        special_tokens=["<unk>", "<eos>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(CORPUS, trainer)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<eos>",
+        unk_token="<unk>",
+        model_max_length=context_window,
+    )
+
+
+def build_model(tokenizer, context_window: int, layers: int, width: int):
+    """A randomly initialized GPT-2, small enough to run anywhere."""
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=context_window,
+        n_embd=width,
+        n_layer=layers,
+        n_head=max(1, width // 64),
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    return GPT2LMHeadModel(config).eval()
+
+
+def build_draft_model(model, layers: int):
+    """A draft that shares the embeddings and the first `layers` blocks of `model`.
+
+    A random model has nothing to learn from, so a truncated copy is the
+    cheapest draft that still agrees with it on some tokens.
+    """
+    config = GPT2Config(**{**model.config.to_dict(), "n_layer": layers})
+    draft = GPT2LMHeadModel(config).eval()
+    draft.load_state_dict(model.state_dict(), strict=False)
+    return draft
+
+
+def build_vector_store(directory: str):
+    return Chroma.from_texts(
+        CORPUS,
+        embedding=DeterministicFakeEmbedding(size=64),
+        persist_directory=directory,
+    )
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit():
+    try:
+        # The commit of the benchmarked code, wherever the benchmark is run from
+        return subprocess.run(
+            ["git", "-C", os.path.dirname(os.path.abspath(__file__)), "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def percentiles(values):
+    if not values:
+        return None
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(np.mean(values)),
+        "max": float(np.max(values)),
+    }
+
+
+class RssSampler:
+    """Records the peak resident memory of this process while it runs."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.process = psutil.Process(os.getpid())
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def ask(base_url: str, question: str, stream: bool, timeout: float) -> dict:
+    """Send one question and time it. `ttft` is only known for streamed answers."""
+    headers = {
+        "Authorization": os.environ.get("NEUTRON_TOKEN", "default_token"),
+        # Every question is new, but keep near-duplicates out of the answer cache
+        "X-Neutron-Cache": "bypass",
+    }
+    start = time.perf_counter()
+    ttft = None
+    if stream:
+        with requests.post(
+            f"{base_url}/ask/stream",
+            json={"question": question},
+            headers=headers,
+            stream=True,
+            timeout=timeout,
+        ) as response:
+            response.raise_for_status()
+            chunks = []
+            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                chunks.append(chunk)
+            text = "".join(chunks)
+    else:
+        response = requests.post(
+            f"{base_url}/ask",
+            json={"question": question},
+            headers=headers,
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        text = response.json()["response"]
+    return {"latency": time.perf_counter() - start, "ttft": ttft, "text": text}
+
+
+def run_load(base_url, tokenizer, questions, concurrency, stream, timeout):
+    latencies, ttfts, tokens = [], [], []
+    errors = []
+
+    def one(question):
+        try:
+            result = ask(base_url, question, stream, timeout)
+        except Exception as e:
+            errors.append(str(e))
+            return
+        latencies.append(result["latency"])
+        if result["ttft"] is not None:
+            ttfts.append(result["ttft"])
+        tokens.append(len(tokenizer(result["text"], add_special_tokens=False).input_ids))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, questions))
+    wall = time.perf_counter() - start
+    return {
+        "endpoint": "/ask/stream" if stream else "/ask",
+        "requests": len(questions),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_seconds": wall,
+        "requests_per_second": len(latencies) / wall if wall else 0.0,
+        "tokens_per_second": sum(tokens) / wall if wall else 0.0,
+        "generated_tokens": sum(tokens),
+        "latency_ms": percentiles([1000 * x for x in latencies]),
+        "ttft_ms": percentiles([1000 * x for x in ttfts]),
+    }
+
+
+def wait_until_ready(base_url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = requests.get(f"{base_url}/readyz", timeout=1)
+            if response.status_code == 200:
+                return response.json()
+            if requests.get(f"{base_url}/healthz", timeout=1).status_code != 200:
+                raise RuntimeError(f"The server failed to start: {server.startup['error']}")
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError("The server did not become ready in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the latency and throughput of neutron-server with local stand-ins."
+    )
+    parser.add_argument("--requests", type=int, default=32, help="Questions per endpoint. Default is 32.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once. Default is 4.")
+    parser.add_argument(
+        "--mode",
+        choices=["ask", "stream", "both"],
+        default="both",
+        help="Drive /ask, /ask/stream or both. Time to first token is only measured when streaming. Default is both.",
+    )
+    parser.add_argument("--warmup-requests", type=int, default=2, help="Unmeasured requests sent first. Default is 2.")
+    parser.add_argument("--search-delay-ms", type=float, default=50, help="Latency of the stub web search. Default is 50.")
+    parser.add_argument("--layers", type=int, default=2, help="Layers of the stand-in model. Default is 2.")
+    parser.add_argument("--width", type=int, default=128, help="Hidden size of the stand-in model. Default is 128.")
+    parser.add_argument("--context-window", type=int, default=1024, help="Context window of the stand-in model. Default is 1024.")
+    parser.add_argument(
+        "--draft-layers",
+        type=int,
+        default=0,
+        help="Generate with a draft model made of the first layers of the stand-in model (assisted decoding). Default is 0, no draft model.",
+    )
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for one answer. Default is 300.")
+    parser.add_argument("--label", type=str, default=None, help="A name stored with the results.")
+    parser.add_argument("--output", type=str, default=None, help="Also write the results to this JSON file.")
+    args, server_argv = parser.parse_known_args()
+
+    server.args = server.parser.parse_args(
+        ["--device", "cpu", "--offline", "--max-new-tokens", "32", *server_argv]
+    )
+    tokenizer = build_tokenizer(args.context_window)
+    with tempfile.TemporaryDirectory() as directory:
+        if not any(argument.startswith("--job-db") for argument in server_argv):
+            # Kept with the stand-in vector store, out of the working directory
+            server.args.job_db = os.path.join(directory, "neutron_jobs.db")
+        vector_store = build_vector_store(directory)
+        if server.args.vector_index:
+            vector_index.build_index(directory, server.args.vector_index, vector_store)
+        model = build_model(tokenizer, args.context_window, args.layers, args.width)
+        server.components = {
+            "model": model,
+            "tokenizer": tokenizer,
+            "embeddings": DeterministicFakeEmbedding(size=64),
+            "vector_store": vector_store,
+            "search_tool": StubSearch(args.search_delay_ms / 1000),
+        }
+        if args.draft_layers:
+            server.components["draft_model"] = build_draft_model(model, args.draft_layers)
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        uvicorn_server = uvicorn.Server(
+            uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning")
+        )
+        thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+        thread.start()
+        try:
+            readiness = wait_until_ready(base_url, args.timeout)
+            modes = {"ask": [False], "stream": [True], "both": [False, True]}[args.mode]
+            runs = []
+            with RssSampler() as rss:
+                for stream in modes:
+                    prefix = "stream" if stream else "ask"
+                    warmup = [f"warmup {prefix} {i}" for i in range(args.warmup_requests)]
+                    run_load(base_url, tokenizer, warmup, args.concurrency, stream, args.timeout)
+                    questions = [
+                        f"How do I {TASKS[i % len(TASKS)].format(host=f'10.0.{i // 256}.{i % 256}')} with {TOOLS[i % len(TOOLS)]}? ({prefix})"
+                        for i in range(args.requests)
+                    ]
+                    runs.append(
+                        run_load(base_url, tokenizer, questions, args.concurrency, stream, args.timeout)
+                    )
+        finally:
+            uvicorn_server.should_exit = True
+            thread.join(timeout=10)
+
+    results = {
+        "label": args.label,
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "config": {
+            **{k: v for k, v in vars(args).items() if k not in ("label", "output")},
+            "server_args": vars(server.args),
+        },
+        "startup_seconds": readiness.get("timings", {}),
+        "peak_rss_mb": rss.peak / 1024 / 1024,
+        "runs": runs,
+    }
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
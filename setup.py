@@ -34,9 +34,12 @@ setup(
         "uvicorn",
         "pydantic",
         "langchain",
+        "langchain_text_splitters",
         "regex",
         "argparse",
         "typing-extensions",
+        "numpy",
+        "prometheus-client",
     ],
     entry_points={
         "console_scripts": [
@@ -44,6 +47,12 @@ setup(
             "neutron-client=neutron.client:main",
             # Allows users to start the server by typing 'neutron-server'
             "neutron-server=neutron.server:main",
+            # Exports the knowledge base for --vector-index
+            "neutron-index=neutron.vector_index:main",
+            # Adds your own markdown and text files to the knowledge base
+            "neutron-ingest=neutron.ingest:main",
+            # Saves the quantized model once so the server loads it faster
+            "neutron-checkpoint=neutron.checkpoints:main",
         ],
     },
     python_requires=">=3.10",
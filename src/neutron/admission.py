@@ -0,0 +1,42 @@
+import math
+import threading
+
+
+class AdmissionController:
+    """Bounds how many questions the server holds at once.
+
+    Requests beyond `max_in_flight` are turned away straight away instead of
+    waiting on a thread, so a load spike cannot pile up work that will only
+    finish after its client has given up.
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 0
+        self.rejected = 0
+        # Moving average of how long admitted requests take
+        self.average_seconds = None
+        self.lock = threading.Lock()
+
+    def try_admit(self) -> bool:
+        with self.lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, seconds: float):
+        with self.lock:
+            self.in_flight -= 1
+            if self.average_seconds is None:
+                self.average_seconds = seconds
+            else:
+                self.average_seconds = 0.9 * self.average_seconds + 0.1 * seconds
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to free up, for the Retry-After header."""
+        with self.lock:
+            average = self.average_seconds or 1.0
+        # With every slot busy, one finishes every average / max_in_flight seconds
+        return int(min(60, max(1, math.ceil(average / self.max_in_flight))))
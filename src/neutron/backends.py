@@ -0,0 +1,90 @@
+import logging
+from typing import Optional
+
+import torch
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+DEVICES = ["auto", "cuda", "cpu"]
+CPU_QUANTIZATIONS = ["int8", "none"]
+
+
+def resolve_device(device: str = "auto") -> str:
+    """Turn the requested device into the backend that will be used."""
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if device.startswith("cuda") and not torch.cuda.is_available():
+        raise RuntimeError("The cuda device was requested but no GPU is available")
+    return device
+
+
+def configure_cpu_threads(threads: Optional[int]):
+    """Set how many threads torch uses for CPU generation."""
+    if not threads:
+        return
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(max(1, threads // 2))
+    except RuntimeError:
+        # Can only be set once, before any parallel work has started
+        logging.warning("Could not change the number of inter-op threads.")
+
+
+def load_cuda_model(
+    path: str, device: str = "cuda", prequantized: bool = False, **kwargs
+):
+    """Load the model on the GPU, quantized to 4-bit NF4 by bitsandbytes.
+
+    Plain `cuda` spreads the model over all GPUs, while a specific device such
+    as `cuda:1` keeps it on that one GPU. A `prequantized` checkpoint, saved
+    by `neutron.checkpoints`, already holds NF4 weights and its quantization
+    settings, so it is loaded as it is.
+    """
+    quantization_kwargs = {}
+    if not prequantized:
+        quantization_kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+        )
+    return AutoModelForCausalLM.from_pretrained(
+        path,
+        low_cpu_mem_usage=True,
+        device_map="auto" if device == "cuda" else {"": device},
+        **quantization_kwargs,
+    )
+
+
+def load_cpu_model(
+    path: str, threads: Optional[int] = None, cpu_quantization: str = "int8", **kwargs
+):
+    """Load the model on the CPU, optionally with dynamic int8 quantization.
+
+    Dynamic quantization stores the weights of every linear layer as int8 and
+    quantizes activations on the fly, which cuts memory use and speeds up
+    generation on CPUs with int8 support.
+    """
+    configure_cpu_threads(threads)
+    model = AutoModelForCausalLM.from_pretrained(
+        path,
+        low_cpu_mem_usage=True,
+        torch_dtype=torch.float32,
+    )
+    if cpu_quantization == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model.eval()
+
+
+BACKENDS = {
+    "cuda": load_cuda_model,
+    "cpu": load_cpu_model,
+}
+
+
+def load_model(path: str, device: str = "auto", **kwargs):
+    """Load the generation model with the backend matching `device`."""
+    device = resolve_device(device)
+    if device.startswith("cuda"):
+        return load_cuda_model(path, device=device, **kwargs)
+    return BACKENDS[device](path, **kwargs)
@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    """Lower-case a question and collapse its whitespace so trivial variations share a key."""
+    return " ".join(question.lower().split())
+
+
+class SearchCache:
+    """TTL and LRU bounded cache for web search results.
+
+    Entries expire `ttl` seconds after they were stored. The least recently
+    used entries are evicted once the cache holds more than `max_entries`
+    results or more than `max_bytes` of UTF-8 encoded result text. When `path`
+    is given the cache is loaded from and saved to that JSON file, so it
+    survives restarts. Changes are saved by a background thread at most every
+    `save_interval` seconds, and `close` saves the last of them.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 3600,
+        max_entries: int = 1024,
+        max_bytes: int = 16 * 1024 * 1024,
+        path: Optional[str] = None,
+        save_interval: float = 5.0,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.save_interval = save_interval
+        self.entries = OrderedDict()  # key -> (stored_at, result)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # Set when entries changed since the last save
+        self.changed = threading.Event()
+        self.closed = threading.Event()
+        self.saver = None
+        if self.path:
+            self._load()
+            self.saver = threading.Thread(
+                target=self._save_changes, name="neutron-search-cache", daemon=True
+            )
+            self.saver.start()
+
+    def get(self, question: str) -> Optional[str]:
+        key = normalize_question(question)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, question: str, result: str):
+        key = normalize_question(question)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time(), result)
+            self.size += _encoded_size(result)
+            self._evict()
+        if self.path:
+            self.changed.set()
+
+    def close(self):
+        """Stop the background saves and write the changes that are still pending."""
+        self.closed.set()
+        if self.saver is not None:
+            self.saver.join()
+            self.saver = None
+        if self.path and self.changed.is_set():
+            self.changed.clear()
+            self._save()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key: str):
+        _, result = self.entries.pop(key)
+        self.size -= _encoded_size(result)
+
+    def _evict(self):
+        while self.entries and (
+            len(self.entries) > self.max_entries or self.size > self.max_bytes
+        ):
+            self._remove(next(iter(self.entries)))
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"Error loading search cache from {self.path}: {e}")
+            return
+        now = time.time()
+        with self.lock:
+            for key, stored_at, result in data.get("entries", []):
+                if now - stored_at <= self.ttl:
+                    self.entries[key] = (stored_at, result)
+                    self.size += _encoded_size(result)
+            self._evict()
+
+    def _save_changes(self):
+        while not self.closed.is_set():
+            if not self.changed.wait(timeout=1.0):
+                continue
+            # Results stored within the interval are written together
+            self.closed.wait(self.save_interval)
+            if self.closed.is_set():
+                break
+            self.changed.clear()
+            self._save()
+
+    def _save(self):
+        with self.lock:
+            data = {
+                "entries": [
+                    [key, stored_at, result]
+                    for key, (stored_at, result) in self.entries.items()
+                ]
+            }
+        # Write to a temporary file first so a crash never leaves a truncated cache
+        tmp_path = f"{self.path}.tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self.save_lock:
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"Error saving search cache to {self.path}: {e}")
+
+
+def _encoded_size(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+class SemanticCache:
+    """Answer cache that matches questions by embedding similarity.
+
+    Questions are embedded with `embed` and compared by cosine similarity to
+    the questions already answered. A stored answer is returned when the best
+    match reaches `threshold`. The least recently used answers are evicted
+    beyond `max_entries`; a `max_entries` of 0 disables the cache.
+    """
+
+    def __init__(self, embed, threshold: float = 0.95, max_entries: int = 512):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (embedding, answer)
+        self.matrix = None  # Stacked embeddings, rebuilt after changes
+        self.keys = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def normalize(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def embed_question(self, question: str) -> np.ndarray:
+        return self.normalize(self.embed(question))
+
+    def lookup(
+        self, question: str, embedding=None
+    ) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """Return the cached answer, if any, and the question's embedding.
+
+        The embedding can be passed back to `add` so the question is only
+        embedded once. Pass `embedding` if the question was already embedded,
+        for example together with others.
+        """
+        if not self.enabled:
+            return None, None
+        key = normalize_question(question)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][1], self.entries[key][0]
+        if embedding is None:
+            embedding = self.embed_question(question)
+        else:
+            embedding = self.normalize(embedding)
+        with self.lock:
+            if self.entries:
+                if self.matrix is None:
+                    self.keys = list(self.entries)
+                    self.matrix = np.stack([self.entries[k][0] for k in self.keys])
+                similarities = self.matrix @ embedding
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    match = self.keys[best]
+                    self.entries.move_to_end(match)
+                    self.hits += 1
+                    return self.entries[match][1], embedding
+            self.misses += 1
+        return None, embedding
+
+    def add(self, question: str, answer: str, embedding: Optional[np.ndarray] = None):
+        if not self.enabled:
+            return
+        if embedding is None:
+            embedding = self.embed_question(question)
+        else:
+            embedding = self.normalize(embedding)
+        key = normalize_question(question)
+        with self.lock:
+            self.entries[key] = (embedding, answer)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,198 @@
+"""A cache of the model converted for the backend it runs on.
+
+Loading `neutron_model` on a GPU reads the full precision weights and
+quantizes them to NF4 on every start. Converting once saves the quantized
+model, with the tokenizer and the embedding model, as safetensors files that
+later starts map into memory and use as they are:
+
+    neutron-checkpoint --device cuda
+
+Entries live in `neutron_model_cache/<key>`, where the key covers the
+version of `neutron_model` (its ETag), the backend and its quantization
+settings and the library versions. When `neutron_model` is updated, the
+server no longer finds an entry for it and loads the model the usual way
+until the conversion is run again.
+
+On the CPU, dynamic int8 quantization cannot be saved, so the entry holds
+the float32 weights as safetensors and quantization runs on load, which
+takes a fraction of the time of reading the original checkpoint.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Optional
+
+import torch
+import transformers
+
+from neutron import backends, downloader, utilities
+
+CACHE_VERSION = 1
+CACHE_DIRECTORY = "neutron_model_cache"
+INFO_FILE = "info.json"
+EMBEDDING_MODEL = "all-MiniLM-L12-v2"
+
+
+def source_version(model_directory: str) -> str:
+    """The ETag of the model directory, or a signature of its files without one."""
+    etag = utilities.get_local_metadata(os.path.join(model_directory, "metadata.json"))
+    if etag:
+        return etag
+    signature = hashlib.sha256()
+    for root, _, names in sorted(os.walk(model_directory)):
+        for name in sorted(names):
+            stat = os.stat(os.path.join(root, name))
+            signature.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return signature.hexdigest()
+
+
+def backend_settings(device: str) -> dict:
+    """What the saved weights depend on besides the model version."""
+    if device.startswith("cuda"):
+        import bitsandbytes
+
+        return {
+            "backend": "cuda",
+            "quantization": "nf4",
+            "compute_dtype": "bfloat16",
+            "bitsandbytes": bitsandbytes.__version__,
+        }
+    return {"backend": "cpu", "dtype": "float32"}
+
+
+def cache_key(model_directory: str, device: str) -> str:
+    settings = {
+        "cache_version": CACHE_VERSION,
+        "source": source_version(model_directory),
+        "embedding_model": EMBEDDING_MODEL,
+        "transformers": transformers.__version__,
+        "torch": torch.__version__.split("+")[0],
+        **backend_settings(device),
+    }
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+    return f"{settings['backend']}-{digest[:16]}"
+
+
+def find_entry(
+    cache_directory: str, model_directory: str, device: str
+) -> Optional[str]:
+    """The cache entry for this version of the model and backend, if it was converted."""
+    entry = os.path.join(cache_directory, cache_key(model_directory, device))
+    downloader.recover_directory(entry)
+    if os.path.exists(os.path.join(entry, INFO_FILE)):
+        return entry
+    return None
+
+
+def convert(
+    cache_directory: str = CACHE_DIRECTORY,
+    model_directory: str = "neutron_model",
+    device: str = "auto",
+    embeddings: bool = True,
+) -> dict:
+    """Save the model for `device` with its tokenizer and embedding model.
+
+    Replaces the older entries of the same backend. Returns the entry's
+    information, including how long the conversion took.
+    """
+    device = backends.resolve_device(device)
+    key = cache_key(model_directory, device)
+    entry = os.path.join(cache_directory, key)
+    staging_directory = f"{entry}.staging-{os.getpid()}"
+    if os.path.exists(staging_directory):
+        shutil.rmtree(staging_directory)
+    os.makedirs(staging_directory)
+    timings = {}
+
+    start = time.perf_counter()
+    model = backends.load_model(model_directory, device=device, cpu_quantization="none")
+    timings["load_source"] = time.perf_counter() - start
+    start = time.perf_counter()
+    model.save_pretrained(os.path.join(staging_directory, "model"))
+    del model
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_directory)
+    tokenizer.save_pretrained(os.path.join(staging_directory, "tokenizer"))
+    if embeddings:
+        from sentence_transformers import SentenceTransformer
+
+        SentenceTransformer(EMBEDDING_MODEL, device="cpu").save(
+            os.path.join(staging_directory, "embeddings")
+        )
+    timings["save"] = time.perf_counter() - start
+
+    info = {
+        "key": key,
+        "source": source_version(model_directory),
+        **backend_settings(device),
+        "created_at": time.time(),
+        "timings": timings,
+    }
+    # Written last, a directory without it is an unfinished conversion
+    with open(os.path.join(staging_directory, INFO_FILE), "w") as f:
+        json.dump(info, f)
+    downloader.swap_directory(staging_directory, entry)
+
+    prefix = f"{info['backend']}-"
+    for name in os.listdir(cache_directory):
+        path = os.path.join(cache_directory, name)
+        if name.startswith(prefix) and name != key and os.path.isdir(path):
+            logging.info(f"Removing the outdated checkpoint {path}.")
+            shutil.rmtree(path, ignore_errors=True)
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the Neutron model once so the server loads it faster."
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        choices=backends.DEVICES,
+        default="auto",
+        help="The device the server runs the model on. Default is auto, which uses the GPU when available.",
+    )
+    parser.add_argument(
+        "--model-directory",
+        type=str,
+        default=utilities.return_path("neutron_model"),
+        help="The model to convert. Default is the downloaded neutron_model.",
+    )
+    parser.add_argument(
+        "--cache-directory",
+        type=str,
+        default=CACHE_DIRECTORY,
+        help=f"Where to save the converted model. Default is {CACHE_DIRECTORY}.",
+    )
+    args = parser.parse_args()
+
+    if not utilities.folder_exists_and_not_empty(args.model_directory):
+        parser.error(
+            f"{args.model_directory} does not exist, start the server once to download the model"
+        )
+    device = backends.resolve_device(args.device)
+    info = convert(args.cache_directory, args.model_directory, device)
+    entry = os.path.join(args.cache_directory, info["key"])
+    size = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(entry)
+        for name in names
+    )
+    print(
+        f"Loaded the source model in {info['timings']['load_source']:.1f}s and saved "
+        f"{size / 1024 / 1024:.0f} MB to {entry} in {info['timings']['save']:.1f}s."
+    )
+    start = time.perf_counter()
+    backends.load_model(
+        os.path.join(entry, "model"), device=device, cpu_quantization="none", prequantized=True
+    )
+    print(f"The converted model loads in {time.perf_counter() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,425 @@
 import argparse
+import json
 import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 
+# Busy or briefly failing servers, worth another attempt
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
-def send_request(question: str, server_url: str = "http://localhost:8000"):
-    # The default request type is now always 'ask', so we don't need to validate it
-    endpoint_url = f"{server_url}/ask"  # The endpoint now directly uses 'ask'
 
-    payload = {"question": question}
+def request_headers(bypass_cache: bool = False, timeout: Optional[float] = None) -> dict:
     # Retrieve the token from the NEUTRON_TOKEN environment variable
     token = os.environ.get(
         "NEUTRON_TOKEN", "default_token"
     )  # Use a default value if NEUTRON_TOKEN is not set
     headers = {"Authorization": token}  # Use the token from the environment variable
+    if bypass_cache:
+        headers["X-Neutron-Cache"] = "bypass"
+    if timeout is not None:
+        # The server stops generating once the timeout has passed
+        headers["X-Neutron-Timeout"] = str(timeout)
+    return headers
+
+
+def create_session(connections: int = 1) -> requests.Session:
+    """A session that keeps up to `connections` connections to the server open."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def error_detail(response) -> str:
     try:
-        response = requests.post(endpoint_url, json=payload, headers=headers)
+        return str(response.json().get("detail", "Unknown error"))
+    except ValueError:
+        return response.text or "Unknown error"
+
+
+def print_error(response):
+    print("Error:", response.status_code, error_detail(response))
+    if "Retry-After" in response.headers:
+        print(f"Retry after {response.headers['Retry-After']}s.", file=sys.stderr)
+
+
+def send_request(
+    question: str,
+    server_url: str = "http://localhost:8000",
+    bypass_cache: bool = False,
+    timeout: Optional[float] = None,
+    session: Optional[requests.Session] = None,
+):
+    # The default request type is now always 'ask', so we don't need to validate it
+    endpoint_url = f"{server_url}/ask"  # The endpoint now directly uses 'ask'
+
+    payload = {"question": question}
+    headers = request_headers(bypass_cache, timeout)
+    try:
+        response = (session or requests).post(
+            endpoint_url, json=payload, headers=headers, timeout=timeout
+        )
         if response.status_code == 200:
             # The response from the server is expected to be JSON
             print("Response:", response.json().get("response", "No response received"))
         else:
             # If an error happens, FastAPI will still return JSON formatted error messages
+            print_error(response)
+    except Exception as e:
+        print(f"An error occurred while sending the request: {e}")
+
+
+def stream_request(
+    question: str,
+    server_url: str = "http://localhost:8000",
+    bypass_cache: bool = False,
+    timeout: Optional[float] = None,
+    session: Optional[requests.Session] = None,
+):
+    endpoint_url = f"{server_url}/ask/stream"
+
+    payload = {"question": question}
+    headers = request_headers(bypass_cache, timeout)
+    start = time.perf_counter()
+    first_token = None
+    try:
+        with (session or requests).post(
+            endpoint_url, json=payload, headers=headers, stream=True, timeout=timeout
+        ) as response:
+            if response.status_code != 200:
+                print_error(response)
+                return
+            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                print(chunk, end="", flush=True)
+        print()
+        if first_token is not None:
             print(
-                "Error:",
-                response.status_code,
-                response.json().get("detail", "Unknown error"),
+                f"Time to first token: {first_token:.2f}s, total: {time.perf_counter() - start:.2f}s",
+                file=sys.stderr,
             )
+    except KeyboardInterrupt:
+        # Closing the connection tells the server to stop generating
+        print("\nGeneration cancelled.", file=sys.stderr)
     except Exception as e:
         print(f"An error occurred while sending the request: {e}")
 
 
+def retry_delay(response, attempt: int, backoff: float) -> float:
+    """Wait as long as the server asks, or back off exponentially with jitter."""
+    if response is not None:
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            pass
+    return min(60.0, backoff * 2**attempt) * random.uniform(0.5, 1.0)
+
+
+def ask_with_retries(
+    session: requests.Session,
+    question: str,
+    server_url: str,
+    bypass_cache: bool = False,
+    timeout: Optional[float] = None,
+    retries: int = 3,
+    backoff: float = 1.0,
+) -> dict:
+    """Ask one question, retrying on 429, 5xx and connection errors.
+
+    Returns a result with the answer or the last error, and the latency of
+    the question including any retries.
+    """
+    headers = request_headers(bypass_cache, timeout)
+    start = time.perf_counter()
+    result = {"question": question}
+    for attempt in range(retries + 1):
+        response = None
+        try:
+            response = session.post(
+                f"{server_url}/ask",
+                json={"question": question},
+                headers=headers,
+                timeout=timeout,
+            )
+        except requests.RequestException as e:
+            result.update(status=None, error=str(e))
+        else:
+            if response.status_code == 200:
+                body = response.json()
+                result.update(
+                    status=200,
+                    response=body.get("response"),
+                    cached=body.get("cached"),
+                    error=None,
+                )
+                break
+            result.update(status=response.status_code, error=error_detail(response))
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+        if attempt < retries:
+            time.sleep(retry_delay(response, attempt, backoff))
+    result["attempts"] = attempt + 1
+    result["latency"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def read_questions(path: str) -> List[dict]:
+    """Read one question per line of a text file, or per object of a JSONL file.
+
+    JSONL lines are either a string or an object with a `question` field. The
+    other fields of the object, such as an ID, are copied to the output.
+    """
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not path.endswith(".jsonl"):
+                questions.append({"question": line})
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            if not isinstance(item, dict) or "question" not in item:
+                raise ValueError(f"{path}:{number}: expected a string or an object with a 'question'")
+            questions.append(item)
+    return questions
+
+
+def run_batch(
+    path: str,
+    server_url: str = "http://localhost:8000",
+    output: Optional[str] = None,
+    concurrency: int = 4,
+    retries: int = 3,
+    bypass_cache: bool = False,
+    timeout: Optional[float] = None,
+) -> int:
+    """Ask every question of a file and write one JSON line per answer.
+
+    Lines are written as answers arrive, so they are not in input order;
+    each carries the `index` of its question. Returns the number of questions
+    that failed.
+    """
+    questions = read_questions(path)
+    session = create_session(concurrency)
+    out = open(output, "w", encoding="utf-8") if output else sys.stdout
+    failed = 0
+    start = time.perf_counter()
+
+    def ask(index: int, item: dict) -> dict:
+        result = ask_with_retries(
+            session, item["question"], server_url, bypass_cache, timeout, retries
+        )
+        return {**item, "index": index, **result}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = [executor.submit(ask, i, item) for i, item in enumerate(questions)]
+            for future in as_completed(futures):
+                result = future.result()
+                failed += result["status"] != 200
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+    finally:
+        session.close()
+        if output:
+            out.close()
+    print(
+        f"Answered {len(questions) - failed} of {len(questions)} questions in {time.perf_counter() - start:.1f}s.",
+        file=sys.stderr,
+    )
+    return failed
+
+
+def repl(
+    server_url: str = "http://localhost:8000",
+    stream: bool = False,
+    bypass_cache: bool = False,
+    timeout: Optional[float] = None,
+):
+    """Read questions from the terminal, reusing one connection to the server."""
+    session = create_session()
+    print("Type a question, or 'exit' to quit.", file=sys.stderr)
+    try:
+        while True:
+            try:
+                question = input("neutron> ").strip()
+            except (EOFError, KeyboardInterrupt):
+                print(file=sys.stderr)
+                break
+            if question in ("exit", "quit"):
+                break
+            if not question:
+                continue
+            if stream:
+                stream_request(question, server_url, bypass_cache, timeout, session)
+            else:
+                send_request(question, server_url, bypass_cache, timeout, session)
+    finally:
+        session.close()
+
+
+def submit_job(
+    question: str,
+    server_url: str = "http://localhost:8000",
+    priority: str = "normal",
+    webhook: Optional[str] = None,
+    bypass_cache: bool = False,
+) -> Optional[str]:
+    """Queue a question as a job and print its ID. Returns the ID, or None on failure."""
+    payload = {"question": question, "priority": priority, "webhook": webhook}
+    try:
+        response = requests.post(
+            f"{server_url}/jobs", json=payload, headers=request_headers(bypass_cache), timeout=30
+        )
+    except requests.RequestException as e:
+        print(f"An error occurred while sending the request: {e}")
+        return None
+    if response.status_code != 202:
+        print_error(response)
+        return None
+    job_id = response.json()["job_id"]
+    print(job_id)
+    return job_id
+
+
+def wait_for_job(
+    job_id: str,
+    server_url: str = "http://localhost:8000",
+    interval: float = 2.0,
+    timeout: Optional[float] = None,
+) -> bool:
+    """Poll a job until it finishes and print its answer. Returns whether it succeeded.
+
+    Connection errors are retried, so waiting carries on across a restart of
+    the server.
+    """
+    session = create_session()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    status = None
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                response = session.get(
+                    f"{server_url}/jobs/{job_id}", headers=request_headers(), timeout=30
+                )
+            except requests.RequestException as e:
+                print(f"Could not reach the server, retrying: {e}", file=sys.stderr)
+                time.sleep(interval)
+                continue
+            if response.status_code != 200:
+                print_error(response)
+                return False
+            job = response.json()
+            if job["status"] != status:
+                status = job["status"]
+                print(f"Job {job_id} is {status}.", file=sys.stderr)
+            if status == "done":
+                print("Response:", job["result"].get("response", "No response received"))
+                return True
+            if status in ("failed", "cancelled"):
+                print("Error:", job.get("error", "Unknown error"))
+                return False
+            time.sleep(interval)
+    finally:
+        session.close()
+    print(f"Job {job_id} did not finish within {timeout}s.", file=sys.stderr)
+    return False
+
+
+def jobs_main(argv: List[str]):
+    """The `submit` and `wait` commands, for questions that run as background jobs."""
+    parser = argparse.ArgumentParser(
+        prog="neutron-client",
+        description="Run questions as background jobs on the AI server.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="Queue a question and print its job ID.")
+    submit.add_argument("question", type=str, help="The question to ask the AI server.")
+    submit.add_argument(
+        "--priority",
+        type=str,
+        choices=["low", "normal", "high"],
+        default="normal",
+        help="Higher priority jobs are answered first. Default is normal.",
+    )
+    submit.add_argument(
+        "--webhook",
+        type=str,
+        default=None,
+        help="A URL the server posts the finished job to.",
+    )
+    submit.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Generate a fresh answer instead of reusing a cached one.",
+    )
+    submit.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for the answer and print it.",
+    )
+    wait = commands.add_parser("wait", help="Wait for a job to finish and print its answer.")
+    wait.add_argument("job_id", type=str, help="The ID printed by submit.")
+    for command in (submit, wait):
+        command.add_argument(
+            "--server_url",
+            type=str,
+            default="http://localhost:8000",
+            help="The URL of the AI server, defaults to http://localhost:8000",
+        )
+        command.add_argument(
+            "--interval",
+            type=float,
+            default=2.0,
+            help="Seconds between checks of the job. Default is 2.",
+        )
+        command.add_argument(
+            "--timeout",
+            type=float,
+            default=None,
+            help="Seconds to wait for the job. By default there is no limit.",
+        )
+
+    args = parser.parse_args(argv)
+    if args.command == "submit":
+        job_id = submit_job(
+            args.question, args.server_url, args.priority, args.webhook, args.no_cache
+        )
+        if job_id is None:
+            sys.exit(1)
+        if not args.wait:
+            return
+    else:
+        job_id = args.job_id
+    if not wait_for_job(job_id, args.server_url, args.interval, args.timeout):
+        sys.exit(1)
+
+
 def main():
-    parser = argparse.ArgumentParser(description="Send a question to the AI server.")
-    parser.add_argument("question", type=str, help="The question to ask the AI server.")
+    if sys.argv[1:2] in (["submit"], ["wait"]):
+        jobs_main(sys.argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Send a question to the AI server. Use 'submit' and 'wait' to run it as a background job."
+    )
+    parser.add_argument(
+        "question",
+        type=str,
+        nargs="?",
+        help="The question to ask the AI server. Without a question or --batch, questions are read interactively.",
+    )
     parser.add_argument(
         "--server_url",
         type=str,
@@ -40,9 +427,66 @@ def main():
         help="The URL of the AI server, defaults to http://localhost:8000",
     )
 
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print the answer as it is generated. Press Ctrl+C to cancel.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Generate a fresh answer instead of reusing a cached one.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for the answer. The server stops generating when they run out.",
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        default=None,
+        help="Ask every question of a .txt file (one per line) or a .jsonl file, and print one JSON line per answer.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write the --batch results to this file instead of standard output.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Questions of a --batch sent at once. Default is 4.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Retries of a --batch question that got 429, a 5xx error or no response. Default is 3.",
+    )
+
     args = parser.parse_args()
 
-    send_request(args.question, args.server_url)
+    if args.batch:
+        failed = run_batch(
+            args.batch,
+            args.server_url,
+            args.output,
+            args.concurrency,
+            args.retries,
+            args.no_cache,
+            args.timeout,
+        )
+        sys.exit(1 if failed else 0)
+    elif args.question is None:
+        repl(args.server_url, args.stream, args.no_cache, args.timeout)
+    elif args.stream:
+        stream_request(args.question, args.server_url, args.no_cache, args.timeout)
+    else:
+        send_request(args.question, args.server_url, args.no_cache, args.timeout)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,276 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from zipfile import ZipFile
+
+import requests
+
+CHUNK_SIZE = 1024 * 1024
+# How often the resume state of a parallel download is written to disk
+STATE_SAVE_INTERVAL = 2.0
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _load_state(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Ignoring unreadable download state {path}: {e}")
+        return None
+
+
+def _save_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _split_ranges(size, parts):
+    part_size = -(-size // parts)
+    return [
+        [start, min(start + part_size, size) - 1, 0]
+        for start in range(0, size, part_size)
+    ]
+
+
+class _Progress:
+    def __init__(self, total, done=0, show=True):
+        self.total = total
+        self.done = done
+        self.show = show
+        self.last_print = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if self.show and (now - self.last_print >= 1 or self.done == self.total):
+                self.last_print = now
+                self._print()
+
+    def _print(self):
+        mb = 1024 * 1024
+        if self.total:
+            print(
+                f"\rDownloaded {self.done / mb:.0f}/{self.total / mb:.0f} MB ({100 * self.done / self.total:.0f}%)",
+                end="",
+                file=sys.stderr,
+                flush=True,
+            )
+        else:
+            print(f"\rDownloaded {self.done / mb:.0f} MB", end="", file=sys.stderr, flush=True)
+
+
+def _download_range(session, url, part_path, byte_range, state, state_path, lock, progress, timeout):
+    start, end, done = byte_range
+    if start + done > end:
+        return
+    headers = {"Range": f"bytes={start + done}-{end}"}
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code != 206:
+            raise DownloadError(
+                f"Expected a partial response for {headers['Range']}, got {response.status_code}"
+            )
+        with open(part_path, "r+b") as f:
+            f.seek(start + done)
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                progress.add(len(chunk))
+                with lock:
+                    byte_range[2] += len(chunk)
+                    if time.monotonic() - state["saved_at"] >= STATE_SAVE_INTERVAL:
+                        f.flush()
+                        state["saved_at"] = time.monotonic()
+                        _save_state(state_path, {k: v for k, v in state.items() if k != "saved_at"})
+
+
+def _download_single(session, url, part_path, progress, timeout):
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        with open(part_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                progress.add(len(chunk))
+
+
+def file_digest(path, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_file(path, expected_sha256=None, etag=None):
+    """Check a downloaded file against a SHA-256 or, failing that, an MD5 ETag.
+
+    S3 ETags are the MD5 of the object unless it was uploaded in several parts,
+    in which case they contain a dash and cannot be checked this way. A file
+    with neither is accepted with a warning.
+    """
+    if expected_sha256:
+        actual = file_digest(path, "sha256")
+        if actual != expected_sha256.lower():
+            raise DownloadError(f"SHA-256 mismatch for {path}: {actual}")
+        return True
+    md5 = (etag or "").strip('"')
+    if re.fullmatch(r"[0-9a-fA-F]{32}", md5):
+        actual = file_digest(path, "md5")
+        if actual != md5.lower():
+            raise DownloadError(f"MD5 mismatch for {path}: {actual} != {md5}")
+        return True
+    message = (
+        f"No SHA-256 was published for {path} and its ETag {etag!r} is not an MD5, "
+        "so the download could not be verified."
+    )
+    # The log level is ERROR by default, this should be seen anyway
+    logging.warning(message)
+    print(f"Warning: {message}", file=sys.stderr)
+    return False
+
+
+def download(
+    url: str,
+    dest: str,
+    parts: int = 8,
+    expected_sha256: Optional[str] = None,
+    timeout: float = 30,
+    show_progress: bool = True,
+) -> Optional[str]:
+    """Download `url` to `dest` with parallel range requests and return its ETag.
+
+    Data is written into `dest.part`, and the progress of every range is
+    recorded in `dest.part.json`. An interrupted download resumes from there,
+    as long as the remote ETag and size are unchanged. Servers without range
+    support get a single plain download. The file is verified before it is
+    renamed to `dest`.
+    """
+    part_path = f"{dest}.part"
+    state_path = f"{dest}.part.json"
+    session = requests.Session()
+    head = session.head(url, allow_redirects=True, timeout=timeout)
+    head.raise_for_status()
+    size = int(head.headers.get("Content-Length") or 0)
+    etag = head.headers.get("ETag")
+    ranged = head.headers.get("Accept-Ranges", "").lower() == "bytes" and size > 0
+
+    if not ranged:
+        logging.info(f"{url} does not support range requests, downloading in one stream.")
+        progress = _Progress(size, show=show_progress)
+        _download_single(session, url, part_path, progress, timeout)
+    else:
+        state = _load_state(state_path)
+        if (
+            state is None
+            or state.get("etag") != etag
+            or state.get("size") != size
+            or not os.path.exists(part_path)
+        ):
+            state = {"url": url, "etag": etag, "size": size, "ranges": _split_ranges(size, max(1, parts))}
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+            _save_state(state_path, state)
+        else:
+            logging.info(f"Resuming download of {url}.")
+        state["saved_at"] = time.monotonic()
+        progress = _Progress(
+            size, sum(done for _, _, done in state["ranges"]), show=show_progress
+        )
+        lock = threading.Lock()
+        try:
+            with ThreadPoolExecutor(max_workers=len(state["ranges"])) as executor:
+                futures = [
+                    executor.submit(
+                        _download_range, session, url, part_path, byte_range, state, state_path, lock, progress, timeout
+                    )
+                    for byte_range in state["ranges"]
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            with lock:
+                _save_state(state_path, {k: v for k, v in state.items() if k != "saved_at"})
+    if show_progress:
+        print(file=sys.stderr)
+
+    try:
+        verify_file(part_path, expected_sha256, etag)
+    except DownloadError:
+        # A corrupt file cannot be resumed, start from scratch next time
+        for path in (part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.replace(part_path, dest)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return etag
+
+
+def recover_directory(target_dir: str):
+    """Restore `target_dir` from its backup if a swap was interrupted."""
+    backup_dir = f"{target_dir}.old"
+    if not os.path.exists(target_dir) and os.path.isdir(backup_dir):
+        logging.warning(f"Restoring {target_dir} from an interrupted update.")
+        os.replace(backup_dir, target_dir)
+
+
+def swap_directory(new_dir: str, target_dir: str):
+    """Replace `target_dir` with `new_dir` using renames, so it is never half written.
+
+    Both directories must be on the same filesystem.
+    """
+    backup_dir = f"{target_dir}.old"
+    if os.path.exists(backup_dir):
+        shutil.rmtree(backup_dir)
+    if os.path.exists(target_dir):
+        os.replace(target_dir, backup_dir)
+    try:
+        os.replace(new_dir, target_dir)
+    except Exception:
+        if os.path.exists(backup_dir):
+            os.replace(backup_dir, target_dir)
+        raise
+    shutil.rmtree(backup_dir, ignore_errors=True)
+
+
+def extract_zip_atomic(zip_path: str, target_dir: str):
+    """Extract `zip_path` next to `target_dir`, then swap it into place.
+
+    Files are extracted straight into a staging directory beside the target,
+    so each byte is written once and the final step is a rename. When the
+    archive wraps everything in a folder named like the target, the contents
+    of that folder are used.
+    """
+    staging_dir = f"{target_dir}.staging"
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    try:
+        with ZipFile(zip_path, "r") as zip_ref:
+            zip_ref.extractall(staging_dir)
+        root = staging_dir
+        entries = os.listdir(staging_dir)
+        if entries == [os.path.basename(os.path.normpath(target_dir))] and os.path.isdir(
+            os.path.join(staging_dir, entries[0])
+        ):
+            root = os.path.join(staging_dir, entries[0])
+        swap_directory(root, target_dir)
+    finally:
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
@@ -0,0 +1,215 @@
+import collections
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Iterator, List, Optional, Tuple
+
+from neutron.interactive_model import InteractiveModel
+from neutron.scheduler import BatchScheduler, RequestCancelled, abort_reason
+from neutron.sessions import SessionStore
+
+
+class LocalEngine:
+    """Answers questions with a model loaded in this process.
+
+    The server talks to an engine rather than to the model directly, so the
+    same endpoints work with a `WorkerPool` of model processes.
+    """
+
+    ready = True
+
+    def __init__(
+        self,
+        model: InteractiveModel,
+        scheduler: BatchScheduler,
+        sessions: Optional[SessionStore] = None,
+    ):
+        self.model = model
+        self.scheduler = scheduler
+        self.sessions = sessions or SessionStore(device=str(model.model.device))
+
+    def ask(
+        self,
+        question: str,
+        use_cache: bool = True,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> dict:
+        """Answer a question.
+
+        Raises `RequestCancelled` or `DeadlineExceeded` if the request is
+        cancelled, or runs past `deadline` (a `time.monotonic()` value).
+        """
+        embedding = None
+        if use_cache:
+            cached, embedding = self.model.answer_cache.lookup(question)
+            if cached is not None:
+                return {"response": cached, "cached": True, "timings": {}}
+        # The context is gathered on the request thread, then the prompt is
+        # queued so it can be generated together with concurrent requests
+        prompt, timings = self.model.build_prompt(question)
+        response = self.scheduler.submit(prompt, cancel_event, deadline).result()
+        # A bypassed lookup still refreshes the cached answer
+        self.model.answer_cache.add(question, response, embedding)
+        return {"response": response, "cached": False, "timings": timings}
+
+    def stream(
+        self,
+        question: str,
+        use_cache: bool = True,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> Tuple[bool, Iterator[str]]:
+        """Return whether the answer came from the cache, and its text as it is generated."""
+        embedding = None
+        if use_cache:
+            cached, embedding = self.model.answer_cache.lookup(question)
+            if cached is not None:
+                return True, iter([cached])
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        return False, self._stream(question, embedding, cancel_event, deadline)
+
+    def _stream(self, question: str, embedding, cancel_event, deadline):
+        answer = []
+        for text in self.model.stream(question, cancel_event, deadline):
+            answer.append(text)
+            yield text
+        # Only complete answers are cached, a failed generation raises above
+        if not cancel_event.is_set() and (
+            deadline is None or time.monotonic() < deadline
+        ):
+            self.model.answer_cache.add(question, "".join(answer), embedding)
+
+    def ask_batch(
+        self,
+        questions: List[str],
+        use_cache: bool = True,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> Iterator[dict]:
+        """Answer many questions, yielding each result as soon as it is ready.
+
+        Results carry the `index` of their question and come in completion
+        order, cached answers first. A question that fails has an `error`
+        instead of a `response`.
+        """
+        # One forward pass embeds every question, for the cache and the retrieval
+        embeddings = self.model.embed_questions(questions)
+        cache_embeddings = {}
+        misses = []
+        for index, question in enumerate(questions):
+            if use_cache:
+                cached, cache_embeddings[index] = self.model.answer_cache.lookup(
+                    question, embeddings[index]
+                )
+                if cached is not None:
+                    yield {
+                        "index": index,
+                        "question": question,
+                        "response": cached,
+                        "cached": True,
+                        "timings": {},
+                    }
+                    continue
+            misses.append(index)
+        if not misses:
+            return
+        prompts = self.model.build_prompts(
+            [questions[index] for index in misses],
+            [embeddings[index] for index in misses],
+        )
+
+        # Only a batch worth of prompts is queued at a time, so questions
+        # from other requests still get a place in the next batches
+        waiting = collections.deque(zip(misses, prompts))
+        running = {}
+        while waiting or running:
+            while waiting and len(running) < self.scheduler.max_batch_size:
+                index, (prompt, timings) = waiting.popleft()
+                future = self.scheduler.submit(prompt, cancel_event, deadline)
+                running[future] = (index, timings)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, timings = running.pop(future)
+                question = questions[index]
+                try:
+                    response = future.result()
+                except Exception as e:
+                    yield {"index": index, "question": question, "error": str(e)}
+                    continue
+                # Without a lookup, the batch embedding still spares embedding it again
+                self.model.answer_cache.add(
+                    question, response, cache_embeddings.get(index, embeddings[index])
+                )
+                yield {
+                    "index": index,
+                    "question": question,
+                    "response": response,
+                    "cached": False,
+                    "timings": timings,
+                }
+
+    def create_session(self) -> dict:
+        return {"session_id": self.sessions.create().id}
+
+    def get_session(self, session_id: str) -> dict:
+        return self.sessions.get(session_id).describe()
+
+    def delete_session(self, session_id: str) -> dict:
+        self.sessions.delete(session_id)
+        return {"session_id": session_id, "deleted": True}
+
+    def session_ask(
+        self,
+        session_id: str,
+        question: str,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> dict:
+        """Answer a question in a session, continuing its conversation.
+
+        Session turns do not go through the batch scheduler or the answer
+        cache, their answers depend on the conversation.
+        """
+        session = self.sessions.get(session_id)
+        with session.lock:
+            cache = self.sessions.take_cache(session)
+            input_ids, cache, timings, restarted = self.model.session_prompt(
+                question, session.input_ids, cache, session.turns
+            )
+            if restarted:
+                self.sessions.record_restart()
+            history_tokens = 0 if session.input_ids is None else session.input_ids.shape[1]
+            cached_tokens = 0 if cache is None else cache.get_seq_length()
+            answer, conversation, cache = self.model.generate_turn(
+                input_ids, cache, cancel_event, deadline
+            )
+            if answer is None:
+                # The cache was extended with a partial answer, so it is not kept
+                self.sessions.store(session, session.input_ids, None)
+                raise abort_reason(cancel_event, deadline) or RequestCancelled(
+                    "Generation was stopped"
+                )
+            session.turns.append((question, answer))
+            self.sessions.store(session, conversation, cache)
+        return {
+            "session_id": session_id,
+            "response": answer,
+            "turn": len(session.turns),
+            "timings": timings,
+            "history_tokens": history_tokens,
+            "prefill_tokens": input_ids.shape[1] - cached_tokens,
+            "restarted": restarted,
+        }
+
+    def stop(self):
+        """Save the state kept across restarts, like the persisted search cache."""
+        self.model.search_cache.close()
+
+    def stats(self) -> dict:
+        return {
+            **self.model.stats(),
+            "queue_depth": self.scheduler.qsize(),
+            "sessions": self.sessions.stats(),
+        }
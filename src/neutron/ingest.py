@@ -0,0 +1,352 @@
+"""Add your own documents to the knowledge base in neutron_chroma.db.
+
+Markdown and text files are split into chunks, embedded with the same
+all-MiniLM-L12-v2 model the server uses for questions, and upserted into the
+Chroma store. Every chunk is stored with the hash of its text, so running
+the ingestion again only embeds the chunks that changed:
+
+    neutron-ingest playbooks/ notes/
+
+A chunk's ID is its file and the hash of its text, so an edit near the top
+of a file does not change the IDs of the chunks after it. A new chunk whose
+text is already in the store takes the stored embedding instead of being
+embedded again. Chunks that are no longer in their file are deleted. With
+`--prune`, the chunks of files that were deleted from the given directories
+are removed as well.
+
+Ingested chunks live in the same store as the downloaded knowledge base, so
+they are replaced along with it when a new version is downloaded. Run the
+ingestion again after an update.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+from langchain_text_splitters import (MarkdownTextSplitter,
+                                      RecursiveCharacterTextSplitter)
+
+from neutron.vector_index import INGEST_FILE
+
+EMBEDDING_MODEL = "all-MiniLM-L12-v2"
+EXTENSIONS = {".md": "markdown", ".markdown": "markdown", ".txt": "text"}
+HEADING_PATTERN = re.compile(r"^#{1,6} ", re.MULTILINE)
+
+
+def find_files(directories: List[str]) -> List[str]:
+    """The markdown and text files under `directories`, as absolute paths."""
+    files = []
+    for directory in directories:
+        if os.path.isfile(directory):
+            files.append(os.path.abspath(directory))
+            continue
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(names):
+                if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                    files.append(os.path.abspath(os.path.join(root, name)))
+    return files
+
+
+def chunk_file(path: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[str]:
+    """Split a file into chunks, along headings first for markdown."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    if EXTENSIONS.get(os.path.splitext(path)[1].lower()) == "markdown":
+        splitter = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        # Sections are split on their own, so an edit only changes the chunks
+        # of its section instead of shifting every chunk after it
+        starts = [match.start() for match in HEADING_PATTERN.finditer(text)]
+        sections = [text[a:b] for a, b in zip([0] + starts, starts + [len(text)])]
+    else:
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+        sections = [text]
+    return [
+        chunk
+        for section in sections
+        for chunk in splitter.split_text(section)
+        if chunk.strip()
+    ]
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_encoder(
+    workers: int = 1, batch_size: int = 256, device: Optional[str] = None
+) -> Tuple[Callable[[List[str]], List[List[float]]], Optional[Callable[[], None]]]:
+    """Embed texts with the knowledge base model, in `workers` processes.
+
+    On a machine with GPUs the workers take the GPUs in turn, otherwise they
+    share the CPU cores. Returns the embedding function and a function that
+    stops the processes, or None with a single worker.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = SentenceTransformer(EMBEDDING_MODEL, device=device)
+    if workers <= 1:
+
+        def embed(texts: List[str]) -> List[List[float]]:
+            return model.encode(texts, batch_size=batch_size).tolist()
+
+        return embed, None
+
+    if device.startswith("cuda"):
+        count = max(1, torch.cuda.device_count())
+        target_devices = [f"cuda:{index % count}" for index in range(workers)]
+    else:
+        target_devices = ["cpu"] * workers
+    pool = model.start_multi_process_pool(target_devices=target_devices)
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        return model.encode_multi_process(texts, pool, batch_size=batch_size).tolist()
+
+    return embed, lambda: model.stop_multi_process_pool(pool)
+
+
+def ingest(
+    directories: List[str],
+    chroma_directory: str = "neutron_chroma.db",
+    chunk_size: int = 1000,
+    chunk_overlap: int = 200,
+    batch_size: int = 256,
+    workers: int = 1,
+    prune: bool = False,
+    embed: Optional[Callable[[List[str]], List[List[float]]]] = None,
+    vector_store=None,
+) -> Dict[str, float]:
+    """Upsert the changed chunks of `directories` into the Chroma store.
+
+    `embed` and `vector_store` take the place of the embedding model and of
+    the store in `chroma_directory`. Returns counts and timings.
+    """
+    start = time.perf_counter()
+    if vector_store is None:
+        from langchain_community.vectorstores import Chroma
+
+        vector_store = Chroma(persist_directory=chroma_directory)
+    collection = vector_store._collection
+    stats = {
+        "files": 0,
+        "chunks": 0,
+        "unchanged": 0,
+        "reused": 0,
+        "embedded": 0,
+        "deleted": 0,
+        "chunk_seconds": 0.0,
+        "embed_seconds": 0.0,
+        "upsert_seconds": 0.0,
+    }
+
+    records = collection.get(where={"ingested": True}, include=["metadatas"])
+    existing = {
+        chunk_id: metadata for chunk_id, metadata in zip(records["ids"], records["metadatas"])
+    }
+
+    # Any stored chunk with the same text can lend its embedding
+    stored_hashes = {
+        metadata.get("content_hash"): chunk_id for chunk_id, metadata in existing.items()
+    }
+
+    files = find_files(directories)
+    current = set()
+    pending = []  # (id, text, metadata)
+    copies = []  # (id, text, metadata) of new chunks whose text is already stored
+    moved = []  # (id, metadata) of stored chunks at a new position
+    for path in files:
+        for index, text in enumerate(chunk_file(path, chunk_size, chunk_overlap)):
+            digest = content_hash(text)
+            chunk_id = f"{path}#{digest[:16]}"
+            # A text repeated within the file gets one ID per occurrence
+            repeat = 1
+            while chunk_id in current:
+                chunk_id = f"{path}#{digest[:16]}-{repeat}"
+                repeat += 1
+            current.add(chunk_id)
+            metadata = {"source": path, "chunk": index, "content_hash": digest, "ingested": True}
+            stored = existing.get(chunk_id)
+            if stored is not None and stored.get("content_hash") == digest:
+                stats["unchanged"] += 1
+                if stored.get("chunk") != index:
+                    moved.append((chunk_id, metadata))
+            elif digest in stored_hashes:
+                copies.append((chunk_id, text, metadata))
+            else:
+                pending.append((chunk_id, text, metadata))
+    stats["files"] = len(files)
+    stats["chunks"] = len(current)
+    stats["chunk_seconds"] = time.perf_counter() - start
+
+    # Chunks past the new end of a file, and with --prune those of deleted files
+    seen_sources = set(files)
+    roots = [os.path.join(os.path.abspath(d), "") for d in directories if os.path.isdir(d)]
+    stale = [
+        chunk_id
+        for chunk_id, metadata in existing.items()
+        if chunk_id not in current
+        and (
+            metadata.get("source") in seen_sources
+            or (prune and any(metadata.get("source", "").startswith(root) for root in roots))
+        )
+    ]
+
+    stop = None
+    if pending and embed is None:
+        embed, stop = load_encoder(workers, batch_size)
+    # Enough chunks per call to keep every worker busy with full batches
+    group_size = batch_size * max(1, workers) * 4
+    max_upsert = collection._client.get_max_batch_size()
+    try:
+        # Upserts of one group overlap with embedding the next
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            upserts = []
+            for offset in range(0, len(pending), group_size):
+                group = pending[offset : offset + group_size]
+                embed_start = time.perf_counter()
+                embeddings = embed([text for _, text, _ in group])
+                stats["embed_seconds"] += time.perf_counter() - embed_start
+                stats["embedded"] += len(group)
+                for part in range(0, len(group), max_upsert):
+                    upserts.append(
+                        writer.submit(
+                            _upsert,
+                            collection,
+                            group[part : part + max_upsert],
+                            embeddings[part : part + max_upsert],
+                            stats,
+                        )
+                    )
+                logging.info(f"Embedded {stats['embedded']} of {len(pending)} chunks.")
+            for upsert in upserts:
+                upsert.result()
+    finally:
+        if stop is not None:
+            stop()
+    # Copied before the stale chunks they may come from are deleted
+    for part in range(0, len(copies), max_upsert):
+        group = copies[part : part + max_upsert]
+        records = collection.get(
+            ids=list({stored_hashes[metadata["content_hash"]] for _, _, metadata in group}),
+            include=["embeddings"],
+        )
+        embeddings = dict(zip(records["ids"], records["embeddings"]))
+        _upsert(
+            collection,
+            group,
+            [embeddings[stored_hashes[metadata["content_hash"]]] for _, _, metadata in group],
+            stats,
+        )
+    stats["reused"] = len(copies)
+    for part in range(0, len(moved), max_upsert):
+        group = moved[part : part + max_upsert]
+        collection.update(
+            ids=[chunk_id for chunk_id, _ in group],
+            metadatas=[metadata for _, metadata in group],
+        )
+    for part in range(0, len(stale), max_upsert):
+        collection.delete(ids=stale[part : part + max_upsert])
+    stats["deleted"] = len(stale)
+
+    if (pending or copies or moved or stale) and os.path.isdir(chroma_directory):
+        with open(os.path.join(chroma_directory, INGEST_FILE), "w") as f:
+            json.dump({"version": uuid.uuid4().hex, "updated_at": time.time()}, f)
+    stats["total_seconds"] = time.perf_counter() - start
+    return stats
+
+
+def _upsert(collection, records, embeddings, stats):
+    start = time.perf_counter()
+    collection.upsert(
+        ids=[chunk_id for chunk_id, _, _ in records],
+        embeddings=embeddings,
+        documents=[text for _, text, _ in records],
+        metadatas=[metadata for _, _, metadata in records],
+    )
+    stats["upsert_seconds"] += time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add markdown and text files to the Neutron knowledge base."
+    )
+    parser.add_argument(
+        "directories",
+        type=str,
+        nargs="+",
+        help="Directories (searched recursively) or files to ingest. .md, .markdown and .txt files are read.",
+    )
+    parser.add_argument(
+        "--chroma-directory",
+        type=str,
+        default="neutron_chroma.db",
+        help="The Chroma store to add the documents to. Default is neutron_chroma.db.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="The most characters in a chunk. Default is 1000.",
+    )
+    parser.add_argument(
+        "--chunk-overlap",
+        type=int,
+        default=200,
+        help="Characters shared by neighbouring chunks. Default is 200.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=256,
+        help="Chunks embedded together in one forward pass. Default is 256.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Embedding processes. With GPUs they take the GPUs in turn, otherwise they share the CPU cores. Default is 1.",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Also delete the chunks of files that no longer exist in the given directories.",
+    )
+    args = parser.parse_args()
+
+    stats = ingest(
+        args.directories,
+        args.chroma_directory,
+        args.chunk_size,
+        args.chunk_overlap,
+        args.batch_size,
+        args.workers,
+        args.prune,
+    )
+    print(
+        f"Read {stats['files']} files into {stats['chunks']} chunks in {stats['chunk_seconds']:.1f}s: "
+        f"{stats['embedded']} new or changed, {stats['reused']} copied from identical chunks, "
+        f"{stats['unchanged']} unchanged, {stats['deleted']} deleted."
+    )
+    if stats["embedded"]:
+        print(
+            f"Embedded {stats['embedded']} chunks in {stats['embed_seconds']:.1f}s "
+            f"({stats['embedded'] / max(stats['embed_seconds'], 1e-9):.0f} chunks/s), "
+            f"upserts took {stats['upsert_seconds']:.1f}s."
+        )
+    print(f"Done in {stats['total_seconds']:.1f}s. Restart the server to use the new documents.")
+
+
+if __name__ == "__main__":
+    main()
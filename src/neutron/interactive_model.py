@@ -1,73 +1,313 @@
+import copy
+import logging
+import math
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import torch
 import transformers
 from langchain_community.embeddings.sentence_transformer import \
     SentenceTransformerEmbeddings
-from langchain_community.llms import HuggingFacePipeline
 from langchain_community.tools import DuckDuckGoSearchRun
 from langchain_community.vectorstores import Chroma
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from transformers import (AutoModelForCausalLM, AutoTokenizer,
-                          BitsAndBytesConfig, pipeline)
-
-from neutron import utilities
-import sys
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from transformers import (AutoTokenizer, StoppingCriteria,
+                          StoppingCriteriaList, TextIteratorStreamer)
+
+from neutron import backends, checkpoints, metrics, utilities
+from neutron.cache import SearchCache, SemanticCache, normalize_question
+from neutron.sessions import cache_tensors
+from neutron.vector_index import VectorIndexRetriever, load_index
+
 transformers.logging.set_verbosity_error()
 
+# Where the model starts writing a new prompt section instead of answering
+ANSWER_BOUNDARY = re.compile(r"\n[ \t]*(?:Question|Given contexts|Answer):")
+BOUNDARY_HEADINGS = ("Question:", "Given contexts:", "Answer:")
+# Context that is cut short must keep at least this many tokens to be included
+MIN_CONTEXT_TOKENS = 32
+# Threads for web searches and retrievals
+CONTEXT_THREADS = 8
+
+
+class CancelCriteria(StoppingCriteria):
+    """Stops each row once its event is set or its deadline has passed.
+
+    Rows without an event or a deadline run to the end. The rows that were
+    stopped this way are recorded in `aborted`.
+    """
+
+    def __init__(
+        self,
+        events: List[Optional[threading.Event]],
+        deadlines: Optional[List[Optional[float]]] = None,
+    ):
+        self.events = events
+        self.deadlines = deadlines or [None] * len(events)
+        self.aborted = set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.monotonic()
+        stop = []
+        for row, (event, deadline) in enumerate(zip(self.events, self.deadlines)):
+            if (event is not None and event.is_set()) or (
+                deadline is not None and now >= deadline
+            ):
+                self.aborted.add(row)
+                stop.append(True)
+            else:
+                stop.append(False)
+        return torch.tensor(stop, dtype=torch.bool, device=input_ids.device)
+
+
+class ForwardCounter:
+    """Counts the forward passes of a model, read around one `generate` call."""
+
+    def __init__(self, model):
+        self.calls = 0
+        model.register_forward_hook(self._count)
+
+    def _count(self, module, inputs, output):
+        self.calls += 1
+
+
+class FirstTokenTimer(StoppingCriteria):
+    """Records when the first new token was generated, never stops generation."""
 
-class InteractiveModel:
     def __init__(self):
-        # Device configuration
+        self.first_token_at = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class AnswerBoundaryCriteria(StoppingCriteria):
+    """Stops each row once its answer runs into a new prompt section."""
+
+    def __init__(self, tokenizer, prompt_length: int, window: int = 16):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.window = window
+
+    def __call__(self, input_ids, scores, **kwargs):
+        tails = self.tokenizer.batch_decode(
+            input_ids[:, max(self.prompt_length, input_ids.shape[1] - self.window) :],
+            skip_special_tokens=True,
+        )
+        return torch.tensor(
+            [ANSWER_BOUNDARY.search(tail) is not None for tail in tails],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def may_start_boundary(line: str) -> bool:
+    """Whether a partial line, starting at its line break, could still become a boundary."""
+    start = line[1:].lstrip(" \t")
+    return any(heading.startswith(start) for heading in BOUNDARY_HEADINGS)
+
+
+def trim_answer(text: str) -> str:
+    """Cut a generated answer at the first answer boundary."""
+    match = ANSWER_BOUNDARY.search(text)
+    return text[: match.start()] if match else text
+
+
+def gpu_memory() -> Dict[str, dict]:
+    """GPU memory in use by this process, by device index.
+
+    Empty unless the process already uses CUDA, so reading it never
+    initializes CUDA on its own.
+    """
+    if not torch.cuda.is_initialized():
+        return {}
+    return {
+        str(index): {
+            "allocated_bytes": torch.cuda.memory_allocated(index),
+            "reserved_bytes": torch.cuda.memory_reserved(index),
+        }
+        for index in range(torch.cuda.device_count())
+    }
+
 
-        if not torch.cuda.is_available():
-            raise "No gpus available"
-            sys.exit()
-        utilities.check_new_pypi_version()
-        utilities.ensure_model_folder_exists("neutron_model")
-        utilities.ensure_model_folder_exists("neutron_chroma.db")
+class InteractiveModel:
+    def __init__(
+        self,
+        search_tool=None,
+        search_timeout: float = 5.0,
+        retrieval_timeout: float = 10.0,
+        search_cache: Optional[SearchCache] = None,
+        answer_cache_threshold: float = 0.95,
+        answer_cache_size: int = 512,
+        device: str = "auto",
+        threads: Optional[int] = None,
+        cpu_quantization: str = "int8",
+        offline: bool = False,
+        update_check_interval: float = utilities.default_update_check_interval,
+        prefix_cache: bool = True,
+        max_prompt_tokens: int = 3072,
+        max_new_tokens: int = 2048,
+        vector_index: Optional[str] = None,
+        draft_model=None,
+        draft_tokens: Optional[int] = None,
+        checkpoint_cache: Optional[str] = None,
+        model=None,
+        tokenizer=None,
+        embeddings=None,
+        vector_store=None,
+    ):
+        """Load the model, tokenizer, embeddings and vector store.
+
+        Any of `model`, `tokenizer`, `embeddings` and `vector_store` can be
+        passed in ready made, in which case they are used as they are and
+        their files are not downloaded. The benchmarks use this to run with
+        small local stand-ins.
+
+        With `vector_index`, a directory, retrieval uses a memory-mapped copy
+        of the knowledge base instead of Chroma. The copy is made, or brought
+        up to date, from the Chroma directory when needed.
+
+        With `draft_model`, a path or a loaded causal LM, single prompts are
+        generated with assisted decoding: the draft model proposes up to
+        `draft_tokens` tokens at a time and the main model checks them in one
+        forward pass. The answers are the same as without it.
+
+        With `checkpoint_cache`, a directory written by `neutron-checkpoint`,
+        the model, tokenizer and embedding model are loaded from the entry
+        converted for this version of the model and this device, if there is
+        one.
+        """
+        # Seconds spent in each loading phase
+        self.load_timings = {}
+        phase_start = time.perf_counter()
+
+        def end_phase(phase: str):
+            nonlocal phase_start
+            now = time.perf_counter()
+            self.load_timings[phase] = now - phase_start
+            phase_start = now
+
+        # Device configuration
+        self.device = backends.resolve_device(device)
+        # One parallel, cached round of network checks shared by everything below
+        update_state = utilities.run_update_checks(
+            offline=offline, interval=update_check_interval
+        )
+        utilities.check_new_pypi_version(update_state=update_state)
+        if model is None or tokenizer is None:
+            utilities.ensure_model_folder_exists(
+                "neutron_model", update_state=update_state, offline=offline
+            )
+        if vector_store is None:
+            utilities.ensure_model_folder_exists(
+                "neutron_chroma.db", update_state=update_state, offline=offline
+            )
+        end_phase("update_check")
+        # The converted model, tokenizer and embeddings, if they exist
+        self.checkpoint = None
+        if checkpoint_cache and (model is None or tokenizer is None):
+            self.checkpoint = checkpoints.find_entry(
+                checkpoint_cache, utilities.return_path("neutron_model"), self.device
+            )
+            if self.checkpoint is None:
+                logging.info(
+                    f"No converted model in {checkpoint_cache}, run neutron-checkpoint to load faster."
+                )
         # Model and tokenizer configuration
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
-        )
-
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            utilities.return_path("neutron_model"),
-            model_max_length=8192,
-            low_cpu_mem_usage=True,
-        )
-
-        self.model = AutoModelForCausalLM.from_pretrained(
-            utilities.return_path("neutron_model"),
-            low_cpu_mem_usage=True,
-            quantization_config=bnb_config,
-            device_map="auto",
-        )
-        # Pipeline configuration
-        self.pipe = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            max_new_tokens=7000,
-            repetition_penalty=1.2,
-            use_fast=True,
-        )
-        self.search_results = ""
-        self.search = DuckDuckGoSearchRun()
-        # Components for LangChain
-        self.llm = HuggingFacePipeline(pipeline=self.pipe)
-        self.embeddings_model = SentenceTransformerEmbeddings(
-            model_name="all-MiniLM-L12-v2"
-        )
-        self.db = Chroma(
-            embedding_function=self.embeddings_model,
-            persist_directory="neutron_chroma.db",
-        )
-        self.retriever = self.db.as_retriever(search_type="mmr")
+        if tokenizer is None:
+            tokenizer = AutoTokenizer.from_pretrained(
+                os.path.join(self.checkpoint, "tokenizer")
+                if self.checkpoint
+                else utilities.return_path("neutron_model"),
+                model_max_length=8192,
+                low_cpu_mem_usage=True,
+            )
+        self.tokenizer = tokenizer
+        end_phase("tokenizer")
+
+        if model is None:
+            model = backends.load_model(
+                os.path.join(self.checkpoint, "model")
+                if self.checkpoint
+                else utilities.return_path("neutron_model"),
+                device=self.device,
+                threads=threads,
+                cpu_quantization=cpu_quantization,
+                prequantized=self.checkpoint is not None,
+            )
+        self.model = model
+        end_phase("model")
+        if self.checkpoint:
+            logging.info(
+                f"Loaded the model from {self.checkpoint} in {self.load_timings['model']:.2f}s."
+            )
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Batched prompts are padded on the left so generation continues
+        # right after each prompt
+        self.tokenizer.padding_side = "left"
+        # Generation configuration
+        # Generation stops at the end of the context window, or earlier at
+        # max_new_tokens, whichever comes first
+        self.context_window = self.tokenizer.model_max_length
+        self.max_prompt_tokens = min(max_prompt_tokens, self.context_window - 1)
+        self.max_new_tokens = max_new_tokens
+        self.generation_kwargs = {
+            "repetition_penalty": 1.2,
+            "pad_token_id": self.tokenizer.pad_token_id,
+        }
+        # Only one generate call may use the model at a time
+        self.generate_lock = threading.Lock()
+        self.draft_model = None
+        self.draft_tokenizer = None
+        if draft_model is not None:
+            self.load_draft_model(
+                draft_model, draft_tokens, threads=threads, cpu_quantization=cpu_quantization
+            )
+        self.assisted_generations = 0
+        self.draft_tokens_proposed = 0
+        self.draft_tokens_accepted = 0
+        self.assisted_steps = 0
+        self.assisted_tokens = 0
+        end_phase("draft_model")
+        if embeddings is None:
+            model_name = "all-MiniLM-L12-v2"
+            if self.checkpoint and os.path.isdir(os.path.join(self.checkpoint, "embeddings")):
+                model_name = os.path.join(self.checkpoint, "embeddings")
+            embeddings = SentenceTransformerEmbeddings(model_name=model_name)
+        self.embeddings_model = embeddings
+        end_phase("embeddings")
+        if vector_index is not None:
+            self.db = None
+            self.retriever = VectorIndexRetriever(
+                load_index(vector_index, "neutron_chroma.db"),
+                self.embeddings_model.embed_query,
+            )
+        else:
+            if vector_store is None:
+                vector_store = Chroma(
+                    embedding_function=self.embeddings_model,
+                    persist_directory="neutron_chroma.db",
+                )
+            self.db = vector_store
+            self.retriever = self.db.as_retriever(search_type="mmr")
+        end_phase("vector_store")
+        # Near-duplicate questions are answered from here without generating
+        self.answer_cache = SemanticCache(
+            self.embeddings_model.embed_query,
+            threshold=answer_cache_threshold,
+            max_entries=answer_cache_size,
+        )
 
         self.template = ChatPromptTemplate.from_template(
             """
@@ -82,25 +322,726 @@ class InteractiveModel:
             """
         )
 
+        # Follow-up questions in a session continue the conversation with the
+        # part of the template from the contexts on
+        template_text = self.template.messages[0].prompt.template
+        self.followup_template = PromptTemplate.from_template(
+            template_text[
+                template_text.rindex("\n", 0, template_text.index("Given contexts:")) :
+            ]
+        )
+        # A conversation that outgrows the context window starts a new prompt,
+        # which carries its last turns as text after the contexts, so the
+        # preamble still matches the prefix cache
+        self.restart_template = ChatPromptTemplate.from_template(
+            template_text.replace(
+                "Question: {question}",
+                "Conversation so far:\n{history}\n            Question: {question}",
+                1,
+            )
+        )
+
         self.current_mode = "retrieval"  # Default mode
-        self.search_results = ""
-        self.search = DuckDuckGoSearchRun()
-
-        self.chain = (
-            {
-                "context": self.retriever,
-                "context2": lambda x: self.search_results,
-                "question": RunnablePassthrough(),
-            }
-            | self.template
-            | self.llm
-            | StrOutputParser()
+        self.search = search_tool if search_tool is not None else DuckDuckGoSearchRun()
+        self.search_timeout = search_timeout
+        self.search_cache = search_cache if search_cache is not None else SearchCache()
+        self.retrieval_timeout = retrieval_timeout
+        # Runs the web search and the vector retrieval side by side
+        self.context_executor = ThreadPoolExecutor(
+            max_workers=CONTEXT_THREADS, thread_name_prefix="neutron-context"
         )
 
+        # KV cache of the static instruction preamble, shared by every request
+        self.prefix_ids = None
+        self.prefix_cache = None
+        self.prefill_tokens = 0
+        self.prefill_tokens_saved = 0
+        self.stats_lock = threading.Lock()
+        if prefix_cache:
+            self.prepare_prefix_cache()
+        end_phase("prefix_cache")
+
+    def load_draft_model(self, draft_model, draft_tokens: Optional[int] = None, **kwargs):
+        """Set up the draft model for assisted decoding.
+
+        A draft with a different vocabulary works too, its proposals are then
+        translated through the text of both tokenizers, which is slower.
+        """
+        if isinstance(draft_model, str):
+            draft_tokenizer = AutoTokenizer.from_pretrained(draft_model)
+            draft_model = backends.load_model(draft_model, device=self.device, **kwargs)
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                self.draft_tokenizer = draft_tokenizer
+        if draft_tokens:
+            draft_model.generation_config.num_assistant_tokens = draft_tokens
+            draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+        self.draft_model = draft_model
+        self.model_steps = ForwardCounter(self.model)
+        self.draft_steps = ForwardCounter(self.draft_model)
+
     def invoke(self, question: str):
-        self.search_results = self.search.run(question)
+        prompt, _ = self.build_prompt(question)
+        return self.generate_batch([prompt])[0]
+
+    def search_web(self, question: str) -> str:
+        """Run the web search, answering repeated questions from the cache."""
+        result = self.search_cache.get(question)
+        if result is None:
+            result = self.search.run(question)
+            self.search_cache.set(question, result)
+        return result
+
+    def stats(self) -> Dict[str, dict]:
+        prefix_tokens = 0 if self.prefix_ids is None else self.prefix_ids.shape[1]
+        with self.stats_lock:
+            prefix_cache = {
+                "enabled": self.prefix_cache is not None,
+                "prefix_tokens": prefix_tokens,
+                "prefill_tokens": self.prefill_tokens,
+                "prefill_tokens_saved": self.prefill_tokens_saved,
+            }
+            proposed = self.draft_tokens_proposed
+            assisted_decoding = {
+                "enabled": self.draft_model is not None,
+                "generations": self.assisted_generations,
+                "proposed_tokens": proposed,
+                "accepted_tokens": self.draft_tokens_accepted,
+                "acceptance_rate": self.draft_tokens_accepted / proposed if proposed else 0.0,
+                "steps": self.assisted_steps,
+                "generated_tokens": self.assisted_tokens,
+                "tokens_per_step": (
+                    self.assisted_tokens / self.assisted_steps if self.assisted_steps else 0.0
+                ),
+            }
+        return {
+            "search_cache": self.search_cache.stats(),
+            "answer_cache": self.answer_cache.stats(),
+            "prefix_cache": prefix_cache,
+            "assisted_decoding": assisted_decoding,
+            "gpu_memory": gpu_memory(),
+        }
+
+    def prepare_prefix_cache(self):
+        """Run the instruction preamble through the model once and keep its KV cache.
+
+        The preamble is the part of the template before the first variable,
+        cut at the last line break so that the tokens of the remainder do not
+        merge with it.
+        """
+        marker = "\x00context\x00"
+        rendered = self.template.format_prompt(
+            context=marker, context2="", question=""
+        ).to_string()
+        prefix = rendered[: rendered.index(marker)]
+        prefix = prefix[: prefix.rindex("\n")] if "\n" in prefix else prefix
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(
+            self.model.device
+        )
+        with self.generate_lock, torch.no_grad():
+            output = self.model(input_ids=prefix_ids, use_cache=True)
+        self.prefix_ids = prefix_ids
+        self.prefix_cache = output.past_key_values
+
+    def _copy_prefix_cache(self):
+        """Copy the prefix cache without copying its tensors.
+
+        Generation appends to a cache by concatenating into new tensors, so
+        the copy can share the prefix tensors and only allocates memory for
+        the tokens it adds (copy-on-write).
+        """
+        memo = {id(tensor): tensor for tensor in cache_tensors(self.prefix_cache)}
+        return copy.deepcopy(self.prefix_cache, memo)
+
+    def encode_prompt(self, prompt: str, use_prefix_cache: bool = True):
+        """Tokenize a prompt and return its input ids with the cache to start from.
+
+        When the prompt begins with the cached preamble, a copy of the prefix
+        cache is returned so generation only prefills the remaining tokens.
+        """
+        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(
+            self.model.device
+        )
+        cache = None
+        saved = 0
+        if use_prefix_cache and self.prefix_cache is not None:
+            prefix_length = self.prefix_ids.shape[1]
+            if input_ids.shape[1] > prefix_length and torch.equal(
+                input_ids[:, :prefix_length], self.prefix_ids
+            ):
+                cache = self._copy_prefix_cache()
+                saved = prefix_length
+        with self.stats_lock:
+            self.prefill_tokens += input_ids.shape[1] - saved
+            self.prefill_tokens_saved += saved
+        return input_ids, cache
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        ids = self.tokenizer(text, add_special_tokens=False).input_ids
+        if len(ids) <= max_tokens:
+            return text
+        return self.tokenizer.decode(ids[:max_tokens], skip_special_tokens=True)
+
+    def assemble_context(
+        self,
+        question: str,
+        documents: list,
+        search_text: str,
+        template=None,
+        max_tokens: Optional[int] = None,
+    ) -> Tuple[str, str]:
+        """Fit the retrieved documents and the search results into the prompt budget.
+
+        The budget is `max_tokens`, by default `max_prompt_tokens`, minus the
+        template and the question.
+        Search results may use up to a third of it. Documents come in retriever
+        order, most relevant first, and are kept whole while they fit; the
+        first one that does not is cut to the remaining space. Space left over
+        by the documents goes back to the search results.
+        """
+        template = template or self.template
+        overhead = self.count_tokens(
+            template.format_prompt(context="", context2="", question=question).to_string()
+        )
+        if max_tokens is None:
+            max_tokens = self.max_prompt_tokens
+        budget = max(0, max_tokens - overhead)
+        search_tokens = self.count_tokens(search_text) if search_text else 0
+        document_budget = budget - min(search_tokens, budget // 3)
+
+        kept = []
+        used = 0
+        for document in documents:
+            text = getattr(document, "page_content", str(document))
+            tokens = self.count_tokens(text)
+            if used + tokens <= document_budget:
+                kept.append(text)
+                used += tokens
+                continue
+            remaining = document_budget - used
+            if remaining >= MIN_CONTEXT_TOKENS:
+                kept.append(self._truncate(text, remaining))
+                used += remaining
+            break
+        context = "\n\n".join(kept)
+        context2 = self._truncate(search_text, budget - used) if search_text else ""
+        return context, context2
+
+    def generation_limit(self, prompt_tokens: int) -> int:
+        """How many new tokens fit after a prompt of `prompt_tokens` tokens."""
+        if prompt_tokens >= self.context_window:
+            logging.warning(
+                f"The prompt ({prompt_tokens} tokens) fills the context window."
+            )
+        return max(1, min(self.max_new_tokens, self.context_window - prompt_tokens))
+
+    def _generation_kwargs(self, prompt_length: int, assisted: bool = False) -> dict:
+        kwargs = {
+            **self.generation_kwargs,
+            "max_new_tokens": self.generation_limit(prompt_length),
+        }
+        if assisted:
+            kwargs["assistant_model"] = self.draft_model
+            if self.draft_tokenizer is not None:
+                kwargs["tokenizer"] = self.tokenizer
+                kwargs["assistant_tokenizer"] = self.draft_tokenizer
+        return kwargs
+
+    def _start_assisted(self):
+        # Called with the generate lock held, so the counts belong to one call
+        self.model_steps.calls = 0
+        self.draft_steps.calls = 0
+
+    def _record_assisted(self, output, prompt_length: int):
+        """Work out how many draft tokens the main model accepted.
+
+        Every forward pass of the main model accepts some of the draft's
+        tokens and adds one of its own, and every forward pass of the draft
+        proposes one token.
+        """
+        tokens = int((output[0, prompt_length:] != self.tokenizer.pad_token_id).sum())
+        steps = self.model_steps.calls
+        proposed = self.draft_steps.calls
+        accepted = min(proposed, max(0, tokens - steps))
+        with self.stats_lock:
+            self.assisted_generations += 1
+            self.draft_tokens_proposed += proposed
+            self.draft_tokens_accepted += accepted
+            self.assisted_steps += steps
+            self.assisted_tokens += tokens
+        metrics.record_assisted(proposed, accepted, tokens, steps)
+
+    def _stopping_criteria(self, prompt_length: int, *criteria) -> StoppingCriteriaList:
+        return StoppingCriteriaList(
+            [AnswerBoundaryCriteria(self.tokenizer, prompt_length), *criteria]
+        )
+
+    def _timed(self, timings: Dict[str, float], stage: str, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timings[stage] = time.perf_counter() - start
+
+    def _result_within(self, future, deadline: float, default, stage: str):
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            logging.warning(f"The {stage} step timed out, continuing without it.")
+        except Exception as e:
+            logging.error(f"The {stage} step failed, continuing without it: {e}")
+        return default
+
+    def gather_context(self, question: str) -> Tuple[list, str, Dict[str, float]]:
+        """Run the web search and the vector retrieval concurrently.
+
+        Each source has its own timeout; a source that is slow or failing is
+        replaced by an empty context so generation can still go ahead. The
+        returned timings hold the duration of each source plus the wall time
+        of the whole step, which is close to the slower of the two when they
+        overlap.
+        """
+        timings = {}
+        start = time.monotonic()
+        search_future = self.context_executor.submit(
+            self._timed, timings, "search", self.search_web, question
+        )
+        retrieval_future = self.context_executor.submit(
+            self._timed, timings, "retrieval", self.retriever.invoke, question
+        )
+        context = self._result_within(
+            retrieval_future, start + self.retrieval_timeout, [], "retrieval"
+        )
+        context2 = self._result_within(
+            search_future, start + self.search_timeout, "", "search"
+        )
+        timings["context"] = time.monotonic() - start
+        return context, context2, dict(timings)
+
+    def render_prompt(
+        self,
+        question: str,
+        documents: list,
+        search_text: str,
+        template=None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        template = template or self.template
+        context, context2 = self.assemble_context(
+            question, documents, search_text, template, max_tokens
+        )
+        return template.format_prompt(
+            context=context,
+            context2=context2,
+            question=question,
+        ).to_string()
+
+    def build_prompt(self, question: str) -> Tuple[str, Dict[str, float]]:
+        """Gather the context for a question and render the prompt.
+
+        The context is carried in the returned prompt, so concurrent requests
+        never share state.
+        """
+        start = time.perf_counter()
+        documents, search_text, timings = self.gather_context(question)
+        prompt = self.render_prompt(question, documents, search_text)
+        timings["prompt_build"] = time.perf_counter() - start
+        metrics.observe_stages(timings)
+        return prompt, timings
+
+    def embed_questions(self, questions: List[str]) -> List[List[float]]:
+        """Embed many questions in one batched forward pass."""
+        return self.embeddings_model.embed_documents(questions)
+
+    def retrieve_many(self, embeddings: List[List[float]]) -> List[list]:
+        """Retrieve the documents of many questions with one vector store query.
+
+        Each question gets the same documents as from `self.retriever`: the
+        nearest `fetch_k` candidates are narrowed down to `k` by maximal
+        marginal relevance, and kept in order of similarity.
+        """
+        if isinstance(self.retriever, VectorIndexRetriever):
+            return self.retriever.retrieve_many(embeddings)
+        search_kwargs = {"k": 4, "fetch_k": 20, "lambda_mult": 0.5}
+        search_kwargs.update(self.retriever.search_kwargs)
+        results = self.db._collection.query(
+            query_embeddings=embeddings,
+            n_results=search_kwargs["fetch_k"],
+            include=["metadatas", "documents", "embeddings"],
+        )
+        documents = []
+        for row, embedding in enumerate(embeddings):
+            selected = maximal_marginal_relevance(
+                np.array(embedding, dtype=np.float32),
+                results["embeddings"][row],
+                k=search_kwargs["k"],
+                lambda_mult=search_kwargs["lambda_mult"],
+            )
+            documents.append(
+                [
+                    Document(
+                        page_content=results["documents"][row][i],
+                        metadata=results["metadatas"][row][i] or {},
+                    )
+                    for i in sorted(selected)
+                ]
+            )
+        return documents
+
+    def build_prompts(
+        self, questions: List[str], embeddings: List[List[float]]
+    ) -> List[Tuple[str, Dict[str, float]]]:
+        """Gather the context of many questions at once and render their prompts.
+
+        The vector store is queried once for all questions, and questions that
+        only differ in case or spacing share one web search. Searches beyond
+        the context threads wait for a free thread, so the search timeout is
+        allowed once per round of threads.
+        """
+        start = time.monotonic()
+        retrieval_timings = {}
+        retrieval_future = self.context_executor.submit(
+            self._timed, retrieval_timings, "retrieval", self.retrieve_many, embeddings
+        )
+        searches = {}
+        for question in questions:
+            key = normalize_question(question)
+            if key not in searches:
+                timings = {}
+                future = self.context_executor.submit(
+                    self._timed, timings, "search", self.search_web, question
+                )
+                searches[key] = (timings, future)
+        all_documents = self._result_within(
+            retrieval_future, start + self.retrieval_timeout, None, "retrieval"
+        ) or [[] for _ in questions]
+        rounds = math.ceil((len(searches) + 1) / CONTEXT_THREADS)
+        search_deadline = start + self.search_timeout * rounds
+        search_texts = {
+            key: self._result_within(future, search_deadline, "", "search")
+            for key, (_, future) in searches.items()
+        }
+        context_seconds = time.monotonic() - start
+
+        prompts = []
+        for question, documents in zip(questions, all_documents):
+            render_start = time.perf_counter()
+            key = normalize_question(question)
+            prompt = self.render_prompt(question, documents, search_texts[key])
+            timings = {
+                **retrieval_timings,
+                **searches[key][0],
+                "context": context_seconds,
+            }
+            timings["prompt_build"] = context_seconds + time.perf_counter() - render_start
+            metrics.observe_stages(timings)
+            prompts.append((prompt, timings))
+        return prompts
+
+    def tokenize_batch(self, prompts: List[str]):
+        """Tokenize prompts and left pad them to the same length.
+
+        The padding is applied separately because asking a fast tokenizer to
+        pad switches its shared padding setting, which races with the request
+        threads that count tokens with the same tokenizer.
+        """
+        return self.tokenizer.pad(self.tokenizer(prompts), return_tensors="pt").to(
+            self.model.device
+        )
+
+    def _record_generation(self, start: float, timer, output, prompt_length: int):
+        new_tokens = output[:, prompt_length:]
+        metrics.record_generation(
+            start,
+            timer.first_token_at,
+            int((new_tokens != self.tokenizer.pad_token_id).sum()),
+            batch_size=output.shape[0],
+        )
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        cancel_events: Optional[List[Optional[threading.Event]]] = None,
+        deadlines: Optional[List[Optional[float]]] = None,
+    ) -> List[Optional[str]]:
+        """Generate answers for several prompts in a single `generate` call.
+
+        A single prompt starts from the prefix cache, or is generated with
+        assisted decoding when there is a draft model; the two do not combine.
+        Batches are left padded, which moves the preamble to a different
+        position in every row, so they are prefilled in full.
+
+        A row stops early when its cancel event is set or its deadline (a
+        `time.monotonic()` value) passes, and its answer is returned as None.
+        """
+        cancel = CancelCriteria(cancel_events or [None] * len(prompts), deadlines)
+        # Assisted decoding only supports one row
+        assisted = self.draft_model is not None and len(prompts) == 1
+        if len(prompts) == 1:
+            input_ids, cache = self.encode_prompt(prompts[0], not assisted)
+            inputs = {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "past_key_values": cache,
+            }
+        else:
+            inputs = self.tokenize_batch(prompts)
+            with self.stats_lock:
+                self.prefill_tokens += int(inputs["attention_mask"].sum())
+        prompt_length = inputs["input_ids"].shape[1]
+        timer = FirstTokenTimer()
+        with self.generate_lock, torch.no_grad():
+            if assisted:
+                self._start_assisted()
+            start = time.perf_counter()
+            output = self.model.generate(
+                **inputs,
+                **self._generation_kwargs(prompt_length, assisted),
+                stopping_criteria=self._stopping_criteria(
+                    prompt_length, cancel, timer
+                ),
+            )
+            self._record_generation(start, timer, output, prompt_length)
+            if assisted:
+                self._record_assisted(output, prompt_length)
+        answers = self.tokenizer.batch_decode(
+            output[:, prompt_length:], skip_special_tokens=True
+        )
+        return [
+            None if row in cancel.aborted else trim_answer(answer)
+            for row, answer in enumerate(answers)
+        ]
+
+    def session_prompt(
+        self,
+        question: str,
+        history_ids: Optional[torch.Tensor],
+        cache=None,
+        turns: Optional[List[Tuple[str, str]]] = None,
+    ):
+        """Build the input of a session turn and the cache it starts from.
+
+        A follow-up appends the contexts and the question to the conversation
+        so far, so only those tokens need prefilling when `cache` covers the
+        conversation. The first question starts a new prompt from the prefix
+        cache. So does a follow-up that would leave less than `max_new_tokens`
+        of the context window for its answer; that prompt restarts the
+        conversation with its last `turns` as text. Returns the input ids, the
+        cache, the context timings and whether the conversation restarted.
+        """
+        start = time.perf_counter()
+        documents, search_text, timings = self.gather_context(question)
+        input_ids = None
+        restarted = False
+        if history_ids is not None:
+            # The answer has to fit in the context window after the prompt
+            room = self.context_window - self.max_new_tokens - history_ids.shape[1]
+            if room > MIN_CONTEXT_TOKENS:
+                text = self.render_prompt(
+                    question, documents, search_text, self.followup_template, room
+                )
+                turn_ids = self.tokenizer(
+                    text, add_special_tokens=False, return_tensors="pt"
+                ).input_ids.to(history_ids.device)
+                if turn_ids.shape[1] <= room:
+                    input_ids = torch.cat([history_ids, turn_ids], dim=1)
+            if input_ids is None:
+                logging.info("The conversation is too long, starting a new prompt.")
+                cache = None
+                restarted = True
+        if input_ids is None:
+            template = max_tokens = None
+            if restarted:
+                # Leaves room for the answer, which the conversation has run out of
+                max_tokens = min(
+                    self.max_prompt_tokens, self.context_window - self.max_new_tokens
+                )
+                if turns:
+                    template = self.history_template(turns, max_tokens // 3)
+            prompt = self.render_prompt(question, documents, search_text, template, max_tokens)
+            input_ids, cache = self.encode_prompt(prompt)
+        else:
+            if cache is not None:
+                cache.crop(min(cache.get_seq_length(), history_ids.shape[1]))
+            cached = 0 if cache is None else cache.get_seq_length()
+            with self.stats_lock:
+                self.prefill_tokens += input_ids.shape[1] - cached
+                self.prefill_tokens_saved += cached
+        timings["prompt_build"] = time.perf_counter() - start
+        metrics.observe_stages(timings)
+        return input_ids, cache, timings, restarted
+
+    def history_template(self, turns: List[Tuple[str, str]], budget: int):
+        """The prompt template with the last `turns` that fit in `budget` tokens."""
+        kept = []
+        used = 0
+        for question, answer in reversed(turns):
+            text = f"Question: {question}\nAnswer: {answer}"
+            tokens = self.count_tokens(text)
+            if used + tokens > budget:
+                break
+            kept.insert(0, text)
+            used += tokens
+        if not kept:
+            return self.template
+        return self.restart_template.partial(history="\n".join(kept))
+
+    def _answer_length(self, new_ids: torch.Tensor, answer: str) -> int:
+        """The fewest generated tokens whose text covers the trimmed answer."""
+        low, high = 0, new_ids.shape[0]
+        while low < high:
+            middle = (low + high) // 2
+            text = self.tokenizer.decode(new_ids[:middle], skip_special_tokens=True)
+            if len(text) >= len(answer):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def generate_turn(
+        self,
+        input_ids: torch.Tensor,
+        cache=None,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ):
+        """Answer a session turn, continuing from `cache`.
+
+        Returns the answer, the ids of the conversation including it and the
+        cache covering them, or None for all three if the turn was cancelled
+        or ran past its deadline. Generation extends `cache` in place.
+        """
+        prompt_length = input_ids.shape[1]
+        cancel = CancelCriteria([cancel_event], [deadline])
+        timer = FirstTokenTimer()
+        with self.generate_lock, torch.no_grad():
+            start = time.perf_counter()
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                return_dict_in_generate=True,
+                **self._generation_kwargs(prompt_length),
+                stopping_criteria=self._stopping_criteria(prompt_length, cancel, timer),
+            )
+            self._record_generation(start, timer, output.sequences, prompt_length)
+        if cancel.aborted:
+            return None, None, None
+        new_ids = output.sequences[0, prompt_length:]
+        answer = trim_answer(
+            self.tokenizer.decode(new_ids, skip_special_tokens=True)
+        )
+        # Whatever the model wrote past the answer is not part of the conversation
+        conversation = output.sequences[:, : prompt_length + self._answer_length(new_ids, answer)]
+        cache = output.past_key_values
+        if cache.get_seq_length() > conversation.shape[1]:
+            cache.crop(conversation.shape[1])
+        return answer, conversation, cache
+
+    def warmup(self, batch_size: int = 1, max_new_tokens: int = 16):
+        """Run a short generation so kernels and memory pools are ready before real traffic.
+
+        A full batch is generated so the allocator has already seen batch-sized
+        tensors, and the embeddings model and retriever are exercised once.
+        """
+        self.retriever.invoke("nmap service scan")
+        inputs = self.tokenize_batch(
+            ["How do I run an nmap service scan?"] * max(1, batch_size)
+        )
+        with self.generate_lock, torch.no_grad():
+            self.model.generate(
+                **inputs,
+                **{**self.generation_kwargs, "max_new_tokens": max_new_tokens},
+            )
+        if self.device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    def stream(
+        self,
+        question: str,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ):
+        """Yield the answer text as the model generates it.
+
+        Generation runs on a background thread and stops early once
+        `cancel_event` is set, the `deadline` passes, or the caller stops
+        consuming the stream.
+        """
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        prompt, timings = self.build_prompt(question)
+        logging.info(f"Context timings: {timings}")
+        assisted = self.draft_model is not None
+        input_ids, cache = self.encode_prompt(prompt, not assisted)
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "past_key_values": cache,
+        }
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        # Set by the generation thread, raised here once the streamer is drained
+        errors = []
+
+        def generate():
+            timer = FirstTokenTimer()
+            try:
+                with self.generate_lock, torch.no_grad():
+                    if assisted:
+                        self._start_assisted()
+                    start = time.perf_counter()
+                    output = self.model.generate(
+                        **inputs,
+                        **self._generation_kwargs(input_ids.shape[1], assisted),
+                        streamer=streamer,
+                        stopping_criteria=self._stopping_criteria(
+                            input_ids.shape[1],
+                            CancelCriteria([cancel_event], [deadline]),
+                            timer,
+                        ),
+                    )
+                    self._record_generation(start, timer, output, input_ids.shape[1])
+                    if assisted:
+                        self._record_assisted(output, input_ids.shape[1])
+            except Exception as e:
+                logging.error(f"Error during streamed generation: {e}")
+                errors.append(e)
+                streamer.end()
 
-        return self.chain.invoke(question)
+        threading.Thread(target=generate, daemon=True).start()
+        # A line that could still turn into a new prompt section is held back
+        # until it is clear either way
+        pending = ""
+        completed = False
+        try:
+            for text in streamer:
+                pending += text
+                match = ANSWER_BOUNDARY.search(pending)
+                if match:
+                    pending = pending[: match.start()]
+                    break
+                line_start = pending.rfind("\n")
+                if line_start != -1 and may_start_boundary(pending[line_start:]):
+                    ready, pending = pending[:line_start], pending[line_start:]
+                else:
+                    ready, pending = pending, ""
+                if ready:
+                    yield ready
+            if errors:
+                raise errors[0]
+            if pending:
+                yield pending
+            completed = True
+        finally:
+            # Stops the generation thread if the caller stopped reading early.
+            # After a complete answer the event stays clear, so callers can
+            # tell whether the answer was cut short.
+            if not completed:
+                cancel_event.set()
 
     def search_duck(self, question: str):
         # Perform the search
@@ -0,0 +1,353 @@
+"""Questions answered in the background, kept in a local SQLite database.
+
+`POST /jobs` stores a question and returns its ID at once. A `JobRunner`
+answers the queued jobs, at most `concurrency` at a time, highest priority
+first and oldest first within a priority. The result is kept with the job
+until `retention` seconds after it finished, and can be sent to a webhook.
+
+Queued jobs survive a restart of the server. Jobs that were running when it
+stopped are queued again, unless they have already been tried
+`max_attempts` times.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+PRIORITIES = {"low": 0, "normal": 1, "high": 2}
+FINISHED = ("done", "failed", "cancelled")
+
+
+class JobNotFound(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    question TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    use_cache INTEGER NOT NULL,
+    webhook TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT,
+    webhook_status TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created_at);
+"""
+
+
+class JobStore:
+    """The jobs and their results, see the module docstring."""
+
+    def __init__(
+        self,
+        path: str = "neutron_jobs.db",
+        max_queued: int = 10000,
+        retention: float = 7 * 24 * 60 * 60,
+        max_attempts: int = 3,
+    ):
+        self.path = path
+        self.max_queued = max_queued
+        self.retention = retention
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Signalled when a job is queued, so idle runners start right away
+        self.queued = threading.Condition(self.lock)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(SCHEMA)
+            # Jobs cut short by a restart run again, unless they keep failing
+            self.connection.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, "
+                "error = 'The server stopped while answering, too many times' "
+                "WHERE status = 'running' AND attempts >= ?",
+                (time.time(), max_attempts),
+            )
+            requeued = self.connection.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running'"
+            ).rowcount
+        if requeued:
+            logging.info(f"Queued {requeued} interrupted jobs again.")
+
+    def submit(
+        self,
+        question: str,
+        priority: str = "normal",
+        webhook: Optional[str] = None,
+        use_cache: bool = True,
+    ) -> dict:
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            queued = self.connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued'"
+            ).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull(f"{queued} jobs are already queued")
+            self.connection.execute(
+                "INSERT INTO jobs (id, question, priority, use_cache, webhook, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                (job_id, question, PRIORITIES[priority], int(use_cache), webhook, time.time()),
+            )
+            self.queued.notify()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> dict:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            raise JobNotFound(f"Job {job_id} does not exist or has expired")
+        return _describe(row)
+
+    def next_job(self, timeout: float = 1.0) -> Optional[dict]:
+        """Claim the next queued job, waiting up to `timeout` seconds for one."""
+        with self.lock:
+            row = self._claim()
+            if row is None:
+                self.queued.wait(timeout)
+                row = self._claim()
+        return None if row is None else _describe(row)
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        row = self.connection.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' "
+            "ORDER BY priority DESC, created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 "
+            "WHERE id = ?",
+            (time.time(), row["id"]),
+        )
+        return self.connection.execute(
+            "SELECT * FROM jobs WHERE id = ?", (row["id"],)
+        ).fetchone()
+
+    def requeue(self, job_id: str):
+        """Put a job back at the front of its priority, e.g. when no worker was ready."""
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1 "
+                "WHERE id = ? AND status = 'running'",
+                (job_id,),
+            )
+            self.queued.notify()
+
+    def finish(
+        self,
+        job_id: str,
+        status: str,
+        result: Optional[dict] = None,
+        error: Optional[str] = None,
+    ):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? "
+                "WHERE id = ? AND status IN ('queued', 'running')",
+                (
+                    status,
+                    time.time(),
+                    None if result is None else json.dumps(result),
+                    error,
+                    job_id,
+                ),
+            )
+
+    def set_webhook_status(self, job_id: str, webhook_status: str):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET webhook_status = ? WHERE id = ?", (webhook_status, job_id)
+            )
+
+    def cancel(self, job_id: str):
+        """Cancel a job unless it has finished."""
+        if self.get(job_id)["status"] not in FINISHED:
+            self.finish(job_id, "cancelled", error="The job was cancelled")
+
+    def expire(self) -> int:
+        """Delete the jobs that finished more than `retention` seconds ago."""
+        with self.lock:
+            return self.connection.execute(
+                "DELETE FROM jobs WHERE finished_at < ?", (time.time() - self.retention,)
+            ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        counts = {status: 0 for status in ("queued", "running", *FINISHED)}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def _describe(row: sqlite3.Row) -> dict:
+    priorities = {value: name for name, value in PRIORITIES.items()}
+    job = {
+        "job_id": row["id"],
+        "status": row["status"],
+        "question": row["question"],
+        "priority": priorities.get(row["priority"], row["priority"]),
+        "use_cache": bool(row["use_cache"]),
+        "attempts": row["attempts"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+    }
+    if row["result"] is not None:
+        job["result"] = json.loads(row["result"])
+    if row["error"] is not None:
+        job["error"] = row["error"]
+    if row["webhook"]:
+        job["webhook"] = row["webhook"]
+        job["webhook_status"] = row["webhook_status"]
+    return job
+
+
+class JobRunner:
+    """Answers queued jobs with `concurrency` threads.
+
+    `get_engine` returns the engine once the model is ready, or None before.
+    Each job gets `timeout` seconds. The answers go through the same batch
+    scheduler as `/ask`, so jobs share the model with interactive questions.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        get_engine: Callable,
+        concurrency: int = 2,
+        timeout: Optional[float] = None,
+        webhook_timeout: float = 10.0,
+        webhook_retries: int = 3,
+    ):
+        self.store = store
+        self.get_engine = get_engine
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.webhook_timeout = webhook_timeout
+        self.webhook_retries = webhook_retries
+        self.cancel_events = {}  # job_id -> threading.Event of running jobs
+        self.stopping = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def start(self):
+        for index in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name=f"neutron-job-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout: float = 10.0) -> bool:
+        """Cancel the running jobs and return whether every thread exited within `timeout` seconds.
+
+        The store has to stay open until they have, since a job that is still
+        being answered records its result there.
+        """
+        self.stopping.set()
+        for cancel_event in list(self.cancel_events.values()):
+            cancel_event.set()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def cancel(self, job_id: str) -> dict:
+        self.store.cancel(job_id)
+        cancel_event = self.cancel_events.get(job_id)
+        if cancel_event is not None:
+            cancel_event.set()
+        return self.store.get(job_id)
+
+    def _run(self):
+        last_expiry = 0.0
+        while not self.stopping.is_set():
+            if time.monotonic() - last_expiry > 60:
+                self.store.expire()
+                last_expiry = time.monotonic()
+            engine = self.get_engine()
+            if engine is None:
+                time.sleep(1)
+                continue
+            job = self.store.next_job()
+            if job is not None:
+                self._answer(engine, job)
+
+    def _answer(self, engine, job: dict):
+        # Imported here to keep this module free of the model's dependencies
+        from neutron.scheduler import DeadlineExceeded, RequestCancelled
+        from neutron.worker_pool import NoWorkerAvailable
+
+        job_id = job["job_id"]
+        cancel_event = self.cancel_events.setdefault(job_id, threading.Event())
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        try:
+            # A cancel between claiming the job and registering its event finds
+            # no event to set, so the job is checked again before it starts
+            if self.store.get(job_id)["status"] != "running":
+                raise RequestCancelled("The job was cancelled")
+            result = engine.ask(job["question"], job["use_cache"], cancel_event, deadline)
+        except NoWorkerAvailable:
+            self.store.requeue(job_id)
+            time.sleep(1)
+            return
+        except RequestCancelled:
+            if self.stopping.is_set():
+                # Answered after the restart instead
+                self.store.requeue(job_id)
+                return
+            self.store.finish(job_id, "cancelled", error="The job was cancelled")
+        except DeadlineExceeded:
+            self.store.finish(job_id, "failed", error="The answer took longer than the job timeout")
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+            self.store.finish(job_id, "failed", error=str(e))
+        else:
+            self.store.finish(job_id, "done", result=result)
+        finally:
+            self.cancel_events.pop(job_id, None)
+        if job.get("webhook"):
+            # Slow webhooks do not hold up the next job
+            threading.Thread(
+                target=self._notify, args=(self.store.get(job_id),), daemon=True
+            ).start()
+
+    def _notify(self, job: dict):
+        """Post the finished job to its webhook, retrying with a growing delay."""
+        webhook_status = None
+        for attempt in range(self.webhook_retries + 1):
+            try:
+                response = requests.post(job["webhook"], json=job, timeout=self.webhook_timeout)
+                webhook_status = str(response.status_code)
+                if response.status_code < 500:
+                    break
+            except requests.RequestException as e:
+                webhook_status = f"error: {e}"
+            if attempt < self.webhook_retries:
+                time.sleep(2**attempt)
+        if webhook_status is None or not webhook_status.startswith("2"):
+            logging.warning(f"Webhook of job {job['job_id']} failed: {webhook_status}")
+        self.store.set_webhook_status(job["job_id"], webhook_status)
@@ -0,0 +1,282 @@
+"""Per-file manifests for the model and vector store directories.
+
+A manifest lists every file of a directory with its SHA-256 and size:
+
+    {"version": 1, "files": [{"path": "...", "sha256": "...", "size": 123}]}
+
+It is published next to the zip archive (`neutron_model.zip` ->
+`neutron_model.manifest.json`), and the files themselves are published under
+`objects/<sha256>`. The archive's own SHA-256 is published beside it in
+`neutron_model.zip.sha256`, in the format of `sha256sum`. An update only
+downloads the files whose hash changed. Unchanged files are hard-linked from
+the current directory, or copied from the local content-addressed store in
+`~/.neutron/objects`.
+
+To publish a directory with its archive:
+
+    python -m neutron.manifest neutron_model upload_dir
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import requests
+
+from neutron import downloader
+
+MANIFEST_VERSION = 1
+# Records the hash of every installed file with its size and mtime, so
+# unchanged files do not have to be hashed again
+INDEX_FILE = ".neutron-index.json"
+# Local files that are not part of the published content
+IGNORED_FILES = {INDEX_FILE, "metadata.json"}
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+store_directory = os.path.join(os.path.expanduser("~"), ".neutron", "objects")
+
+
+def manifest_url_for(zip_url: str) -> str:
+    if zip_url.endswith(".zip"):
+        zip_url = zip_url[: -len(".zip")]
+    return f"{zip_url}.manifest.json"
+
+
+def objects_url_for(manifest_url: str) -> str:
+    return f"{manifest_url.rsplit('/', 1)[0]}/objects"
+
+
+def checksum_url_for(zip_url: str) -> str:
+    return f"{zip_url}.sha256"
+
+
+def fetch_archive_sha256(zip_url: str, timeout: float = 30) -> Optional[str]:
+    """Return the SHA-256 published for an archive, or None if there is none."""
+    response = requests.get(checksum_url_for(zip_url), timeout=timeout)
+    if response.status_code in (403, 404):
+        return None
+    response.raise_for_status()
+    fields = response.text.split()
+    sha256 = fields[0].lower() if fields else ""
+    if not SHA256_PATTERN.fullmatch(sha256):
+        raise ValueError(f"Invalid SHA-256 published for {zip_url}")
+    return sha256
+
+
+def list_files(directory: str):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), directory)
+            if path not in IGNORED_FILES:
+                yield path.replace(os.sep, "/")
+
+
+def _load_index(directory: str) -> Dict[str, dict]:
+    try:
+        with open(os.path.join(directory, INDEX_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error(f"Ignoring unreadable index in {directory}: {e}")
+        return {}
+
+
+def _save_index(directory: str, index: Dict[str, dict]):
+    with open(os.path.join(directory, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+
+
+def _index_entry(path: str, sha256: str) -> dict:
+    stat = os.stat(path)
+    return {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def file_hashes(directory: str) -> Dict[str, str]:
+    """Return the SHA-256 of every file, hashing only files changed since the last index."""
+    index = _load_index(directory)
+    hashes = {}
+    for path in list_files(directory):
+        full_path = os.path.join(directory, path)
+        stat = os.stat(full_path)
+        entry = index.get(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            hashes[path] = entry["sha256"]
+        else:
+            hashes[path] = downloader.file_digest(full_path)
+    return hashes
+
+
+def build_manifest(directory: str) -> dict:
+    files = []
+    for path, sha256 in sorted(file_hashes(directory).items()):
+        size = os.path.getsize(os.path.join(directory, path))
+        files.append({"path": path, "sha256": sha256, "size": size})
+    return {"version": MANIFEST_VERSION, "files": files}
+
+
+def write_archive(directory: str, archive_path: str) -> str:
+    """Zip `directory` into a folder of the same name, write its checksum file and return the SHA-256."""
+    name = os.path.basename(os.path.normpath(directory))
+    with ZipFile(archive_path, "w", ZIP_DEFLATED) as archive:
+        for path in sorted(list_files(directory)):
+            archive.write(os.path.join(directory, *path.split("/")), f"{name}/{path}")
+    sha256 = downloader.file_digest(archive_path)
+    with open(f"{archive_path}.sha256", "w") as f:
+        f.write(f"{sha256}  {os.path.basename(archive_path)}\n")
+    return sha256
+
+
+def publish(directory: str, output_dir: str) -> str:
+    """Write the archive, manifest and content-addressed objects of `directory` for upload."""
+    manifest = build_manifest(directory)
+    objects_dir = os.path.join(output_dir, "objects")
+    os.makedirs(objects_dir, exist_ok=True)
+    for entry in manifest["files"]:
+        object_path = os.path.join(objects_dir, entry["sha256"])
+        if not os.path.exists(object_path):
+            shutil.copyfile(os.path.join(directory, entry["path"]), object_path)
+    name = os.path.basename(os.path.normpath(directory))
+    write_archive(directory, os.path.join(output_dir, f"{name}.zip"))
+    manifest_path = os.path.join(output_dir, f"{name}.manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest_path
+
+
+def store_path(sha256: str) -> str:
+    return os.path.join(store_directory, sha256[:2], sha256)
+
+
+def _link_or_copy(source: str, destination: str):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _copy_from_store(sha256: str, size: int, destination: str) -> bool:
+    source = store_path(sha256)
+    if not os.path.exists(source) or os.path.getsize(source) != size:
+        return False
+    # Stored files may share an inode with files that were modified in place
+    if downloader.file_digest(source) != sha256:
+        os.remove(source)
+        return False
+    shutil.copyfile(source, destination)
+    return True
+
+
+def _entry_destination(directory: str, entry: dict) -> str:
+    """Where a manifest entry goes in `directory`, refusing paths that leave it."""
+    path = entry["path"]
+    parts = path.split("/")
+    if (
+        "\\" in path
+        or os.path.splitdrive(path)[0]
+        or any(part in ("", ".", "..") for part in parts)
+    ):
+        raise ValueError(f"Unsafe path in manifest: {path!r}")
+    destination = os.path.join(directory, *parts)
+    root = os.path.realpath(directory)
+    if os.path.commonpath([root, os.path.realpath(destination)]) != root:
+        raise ValueError(f"Unsafe path in manifest: {path!r}")
+    # The hash names the object in the store and in the download URL
+    if not SHA256_PATTERN.fullmatch(str(entry["sha256"])):
+        raise ValueError(f"Invalid SHA-256 in manifest for {path!r}")
+    return destination
+
+
+def sync_directory(manifest_url: str, target_dir: str, parallel: int = 4) -> Optional[str]:
+    """Bring `target_dir` up to date with a manifest, downloading only changed files.
+
+    The new version is assembled in a staging directory and swapped into place,
+    so the current directory is untouched until everything has been fetched
+    and verified. Returns the ETag of the manifest, or None if the manifest
+    does not exist.
+    """
+    response = requests.get(manifest_url, timeout=30)
+    if response.status_code in (403, 404):
+        return None
+    response.raise_for_status()
+    manifest = response.json()
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version {manifest.get('version')}")
+    staging_dir = f"{target_dir}.staging"
+    # Checked before anything is downloaded or linked
+    destinations = [_entry_destination(staging_dir, entry) for entry in manifest["files"]]
+
+    downloader.recover_directory(target_dir)
+    current = file_hashes(target_dir) if os.path.isdir(target_dir) else {}
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    objects_url = objects_url_for(manifest_url)
+    index = {}
+    missing = []
+    reused = 0
+    try:
+        for entry, destination in zip(manifest["files"], destinations):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            if current.get(entry["path"]) == entry["sha256"]:
+                _link_or_copy(_entry_destination(target_dir, entry), destination)
+                reused += 1
+            elif _copy_from_store(entry["sha256"], entry["size"], destination):
+                reused += 1
+            else:
+                missing.append((entry, destination))
+
+        def fetch(item):
+            # Objects are downloaded into the store, where an interrupted
+            # download can resume on the next attempt, then linked into place
+            entry, destination = item
+            object_path = store_path(entry["sha256"])
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            downloader.download(
+                f"{objects_url}/{entry['sha256']}",
+                object_path,
+                expected_sha256=entry["sha256"],
+                show_progress=False,
+            )
+            _link_or_copy(object_path, destination)
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            list(executor.map(fetch, missing))
+
+        for entry, destination in zip(manifest["files"], destinations):
+            index[entry["path"]] = _index_entry(destination, entry["sha256"])
+        _save_index(staging_dir, index)
+        downloaded = sum(entry["size"] for entry, _ in missing)
+        logging.info(
+            f"Updated {target_dir}: reused {reused} files, downloaded {len(missing)} files ({downloaded} bytes)."
+        )
+        print(
+            f"{target_dir}: reused {reused} files, downloaded {len(missing)} ({downloaded / 1024 / 1024:.1f} MB)"
+        )
+        downloader.swap_directory(staging_dir, target_dir)
+    finally:
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+    return response.headers.get("ETag")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Publish a directory as a zip archive, a manifest and content-addressed objects."
+    )
+    parser.add_argument("directory", type=str, help="The directory to publish.")
+    parser.add_argument(
+        "output_dir",
+        type=str,
+        help="Where to write the archive, its checksum, the manifest and the objects/ folder for upload.",
+    )
+    args = parser.parse_args()
+    print(publish(args.directory, args.output_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Prometheus metrics for the server, served at `/metrics`.
+
+With `--workers`, stage timings are recorded in the worker processes. To
+include them, point the `PROMETHEUS_MULTIPROC_DIR` environment variable at an
+empty directory before starting the server, as for any multi-process
+Prometheus client.
+"""
+
+import os
+import time
+from typing import Callable, Optional
+
+import psutil
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# From 5ms to 5 minutes, answers with long generations take minutes
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300
+)
+STAGES = ["search", "retrieval", "context", "prompt_build", "queue", "prefill", "decode"]
+
+REQUESTS = Counter(
+    "neutron_requests", "HTTP requests by endpoint and status code.", ["endpoint", "status"]
+)
+REQUEST_SECONDS = Histogram(
+    "neutron_request_seconds",
+    "Time from receiving a request until its response is fully sent.",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "neutron_time_to_first_token_seconds",
+    "Time from starting a streamed answer until its first text is sent.",
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "neutron_stage_seconds",
+    "Time spent in each stage of answering a question.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+GENERATED_TOKENS = Counter(
+    "neutron_generated_tokens", "Tokens generated by the model."
+)
+IN_FLIGHT = Gauge(
+    "neutron_requests_in_flight",
+    "Questions admitted and not yet answered.",
+    multiprocess_mode="livesum",
+)
+REJECTED = Counter(
+    "neutron_rejected_requests", "Questions turned away because the server was full."
+)
+ABORTED = Counter(
+    "neutron_aborted_requests",
+    "Questions whose generation was stopped early, by reason.",
+    ["reason"],
+)
+DRAFT_TOKENS = Counter(
+    "neutron_draft_tokens",
+    "Tokens proposed by the draft model, by whether the main model accepted them.",
+    ["outcome"],
+)
+TOKENS_PER_STEP = Histogram(
+    "neutron_tokens_per_step",
+    "Tokens gained per forward pass of the main model in assisted generations, 1 without a draft model.",
+    buckets=(1, 1.25, 1.5, 2, 2.5, 3, 4, 5, 6, 8, 12, 16),
+)
+BATCH_SIZE = Histogram(
+    "neutron_batch_size",
+    "Prompts generated together in one batch.",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+for stage in STAGES:
+    STAGE_SECONDS.labels(stage)
+
+
+def observe_stages(timings: dict):
+    for stage, seconds in timings.items():
+        if stage in STAGES:
+            STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def record_generation(
+    start: float, first_token_at: Optional[float], tokens: int, batch_size: int = 1
+):
+    """Split one `generate` call into prefill and decode time.
+
+    Prefill runs until the first new token exists, decode is everything after.
+    """
+    end = time.perf_counter()
+    first_token_at = first_token_at or end
+    STAGE_SECONDS.labels("prefill").observe(first_token_at - start)
+    STAGE_SECONDS.labels("decode").observe(end - first_token_at)
+    GENERATED_TOKENS.inc(tokens)
+    BATCH_SIZE.observe(batch_size)
+
+
+def record_assisted(proposed: int, accepted: int, tokens: int, steps: int):
+    DRAFT_TOKENS.labels("accepted").inc(accepted)
+    DRAFT_TOKENS.labels("rejected").inc(proposed - accepted)
+    if steps:
+        TOKENS_PER_STEP.observe(tokens / steps)
+
+
+class ServerCollector:
+    """Reads queue depth, cache counters and memory use when metrics are scraped."""
+
+    def __init__(self, get_engine: Callable):
+        self.get_engine = get_engine
+        self.process = psutil.Process()
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            "neutron_rss_bytes",
+            "Resident memory of the server process.",
+            value=self.process.memory_info().rss,
+        )
+        engine = self.get_engine()
+        if engine is None:
+            return
+        stats = engine.stats()
+        yield GaugeMetricFamily(
+            "neutron_queue_depth",
+            "Prompts waiting for a batch.",
+            value=stats.get("queue_depth", 0),
+        )
+        if "workers" in stats:
+            ready = GaugeMetricFamily(
+                "neutron_worker_ready", "Whether a model worker is ready.", labels=["worker"]
+            )
+            in_flight = GaugeMetricFamily(
+                "neutron_worker_in_flight",
+                "Requests a model worker is handling.",
+                labels=["worker"],
+            )
+            restarts = CounterMetricFamily(
+                "neutron_worker_restarts", "Restarts of a model worker.", labels=["worker"]
+            )
+            for worker in stats["workers"]:
+                label = [str(worker["index"])]
+                ready.add_metric(label, int(worker["ready"]))
+                in_flight.add_metric(label, worker["in_flight"])
+                restarts.add_metric(label, worker["restarts"])
+            yield ready
+            yield in_flight
+            yield restarts
+        if stats.get("gpu_memory"):
+            # Read by the processes holding the models, summed over the workers of a device
+            allocated = GaugeMetricFamily(
+                "neutron_gpu_memory_allocated_bytes",
+                "GPU memory held by tensors.",
+                labels=["device"],
+            )
+            reserved = GaugeMetricFamily(
+                "neutron_gpu_memory_reserved_bytes",
+                "GPU memory reserved by the caching allocator.",
+                labels=["device"],
+            )
+            for device, memory in sorted(stats["gpu_memory"].items()):
+                allocated.add_metric([device], memory["allocated_bytes"])
+                reserved.add_metric([device], memory["reserved_bytes"])
+            yield allocated
+            yield reserved
+        if "answer_cache" not in stats:
+            # No worker could report its statistics
+            return
+        hits = CounterMetricFamily(
+            "neutron_cache_hits", "Cache lookups that found an entry.", labels=["cache"]
+        )
+        misses = CounterMetricFamily(
+            "neutron_cache_misses", "Cache lookups that found nothing.", labels=["cache"]
+        )
+        hit_rate = GaugeMetricFamily(
+            "neutron_cache_hit_rate", "Share of cache lookups that hit.", labels=["cache"]
+        )
+        entries = GaugeMetricFamily(
+            "neutron_cache_entries", "Entries held by the cache.", labels=["cache"]
+        )
+        for cache in ("search_cache", "answer_cache"):
+            hits.add_metric([cache], stats[cache]["hits"])
+            misses.add_metric([cache], stats[cache]["misses"])
+            hit_rate.add_metric([cache], stats[cache]["hit_rate"])
+            entries.add_metric([cache], stats[cache]["entries"])
+        yield hits
+        yield misses
+        yield hit_rate
+        yield entries
+        prefill = CounterMetricFamily(
+            "neutron_prefill_tokens",
+            "Prompt tokens run through the model, by whether the prefix cache skipped them.",
+            labels=["source"],
+        )
+        prefill.add_metric(["computed"], stats["prefix_cache"]["prefill_tokens"])
+        prefill.add_metric(["cached"], stats["prefix_cache"]["prefill_tokens_saved"])
+        yield prefill
+
+
+collectors = []
+
+
+def register_collector(get_engine: Callable):
+    collector = ServerCollector(get_engine)
+    collectors.append(collector)
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        REGISTRY.register(collector)
+
+
+def render() -> bytes:
+    """The metrics of this process, and of the workers in multi-process mode."""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in collectors:
+        registry.register(collector)
+    return generate_latest(registry)
@@ -0,0 +1,121 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+from neutron import metrics
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def abort_reason(
+    cancel_event: Optional[threading.Event], deadline: Optional[float]
+) -> Optional[Exception]:
+    """The exception for a request that was cancelled or ran out of time, if it did."""
+    if cancel_event is not None and cancel_event.is_set():
+        return RequestCancelled("The request was cancelled")
+    if deadline is not None and time.monotonic() >= deadline:
+        return DeadlineExceeded("The request deadline passed")
+    return None
+
+
+class BatchScheduler:
+    """Queues prompts and runs them through the model in micro-batches.
+
+    A single worker thread owns the model. It waits for the first queued
+    prompt, then keeps collecting prompts until either `max_batch_size` is
+    reached or `max_wait_ms` has passed, and hands the whole batch to
+    `generate_batch` in one call.
+
+    Prompts whose request was cancelled or whose deadline passed while they
+    waited are dropped before generation, and rows that are stopped during
+    generation fail their future instead of returning a partial answer.
+    """
+
+    def __init__(
+        self,
+        generate_batch: Callable[..., List[Optional[str]]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10,
+    ):
+        self.generate_batch = generate_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(
+        self,
+        prompt: str,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> Future:
+        """Queue a prompt, the returned future resolves to its answer.
+
+        `deadline` is a `time.monotonic()` value. The future fails with
+        `RequestCancelled` once `cancel_event` is set, or with
+        `DeadlineExceeded` once the deadline passes.
+        """
+        future = Future()
+        self.queue.put((prompt, future, time.perf_counter(), cancel_event, deadline))
+        return future
+
+    def qsize(self) -> int:
+        return self.queue.qsize()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = []
+            for prompt, future, queued_at, cancel_event, deadline in self._next_batch():
+                if not future.set_running_or_notify_cancel():
+                    continue
+                reason = abort_reason(cancel_event, deadline)
+                if reason is not None:
+                    future.set_exception(reason)
+                    continue
+                batch.append((prompt, future, queued_at, cancel_event, deadline))
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for item in batch:
+                metrics.STAGE_SECONDS.labels("queue").observe(started - item[2])
+            try:
+                answers = self.generate_batch(
+                    [item[0] for item in batch],
+                    [item[3] for item in batch],
+                    [item[4] for item in batch],
+                )
+                for (_, future, _, cancel_event, deadline), answer in zip(batch, answers):
+                    if answer is None:
+                        future.set_exception(
+                            abort_reason(cancel_event, deadline)
+                            or RequestCancelled("Generation was stopped")
+                        )
+                    else:
+                        future.set_result(answer)
+            except Exception as e:
+                logging.error(f"Error generating batch of {len(batch)}: {e}")
+                for item in batch:
+                    item[1].set_exception(e)
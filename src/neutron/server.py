@@ -1,14 +1,32 @@
 import argparse
+import asyncio
+import json
+import logging
 import os
-from typing import Any, Dict
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
 
+import anyio
 import psutil
-import torch
-from fastapi import FastAPI, HTTPException, Request, status
+from fastapi import FastAPI, HTTPException, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST
 from pydantic import BaseModel
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 
+from neutron import backends, metrics, vector_index
+from neutron.admission import AdmissionController
+from neutron.cache import SearchCache
+from neutron.engine import LocalEngine
 from neutron.interactive_model import InteractiveModel
+from neutron.jobs import PRIORITIES, JobNotFound, JobRunner, JobStore, QueueFull
+from neutron.scheduler import BatchScheduler, DeadlineExceeded, RequestCancelled
+from neutron.sessions import SessionNotFound, SessionStore
+from neutron.worker_pool import NoWorkerAvailable, WorkerPool, worker_specs
 
 # Set up argument parsing
 parser = argparse.ArgumentParser(description="Run the FastAPI server.")
@@ -21,10 +39,425 @@ parser.add_argument(
 parser.add_argument(
     "--port", type=int, default=8000, help="The port of the webserver. Default is 8000."
 )  # FastAPI's default port is 8000
-args = parser.parse_args()
+parser.add_argument(
+    "--max-batch-size",
+    type=int,
+    default=8,
+    help="The maximum number of questions generated together in one batch. Default is 8.",
+)
+parser.add_argument(
+    "--max-batch-wait-ms",
+    type=float,
+    default=10,
+    help="How long to wait for more questions before running a batch. Default is 10ms.",
+)
+parser.add_argument(
+    "--search-timeout",
+    type=float,
+    default=5.0,
+    help="Seconds to wait for web search results before answering without them. Default is 5.",
+)
+parser.add_argument(
+    "--retrieval-timeout",
+    type=float,
+    default=10.0,
+    help="Seconds to wait for the knowledge base before answering without it. Default is 10.",
+)
+parser.add_argument(
+    "--search-cache-ttl",
+    type=float,
+    default=3600,
+    help="Seconds a cached web search result stays valid. Default is 3600.",
+)
+parser.add_argument(
+    "--search-cache-size",
+    type=int,
+    default=1024,
+    help="The maximum number of cached web search results. Default is 1024.",
+)
+parser.add_argument(
+    "--search-cache-mb",
+    type=float,
+    default=16,
+    help="The maximum size of the cached web search results in MB. Default is 16.",
+)
+parser.add_argument(
+    "--search-cache-path",
+    type=str,
+    default=None,
+    help="A JSON file to persist the web search cache across restarts. Disabled by default.",
+)
+parser.add_argument(
+    "--answer-cache-threshold",
+    type=float,
+    default=0.95,
+    help="The cosine similarity above which a past answer is reused for a new question. Default is 0.95.",
+)
+parser.add_argument(
+    "--answer-cache-size",
+    type=int,
+    default=512,
+    help="The maximum number of cached answers, 0 disables the answer cache. Default is 512.",
+)
+parser.add_argument(
+    "--device",
+    type=str,
+    choices=backends.DEVICES,
+    default="auto",
+    help="Run the model on the GPU (cuda) or the CPU. Default is auto, which uses the GPU when available.",
+)
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=None,
+    help="The number of threads used for CPU generation. Defaults to the number of cores.",
+)
+parser.add_argument(
+    "--cpu-quantization",
+    type=str,
+    choices=backends.CPU_QUANTIZATIONS,
+    default="int8",
+    help="How the model is quantized when running on the CPU. Default is int8.",
+)
+parser.add_argument(
+    "--offline",
+    action="store_true",
+    default=os.environ.get("NEUTRON_OFFLINE", "") not in ("", "0"),
+    help="Skip all update checks and use the local model files. Also enabled by setting NEUTRON_OFFLINE=1.",
+)
+parser.add_argument(
+    "--update-check-interval",
+    type=float,
+    default=24,
+    help="Hours to reuse the result of the last update check before checking again. Default is 24.",
+)
+parser.add_argument(
+    "--no-warmup",
+    action="store_true",
+    help="Report ready as soon as the model is loaded, without a warmup generation.",
+)
+parser.add_argument(
+    "--max-prompt-tokens",
+    type=int,
+    default=3072,
+    help="Token budget for the prompt. Retrieved documents and search results are trimmed to fit. Default is 3072.",
+)
+parser.add_argument(
+    "--max-new-tokens",
+    type=int,
+    default=2048,
+    help="The most tokens generated for an answer, further limited by the room left in the context window. Default is 2048.",
+)
+parser.add_argument(
+    "--slow-request-seconds",
+    type=float,
+    default=30,
+    help="Requests slower than this are logged as warnings with their request ID. Default is 30.",
+)
+parser.add_argument(
+    "--log-level",
+    type=str,
+    choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    default="ERROR",
+    help="Level of the messages written to ~/neutron.log. WARNING logs slow requests, INFO every request. Default is ERROR.",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Model worker processes. With more than one, each GPU gets workers in turn, or the CPU cores are split between them. Default is 1, which runs the model in the server process.",
+)
+parser.add_argument(
+    "--worker-restart-delay",
+    type=float,
+    default=5,
+    help="Seconds before restarting a worker that exited, doubled after each further crash. Default is 5.",
+)
+parser.add_argument(
+    "--max-queue-depth",
+    type=int,
+    default=64,
+    help="Questions the server works on at once. Beyond this, requests get 429 Too Many Requests. Default is 64.",
+)
+parser.add_argument(
+    "--request-timeout",
+    type=float,
+    default=600,
+    help="Seconds a question may take before generation is stopped. Clients can ask for less with the X-Neutron-Timeout header. Default is 600.",
+)
+parser.add_argument(
+    "--max-batch-questions",
+    type=int,
+    default=256,
+    help="The most questions accepted by one /ask/batch request. Default is 256.",
+)
+parser.add_argument(
+    "--vector-index",
+    type=str,
+    default=None,
+    help="Retrieve from a memory-mapped copy of the knowledge base in this directory instead of Chroma. It is built, or rebuilt after an update, on startup.",
+)
+parser.add_argument(
+    "--draft-model",
+    type=str,
+    default=None,
+    help="Path to a small causal LM that drafts tokens for the main model to verify (assisted decoding). Single questions and streams use it, larger batches decode normally.",
+)
+parser.add_argument(
+    "--draft-tokens",
+    type=int,
+    default=None,
+    help="Tokens the draft model proposes at a time. By default the number adapts to how many get accepted.",
+)
+parser.add_argument(
+    "--checkpoint-cache",
+    type=str,
+    default="neutron_model_cache",
+    help="Load the model converted by neutron-checkpoint from this directory when it matches the current model and device. Default is neutron_model_cache.",
+)
+parser.add_argument(
+    "--session-memory-mb",
+    type=float,
+    default=1024,
+    help="Memory on the model device for the KV caches of /sessions conversations, per worker. Default is 1024.",
+)
+parser.add_argument(
+    "--session-offload-mb",
+    type=float,
+    default=4096,
+    help="Host memory for session caches moved off the GPU, per worker. Beyond it caches are dropped and rebuilt when needed. Default is 4096.",
+)
+parser.add_argument(
+    "--session-idle-timeout",
+    type=float,
+    default=1800,
+    help="Seconds after which an unused session is deleted. Default is 1800.",
+)
+parser.add_argument(
+    "--max-sessions",
+    type=int,
+    default=256,
+    help="The most sessions kept per worker, the least recently used are deleted first. Default is 256.",
+)
+parser.add_argument(
+    "--job-db",
+    type=str,
+    default="neutron_jobs.db",
+    help="The SQLite database that keeps /jobs, so queued questions survive restarts. Default is neutron_jobs.db.",
+)
+parser.add_argument(
+    "--job-concurrency",
+    type=int,
+    default=2,
+    help="Jobs answered at once. They share the batches with /ask questions. Default is 2.",
+)
+parser.add_argument(
+    "--max-queued-jobs",
+    type=int,
+    default=10000,
+    help="Jobs that may wait at once. Beyond this, POST /jobs gets 429 Too Many Requests. Default is 10000.",
+)
+parser.add_argument(
+    "--job-timeout",
+    type=float,
+    default=3600,
+    help="Seconds a job may take before generation is stopped and the job fails. Default is 3600.",
+)
+parser.add_argument(
+    "--job-retention-hours",
+    type=float,
+    default=168,
+    help="Hours a finished job and its result are kept. Default is 168.",
+)
+parser.add_argument(
+    "--no-prefix-cache",
+    action="store_true",
+    help="Prefill the whole prompt for every request instead of reusing the cached instruction preamble.",
+)
+# Defaults until main() parses the command line, so importing this module
+# has no side effects
+args = parser.parse_args([])
+
+# Loaded in the background once the server is listening, see load_components.
+# Either a LocalEngine or a WorkerPool.
+engine = None
+# Created with the app, once the command line has been parsed
+admission = None
+job_store = None
+job_runner = None
+# Extra keyword arguments for InteractiveModel, the benchmarks use this to
+# plug in stand-ins for the model, search tool and vector store
+components: Dict[str, Any] = {}
+startup = {"phase": "starting", "ready": False, "error": None, "timings": {}}
+# Get current process ID
+pid = os.getpid()
+# Get the process info using psutil
+process = psutil.Process(pid)
+metrics.register_collector(lambda: engine)
+
+
+def model_kwargs() -> Dict[str, Any]:
+    """InteractiveModel arguments from the command line, apart from the device."""
+    return {
+        "search_timeout": args.search_timeout,
+        "retrieval_timeout": args.retrieval_timeout,
+        "answer_cache_threshold": args.answer_cache_threshold,
+        "answer_cache_size": args.answer_cache_size,
+        "cpu_quantization": args.cpu_quantization,
+        "offline": args.offline,
+        "update_check_interval": args.update_check_interval * 60 * 60,
+        "prefix_cache": not args.no_prefix_cache,
+        "max_prompt_tokens": args.max_prompt_tokens,
+        "max_new_tokens": args.max_new_tokens,
+        "vector_index": args.vector_index,
+        "draft_model": args.draft_model,
+        "draft_tokens": args.draft_tokens,
+        "checkpoint_cache": args.checkpoint_cache,
+    }
+
+
+def search_cache_kwargs() -> Dict[str, Any]:
+    return {
+        "ttl": args.search_cache_ttl,
+        "max_entries": args.search_cache_size,
+        "max_bytes": int(args.search_cache_mb * 1024 * 1024),
+        "path": args.search_cache_path,
+    }
+
+
+def session_kwargs() -> Dict[str, Any]:
+    return {
+        "max_device_bytes": int(args.session_memory_mb * 1024 * 1024),
+        "max_offloaded_bytes": int(args.session_offload_mb * 1024 * 1024),
+        "idle_timeout": args.session_idle_timeout,
+        "max_sessions": args.max_sessions,
+    }
+
+
+def load_local_engine() -> LocalEngine:
+    model = InteractiveModel(
+        search_cache=SearchCache(**search_cache_kwargs()),
+        device=args.device,
+        threads=args.threads,
+        # Stand-ins take the place of the matching command line settings
+        **{**model_kwargs(), **components},
+    )
+    startup["timings"].update(model.load_timings)
+    if model.checkpoint:
+        print(f"Loaded the converted model from {model.checkpoint}")
+    scheduler = BatchScheduler(
+        model.generate_batch,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_batch_wait_ms,
+    )
+    if not args.no_warmup:
+        startup["phase"] = "warming up"
+        warmup_start = time.perf_counter()
+        model.warmup(batch_size=args.max_batch_size)
+        startup["timings"]["warmup"] = time.perf_counter() - warmup_start
+    sessions = SessionStore(device=str(model.model.device), **session_kwargs())
+    return LocalEngine(model, scheduler, sessions)
+
+
+def load_worker_pool() -> WorkerPool:
+    """Start the model workers and wait until the first one is ready."""
+    specs = worker_specs(args.workers, args.device, args.threads)
+    if args.vector_index and os.path.isdir("neutron_chroma.db"):
+        # Built once here rather than by every worker at the same time
+        vector_index.load_index(args.vector_index, "neutron_chroma.db")
+    for index, spec in enumerate(specs):
+        cache_kwargs = search_cache_kwargs()
+        if cache_kwargs["path"]:
+            # Each worker keeps its own file so they do not overwrite each other
+            cache_kwargs["path"] = f"{cache_kwargs['path']}.{index}"
+        spec.update(
+            model_kwargs=model_kwargs(),
+            search_cache=cache_kwargs,
+            scheduler_kwargs={
+                "max_batch_size": args.max_batch_size,
+                "max_wait_ms": args.max_batch_wait_ms,
+            },
+            session_kwargs=session_kwargs(),
+            warmup=not args.no_warmup,
+        )
+    pool = WorkerPool(specs, restart_delay=args.worker_restart_delay)
+    pool.start()
+    if not pool.wait_until_ready():
+        pool.stop()
+        errors = "; ".join(f"worker {w.index}: {w.error}" for w in pool.workers)
+        raise RuntimeError(f"No model worker could be started ({errors})")
+    startup["timings"].update(
+        next(worker.load_timings for worker in pool.workers if worker.ready)
+    )
+    return pool
+
+
+def load_components():
+    """Load the model and its components, warm it up, then mark the server ready."""
+    global engine
+    start = time.perf_counter()
+    try:
+        startup["phase"] = "loading"
+        if args.workers > 1:
+            engine = load_worker_pool()
+        else:
+            engine = load_local_engine()
+        startup["timings"]["total"] = time.perf_counter() - start
+        startup["phase"] = "ready"
+        startup["ready"] = True
+    except Exception as e:
+        logging.error(f"Error loading Neutron: {e}")
+        startup["phase"] = "failed"
+        startup["error"] = str(e)
+        print(f"Neutron failed to start: {e}")
+        return
+
+    for phase, seconds in startup["timings"].items():
+        print(f"Startup phase {phase}: {seconds:.2f}s")
+    memory_use = process.memory_info().rss
+    memory_use_gb = memory_use / 1024 / 1024 / 1024
+    print(f"Memory used by Neutron: {memory_use_gb} GB")
+    print(
+        "Neutron is now part of Nebula Pro's Free Tier.\nEmbrace the future of AI Powered Ethical Hacking with Nebula Pro ->> https://www.berylliumsec.com/nebula-pro-waitlist "
+    )
 
 
-app = FastAPI()
+def ready_engine():
+    """The engine once it can answer questions, otherwise None."""
+    if startup["ready"] and engine.ready:
+        return engine
+    return None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global admission, job_store, job_runner
+    admission = AdmissionController(args.max_queue_depth)
+    # Jobs can be submitted while the model loads, they wait for it
+    job_store = JobStore(
+        args.job_db,
+        max_queued=args.max_queued_jobs,
+        retention=args.job_retention_hours * 60 * 60,
+    )
+    job_runner = JobRunner(
+        job_store, ready_engine, args.job_concurrency, timeout=args.job_timeout
+    )
+    job_runner.start()
+    # The port is bound before the model loads so health checks work right away
+    threading.Thread(target=load_components, daemon=True).start()
+    yield
+    # Jobs that are still running are queued again for the next start
+    if job_runner.stop():
+        job_store.close()
+    else:
+        # A job still being answered would fail to record its result in a
+        # closed store. It stays running and is queued again on the next start.
+        logging.warning("Job runners did not stop in time, leaving the job database open.")
+    if engine is not None:
+        engine.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
@@ -32,21 +465,61 @@ app.add_middleware(
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
 )
-if not torch.cuda.is_available():
-    print("At least 8GB of GPU is required for Neutron to run")
-    exit(0)
-model = InteractiveModel()  # Initializes the model with its default configuration
-# Get current process ID
-pid = os.getpid()
-# Get the process info using psutil
-process = psutil.Process(pid)
-# Get memory usage (in bytes)
-memory_use = process.memory_info().rss
-memory_use_gb = memory_use / 1024 / 1024 / 1024
-print(f"Memory used by Neutron: {memory_use_gb} GB")
-print(
-    "Neutron is now part of Nebula Pro's Free Tier.\nEmbrace the future of AI Powered Ethical Hacking with Nebula Pro ->> https://www.berylliumsec.com/nebula-pro-waitlist "
-)
+
+
+class RecordRequests:
+    """Count and time every request, and tag it with a request ID.
+
+    The ID is taken from the `X-Request-ID` header or generated, returned in
+    the response headers and written to the log with the request's duration,
+    so slow requests can be traced. This is a plain ASGI middleware because
+    `@app.middleware("http")` wraps `receive`, and endpoints could then no
+    longer tell that their client disconnected.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1") or uuid.uuid4().hex
+        scope.setdefault("state", {})["request_id"] = request_id
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message = {
+                    **message,
+                    "headers": [
+                        *message.get("headers", []),
+                        (b"x-request-id", request_id.encode("latin-1")),
+                    ],
+                }
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            # Streamed answers are only done once the last chunk has been sent
+            seconds = time.perf_counter() - start
+            # Only known routes become labels, so stray paths cannot add new series
+            endpoint = getattr(scope.get("route"), "path", "unmatched")
+            metrics.REQUESTS.labels(endpoint, str(status_code)).inc()
+            metrics.REQUEST_SECONDS.labels(endpoint).observe(seconds)
+            message = f"Request {request_id} {scope['method']} {endpoint} {status_code} {seconds:.3f}s"
+            if seconds >= args.slow_request_seconds:
+                logging.warning(f"Slow request: {message}")
+            else:
+                logging.info(message)
+
+
+app.add_middleware(RecordRequests)
 
 
 def check_auth(token: str) -> bool:
@@ -62,21 +535,123 @@ class Query(BaseModel):
     question: str
 
 
-@app.post("/ask")
-def ask(request: Request, query: Query) -> Dict[str, Any]:
-    # Check for auth token
-    auth_token = request.headers.get("Authorization")
-    if not auth_token or not check_auth(auth_token):
+class BatchQuery(BaseModel):
+    questions: List[str]
+
+
+class JobQuery(BaseModel):
+    question: str
+    priority: str = "normal"
+    webhook: Optional[str] = None
+
+
+def ensure_ready():
+    """Reject requests with 503 until the model has been loaded and warmed up."""
+    if not startup["ready"]:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Neutron is not ready yet ({startup['phase']})",
+            headers={"Retry-After": "10"},
+        )
+    if not engine.ready:
+        no_worker_available()
+
+
+def no_worker_available():
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="No model worker is ready, they are restarting",
+        headers={"Retry-After": "10"},
+    )
+
+
+def admit():
+    """Reserve a slot for a question, or reject it with 429 when all are taken."""
+    if not admission.try_admit():
+        metrics.REJECTED.inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Neutron is busy, try again later",
+            headers={"Retry-After": str(admission.retry_after())},
         )
+    metrics.IN_FLIGHT.inc()
+
 
+def release(start: float):
+    admission.release(time.perf_counter() - start)
+    metrics.IN_FLIGHT.dec()
+
+
+async def close_generator(generator):
+    """Close a generator on a worker thread, even while the request is being cancelled."""
+    with anyio.CancelScope(shield=True):
+        try:
+            await run_in_threadpool(generator.close)
+        except ValueError:
+            # Still running on another thread, the request's cancel event stops it
+            pass
+
+
+def request_deadline(request: Request) -> float:
+    """The `time.monotonic()` by which a question must be answered.
+
+    Clients can shorten `--request-timeout` with the `X-Neutron-Timeout`
+    header, in seconds.
+    """
+    timeout = args.request_timeout
+    try:
+        timeout = min(timeout, float(request.headers["X-Neutron-Timeout"]))
+    except (KeyError, ValueError):
+        pass
+    return time.monotonic() + timeout
+
+
+def use_answer_cache(request: Request) -> bool:
+    """Clients can skip cached answers by sending `X-Neutron-Cache: bypass`."""
+    return request.headers.get("X-Neutron-Cache", "").lower() != "bypass"
+
+
+async def answer(request: Request, function, *arguments) -> Dict[str, Any]:
+    """Run `function(*arguments, cancel_event, deadline)` for an admitted question.
+
+    Generation stops if the client disconnects or the deadline passes, and
+    errors become the matching HTTP status codes.
+    """
+    admit()
+
+    start = time.perf_counter()
+    cancel_event = threading.Event()
     try:
-        response = model.invoke(query.question)
-        memory_use = process.memory_info().rss
-        memory_use_gb = memory_use / 1024 / 1024 / 1024
-        print(f"Memory used by Neutron: {memory_use_gb} GB")
-        return {"response": response}
+        task = asyncio.ensure_future(
+            run_in_threadpool(
+                function, *arguments, cancel_event, request_deadline(request)
+            )
+        )
+        # Stop generating for clients that have given up waiting
+        while not task.done():
+            await asyncio.wait({task}, timeout=0.5)
+            if not task.done() and await request.is_disconnected():
+                logging.info(
+                    f"Request {request.state.request_id}: client disconnected, cancelling generation."
+                )
+                cancel_event.set()
+        result = await task
+        logging.info(f"Request {request.state.request_id} timings: {result['timings']}")
+        return result
+    except NoWorkerAvailable:
+        no_worker_available()
+    except SessionNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except RequestCancelled:
+        metrics.ABORTED.labels("cancelled").inc()
+        # Nobody is listening any more, 499 is the usual code for this
+        raise HTTPException(status_code=499, detail="Client closed the request")
+    except DeadlineExceeded:
+        metrics.ABORTED.labels("deadline").inc()
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="The answer took longer than the request timeout",
+        )
     except KeyError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={e})
     except Exception as e:
@@ -84,11 +659,328 @@ def ask(request: Request, query: Query) -> Dict[str, Any]:
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred: {str(e)}",
         )
+    finally:
+        cancel_event.set()
+        release(start)
+
+
+@app.post("/ask")
+async def ask(request: Request, query: Query) -> Dict[str, Any]:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+    return await answer(request, engine.ask, query.question, use_answer_cache(request))
+
+
+def session_call(function, *arguments) -> Dict[str, Any]:
+    try:
+        return function(*arguments)
+    except NoWorkerAvailable:
+        no_worker_available()
+    except SessionNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
+@app.post("/sessions")
+def create_session(request: Request) -> Dict[str, Any]:
+    """Start a conversation, its follow-up questions reuse the model's cache."""
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+    return session_call(engine.create_session)
+
+
+@app.post("/sessions/{session_id}/ask")
+async def session_ask(request: Request, session_id: str, query: Query) -> Dict[str, Any]:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+    return await answer(request, engine.session_ask, session_id, query.question)
+
+
+@app.get("/sessions/{session_id}")
+def get_session(request: Request, session_id: str) -> Dict[str, Any]:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+    return session_call(engine.get_session, session_id)
+
+
+@app.delete("/sessions/{session_id}")
+def delete_session(request: Request, session_id: str) -> Dict[str, Any]:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+    return session_call(engine.delete_session, session_id)
+
+
+@app.get("/healthz")
+def healthz() -> Dict[str, Any]:
+    """Liveness: the process is up and the model has not failed to load."""
+    if startup["phase"] == "failed":
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={"phase": startup["phase"], "error": startup["error"]},
+        )
+    return {"status": "ok", "phase": startup["phase"]}
+
+
+@app.get("/readyz")
+def readyz() -> Dict[str, Any]:
+    """Readiness: the model is loaded and warmed up."""
+    if not startup["ready"] or not engine.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={"phase": startup["phase"], "error": startup["error"]},
+        )
+    return {"status": "ready", "timings": startup["timings"]}
+
+
+@app.get("/stats")
+def stats(request: Request) -> Dict[str, Any]:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+    return {**engine.stats(), "jobs": job_store.counts()}
+
+
+@app.get("/metrics")
+def prometheus_metrics() -> Response:
+    """Prometheus metrics, see neutron.metrics."""
+    return Response(metrics.render(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/ask/stream")
+async def ask_stream(request: Request, query: Query) -> StreamingResponse:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+
+    admit()
+    start = time.perf_counter()
+    cancel_event = threading.Event()
+    deadline = request_deadline(request)
+    try:
+        cached, chunks = await run_in_threadpool(
+            engine.stream,
+            query.question,
+            use_answer_cache(request),
+            cancel_event,
+            deadline,
+        )
+        if not cached:
+            # A generation that fails before its first token still gets an
+            # error status, the headers have not been sent yet
+            first_text = await run_in_threadpool(next, chunks, None)
+    except NoWorkerAvailable:
+        release(start)
+        no_worker_available()
+    except Exception:
+        cancel_event.set()
+        release(start)
+        raise
+    if cached:
+        release(start)
+        return StreamingResponse(
+            chunks,
+            media_type="text/plain; charset=utf-8",
+            headers={"X-Neutron-Cache": "hit"},
+        )
+
+    async def rest():
+        if first_text is not None:
+            yield first_text
+            async for text in iterate_in_threadpool(chunks):
+                yield text
+
+    async def generate():
+        first_token = None
+        try:
+            async for text in rest():
+                if await request.is_disconnected():
+                    logging.info("Client disconnected, cancelling generation.")
+                    metrics.ABORTED.labels("cancelled").inc()
+                    break
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                    metrics.TIME_TO_FIRST_TOKEN.observe(first_token)
+                    logging.info(
+                        f"Request {request.state.request_id} time to first token: {first_token:.3f}s"
+                    )
+                yield text
+            else:
+                if time.monotonic() >= deadline:
+                    metrics.ABORTED.labels("deadline").inc()
+                    logging.warning(
+                        f"Request {request.state.request_id}: the answer was cut off at the request timeout."
+                    )
+        except Exception as e:
+            logging.error(f"Request {request.state.request_id}: the stream failed: {e}")
+            # The 200 status has already been sent, so the failure is reported
+            # at the end of the text
+            yield f"\n[Error: the answer could not be completed: {e}]"
+        finally:
+            # A client that disconnects cancels this task, so nothing is
+            # awaited before the slot is released and the generation stopped
+            cancel_event.set()
+            release(start)
+            await close_generator(chunks)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/plain; charset=utf-8",
+        headers={"X-Neutron-Cache": "miss"},
+    )
+
+
+@app.post("/ask/batch")
+async def ask_batch(request: Request, query: BatchQuery) -> StreamingResponse:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    ensure_ready()
+    if not query.questions or len(query.questions) > args.max_batch_questions:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Send between 1 and {args.max_batch_questions} questions",
+        )
+
+    # A batch takes one admission slot, it is generated a few questions at a time
+    admit()
+    start = time.perf_counter()
+    cancel_event = threading.Event()
+    try:
+        results = await run_in_threadpool(
+            engine.ask_batch,
+            query.questions,
+            use_answer_cache(request),
+            cancel_event,
+            request_deadline(request),
+        )
+    except NoWorkerAvailable:
+        release(start)
+        no_worker_available()
+    except Exception:
+        release(start)
+        raise
+
+    async def generate():
+        try:
+            async for result in iterate_in_threadpool(results):
+                if await request.is_disconnected():
+                    logging.info("Client disconnected, cancelling the batch.")
+                    metrics.ABORTED.labels("cancelled").inc()
+                    break
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            logging.error(f"Request {request.state.request_id}: the batch failed: {e}")
+            yield json.dumps({"error": f"An error occurred: {str(e)}"}) + "\n"
+        finally:
+            # Nothing is awaited before the slot is released, see ask_stream
+            cancel_event.set()
+            release(start)
+            await close_generator(results)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+def submit_job(request: Request, query: JobQuery) -> Dict[str, Any]:
+    """Queue a question and return its job right away, see neutron.jobs."""
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    if query.priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"The priority must be one of {', '.join(PRIORITIES)}",
+        )
+    if query.webhook and not query.webhook.startswith(("http://", "https://")):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The webhook must be an http:// or https:// URL",
+        )
+    try:
+        return job_store.submit(
+            query.question, query.priority, query.webhook, use_answer_cache(request)
+        )
+    except QueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many queued jobs, try again later ({e})",
+            headers={"Retry-After": "60"},
+        )
+
+
+@app.get("/jobs/{job_id}")
+def get_job(request: Request, job_id: str) -> Dict[str, Any]:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    try:
+        return job_store.get(job_id)
+    except JobNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(request: Request, job_id: str) -> Dict[str, Any]:
+    # Check for auth token
+    auth_token = request.headers.get("Authorization")
+    if not auth_token or not check_auth(auth_token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
+        )
+    try:
+        return job_runner.cancel(job_id)
+    except JobNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
 
 
 def main():
     import uvicorn
 
+    global args
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+
     uvicorn.run(app, host=args.host, port=args.port)
 
 
@@ -0,0 +1,246 @@
+"""Conversations that keep their KV cache between questions.
+
+A session holds the token ids of its conversation so far and the attention
+key/value cache that covers them, so a follow-up question only prefills its
+own tokens. Caches live on the model device within `max_device_bytes`.
+Beyond that, the least recently used caches are moved to host memory, up to
+`max_offloaded_bytes`, and beyond that they are dropped. A session whose
+cache was dropped still works, its next question prefills the whole
+conversation again. Sessions idle for `idle_timeout` seconds, or the least
+recently used beyond `max_sessions`, are removed.
+"""
+
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+
+
+class SessionNotFound(Exception):
+    pass
+
+
+def cache_tensors(cache) -> List[torch.Tensor]:
+    """Every tensor held by a KV cache object, whatever its layout."""
+    tensors = []
+    seen = set()
+    pending = [cache]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, torch.Tensor):
+            tensors.append(item)
+        elif isinstance(item, (list, tuple)):
+            pending.extend(item)
+        elif isinstance(item, dict):
+            pending.extend(item.values())
+        elif hasattr(item, "__dict__"):
+            pending.extend(vars(item).values())
+    return tensors
+
+
+def cache_nbytes(cache) -> int:
+    if cache is None:
+        return 0
+    return sum(tensor.nbytes for tensor in cache_tensors(cache))
+
+
+def offload_cache(cache):
+    """Copy a KV cache to host memory, with the device of each tensor to restore it to.
+
+    The cache spans several GPUs when the model does. Devices recorded by the
+    cache object itself are left alone, the copy is only kept until restored.
+    """
+    tensors = cache_tensors(cache)
+    memo = {id(tensor): tensor.to("cpu") for tensor in tensors}
+    return copy.deepcopy(cache, memo), [tensor.device for tensor in tensors]
+
+
+def restore_cache(cache, devices: List[torch.device]):
+    tensors = cache_tensors(cache)
+    memo = {id(tensor): tensor.to(device) for tensor, device in zip(tensors, devices)}
+    return copy.deepcopy(cache, memo)
+
+
+class Session:
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.turns = []  # (question, answer)
+        # Token ids of the conversation so far, and the cache that covers them
+        self.input_ids = None
+        self.cache = None
+        self.cache_bytes = 0
+        # Where the tensors of an offloaded cache came from
+        self.cache_devices = None
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        # A session answers one question at a time
+        self.lock = threading.Lock()
+
+    def describe(self) -> dict:
+        if self.cache is None:
+            cache = "none"
+        else:
+            cache = "device" if self.cache_devices is None else "offloaded"
+        return {
+            "session_id": self.id,
+            "turns": [
+                {"question": question, "answer": answer} for question, answer in self.turns
+            ],
+            "tokens": 0 if self.input_ids is None else self.input_ids.shape[1],
+            "cache": cache,
+        }
+
+
+class SessionStore:
+    """Holds the sessions and their caches within the memory budgets, see the module docstring."""
+
+    def __init__(
+        self,
+        device: str = "cpu",
+        max_device_bytes: int = 1024 * 1024 * 1024,
+        max_offloaded_bytes: int = 4 * 1024 * 1024 * 1024,
+        idle_timeout: float = 1800,
+        max_sessions: int = 256,
+    ):
+        self.device = device
+        # On a CPU there is nowhere to offload to
+        self.can_offload = not device.startswith("cpu")
+        self.max_device_bytes = max_device_bytes
+        self.max_offloaded_bytes = max_offloaded_bytes if self.can_offload else 0
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max(1, max_sessions)
+        self.sessions = OrderedDict()  # id -> Session, least recently used first
+        self.device_bytes = 0
+        self.offloaded_bytes = 0
+        self.offloads = 0
+        self.dropped = 0
+        self.expired = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def create(self) -> Session:
+        session = Session(uuid.uuid4().hex)
+        with self.lock:
+            self._expire()
+            self.sessions[session.id] = session
+            while len(self.sessions) > self.max_sessions:
+                _, oldest = self.sessions.popitem(last=False)
+                self._release(oldest)
+                self.expired += 1
+        return session
+
+    def get(self, session_id: str) -> Session:
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise SessionNotFound(f"Session {session_id} does not exist or has expired")
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            return session
+
+    def delete(self, session_id: str):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                raise SessionNotFound(f"Session {session_id} does not exist or has expired")
+            self._release(session)
+
+    def take_cache(self, session: Session):
+        """Hand the session's cache to a new turn, back on the model device.
+
+        The cache is extended in place by generation, so the session no
+        longer holds it until `store` is called.
+        """
+        with self.lock:
+            cache, devices = session.cache, session.cache_devices
+            self._release(session)
+        if cache is not None and devices is not None:
+            cache = restore_cache(cache, devices)
+        return cache
+
+    def store(self, session: Session, input_ids: torch.Tensor, cache):
+        """Keep the ids and cache of the conversation after a turn, within the budgets."""
+        size = cache_nbytes(cache)
+        with self.lock:
+            session.input_ids = input_ids
+            if session.id not in self.sessions:
+                # Deleted or expired during the turn
+                return
+            if cache is not None and size <= self.max_device_bytes:
+                session.cache = cache
+                session.cache_bytes = size
+                self.device_bytes += size
+            elif cache is not None:
+                self.dropped += 1
+            self._enforce_budgets(session)
+
+    def _release(self, session: Session):
+        if session.cache is not None:
+            if session.cache_devices is not None:
+                self.offloaded_bytes -= session.cache_bytes
+            else:
+                self.device_bytes -= session.cache_bytes
+        session.cache = None
+        session.cache_bytes = 0
+        session.cache_devices = None
+
+    def _enforce_budgets(self, keep: Session):
+        for session in list(self.sessions.values()):
+            if self.device_bytes <= self.max_device_bytes:
+                break
+            if session is keep or session.cache is None or session.cache_devices:
+                continue
+            if self.can_offload and session.cache_bytes <= self.max_offloaded_bytes:
+                cache, size = session.cache, session.cache_bytes
+                self._release(session)
+                session.cache, session.cache_devices = offload_cache(cache)
+                session.cache_bytes = size
+                self.offloaded_bytes += size
+                self.offloads += 1
+            else:
+                self._release(session)
+                self.dropped += 1
+        for session in list(self.sessions.values()):
+            if self.offloaded_bytes <= self.max_offloaded_bytes:
+                break
+            if session.cache_devices is not None:
+                self._release(session)
+                self.dropped += 1
+
+    def _expire(self):
+        if not self.idle_timeout:
+            return
+        cutoff = time.monotonic() - self.idle_timeout
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_used > cutoff:
+                break
+            self.sessions.popitem(last=False)
+            self._release(session)
+            self.expired += 1
+
+    def record_restart(self):
+        """Count a conversation that outgrew the context window and started over."""
+        with self.lock:
+            self.restarts += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._expire()
+            return {
+                "sessions": len(self.sessions),
+                "device_bytes": self.device_bytes,
+                "offloaded_bytes": self.offloaded_bytes,
+                "offloads": self.offloads,
+                "dropped_caches": self.dropped,
+                "expired": self.expired,
+                "restarts": self.restarts,
+            }
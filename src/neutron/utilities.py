@@ -3,10 +3,10 @@ import logging
 import os
 import shutil
 import socket
-import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from importlib.metadata import version
-from zipfile import ZipFile
 
 import requests
 import transformers
@@ -14,9 +14,16 @@ from prompt_toolkit import prompt
 from prompt_toolkit.history import InMemoryHistory
 from prompt_toolkit.styles import Style
 
+from neutron import downloader, manifest
+
 transformers.logging.set_verbosity_error()
 model_s3_url = "https://nebula-pro-beta.s3.amazonaws.com/neutron_model.zip"  # Update this with your actual S3 URL
 chroma_s3_url = "https://nebula-pro-beta.s3.amazonaws.com/neutron_chroma.db.zip"
+# Results of the last update check, reused until they are older than the check interval
+update_state_path = os.path.join(os.path.expanduser("~"), ".neutron", "update_state.json")
+default_update_check_interval = 24 * 60 * 60
+# A check that failed, e.g. without network access, is tried again after this
+failed_update_check_retry = 15 * 60
 # Configure basic logging
 # This will set the log level to ERROR, meaning only error and critical messages will be logged
 # You can specify a filename to write the logs to a file; otherwise, it will log to stderr
@@ -51,28 +58,62 @@ def get_input_with_default(message, default_text=None):
     return user_input
 
 
-def ensure_model_folder_exists(model_directory, auto_update=True):
+def ensure_model_folder_exists(
+    model_directory, auto_update=True, update_state=None, offline=False
+):
+    """Download the model directory if it is missing or outdated.
+
+    When `update_state` (from `run_update_checks`) is given, its cached ETags
+    are used instead of asking S3 again. If a per-file manifest is published
+    next to the archive, only the files that changed are downloaded. In
+    offline mode nothing is downloaded, and a missing directory raises
+    FileNotFoundError.
+    """
+    if offline:
+        downloader.recover_directory(model_directory)
+        if not folder_exists_and_not_empty(model_directory):
+            raise FileNotFoundError(
+                f"{model_directory} is missing and offline mode is enabled. Copy it "
+                "from a machine with network access, or start once without --offline "
+                "(NEUTRON_OFFLINE) to download it."
+            )
+        return
     if model_directory == "neutron_model":
         s3_url = model_s3_url
     else:
         s3_url = chroma_s3_url
     try:
+        downloader.recover_directory(model_directory)
         metadata_file = os.path.join(model_directory, "metadata.json")
 
+        local_etag = None
         try:
             local_etag = get_local_metadata(metadata_file)
         except Exception as e:
             logging.error(f"Error getting local metadata: {e}")
 
+        manifest_url = manifest.manifest_url_for(s3_url)
+        s3_etag = None
+        manifest_etag = None
         try:
-            s3_etag = get_s3_file_etag(s3_url)
+            if update_state is not None:
+                s3_etag = update_state.get("etags", {}).get(s3_url)
+                manifest_etag = update_state.get("etags", {}).get(manifest_url)
+            else:
+                s3_etag = get_s3_file_etag(s3_url)
+                manifest_etag = get_s3_file_etag(manifest_url)
         except Exception as e:
             logging.error(f"Error getting S3 file etag: {e}")
+        # A published manifest identifies the version and allows delta updates
+        s3_etag = manifest_etag or s3_etag
 
         if s3_etag is None:
             logging.warning(
                 "No S3 etag found. Possibly no internet connection or issue with S3."
             )
+            if folder_exists_and_not_empty(model_directory):
+                # Without a remote version to compare against, keep what we have
+                return
 
         # Check if the model directory exists and has the same etag (metadata)
         if folder_exists_and_not_empty(model_directory) and local_etag == s3_etag:
@@ -98,22 +139,25 @@ def ensure_model_folder_exists(model_directory, auto_update=True):
                 "Auto-update is enabled. Downloading new version if necessary..."
             )
 
-        # Proceed with the removal of the existing model directory and the download of the new version
-        if os.path.exists(model_directory):
-            logging.info("Removing existing model folder...")
-            try:
-                shutil.rmtree(model_directory)
-            except Exception as e:
-                logging.error(f"Error removing existing model directory: {e}")
-                return
-
+        # The existing directory stays in place until the new version is ready
         logging.info(
             f"{model_directory} not found or is outdated. Downloading and unzipping..."
         )
         try:
-            download_and_unzip(s3_url, f"{model_directory}.zip")
+            etag = None
+            if manifest_etag is not None:
+                try:
+                    etag = manifest.sync_directory(manifest_url, model_directory)
+                except Exception as e:
+                    logging.error(
+                        f"Delta update of {model_directory} failed, downloading the full archive: {e}"
+                    )
+            if etag is None:
+                etag = download_and_unzip(s3_url, f"{model_directory}.zip")
+                # The manifest stays the version compared against next time
+                etag = manifest_etag or etag
             # Save new metadata
-            save_local_metadata(metadata_file, s3_etag)
+            save_local_metadata(metadata_file, etag or s3_etag)
         except Exception as e:
             logging.error(f"Error updating model directory: {e}")
     except Exception as e:
@@ -146,54 +190,27 @@ def folder_exists_and_not_empty(folder_path):
 
 
 def download_and_unzip(url, output_name):
+    """Download a zipped model directory and swap it into place.
+
+    The download runs in parallel and resumes after interruptions. The
+    existing directory is only replaced once the archive has been verified
+    against its published SHA-256 and fully extracted. Returns the ETag of the
+    downloaded archive.
+    """
+    # Define the target directory based on the intended structure
+    target_dir = os.path.splitext(output_name)[0]  # Removes '.zip' from output_name
     try:
-        # Download the file from the S3 bucket using wget with progress bar
         logging.info("Downloading...")
-        subprocess.run(
-            ["wget", "--progress=bar:force:noscroll", url, "-O", output_name],
-            check=True,
-        )
-
-        # Define the target directory based on the intended structure
-        target_dir = os.path.splitext(output_name)[0]  # Removes '.zip' from output_name
-
-        # Extract the ZIP file
-        logging.info("\nUnzipping...")
-        with ZipFile(output_name, "r") as zip_ref:
-            # Here we will extract in a temp directory to inspect the structure
-            temp_dir = "temp_extract_dir"
-            zip_ref.extractall(temp_dir)
-
-            # Check if there is an unwanted nested structure
-            extracted_dirs = os.listdir(temp_dir)
-            if len(extracted_dirs) == 1 and os.path.isdir(
-                os.path.join(temp_dir, extracted_dirs[0])
-            ):
-                nested_dir = os.path.join(temp_dir, extracted_dirs[0])
-                # Move content up if there is exactly one directory inside
-                if os.path.basename(nested_dir) == output_name:
-                    shutil.move(nested_dir, target_dir)
-                else:
-                    shutil.move(nested_dir, os.path.join(target_dir, output_name))
-            else:
-                # No nested structure, so just move all to the target directory
-                os.makedirs(target_dir, exist_ok=True)
-                for item in extracted_dirs:
-                    shutil.move(
-                        os.path.join(temp_dir, item), os.path.join(target_dir, item)
-                    )
-
-            # Cleanup temp directory
-            shutil.rmtree(temp_dir)
-
+        expected_sha256 = manifest.fetch_archive_sha256(url)
+        etag = downloader.download(url, output_name, expected_sha256=expected_sha256)
+        logging.info("Unzipping...")
+        downloader.extract_zip_atomic(output_name, target_dir)
         # Remove the ZIP file to clean up
         os.remove(output_name)
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error occurred during download: {e}")
-        logging.error(f"Error occurred during download: {e}")
+        return etag
     except Exception as e:
-        logging.error(f"Unexpected error: {e}")
-        logging.error(f"Unexpected error: {e}")
+        logging.error(f"Error occurred while updating {target_dir}: {e}")
+        raise
 
 
 def save_local_metadata(file_name, etag):
@@ -211,18 +228,19 @@ def return_path(path):
 def is_internet_available(host="8.8.8.8", port=53, timeout=3):
     """Check if there is an internet connection."""
     try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        return True
+        # The timeout only applies to this socket, not to every socket in the process
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
     except Exception:
         return False
 
 
-def get_s3_file_etag(s3_url):
-    if not is_internet_available():
-        logging.error("No internet connection available. Skipping version check.")
+def get_s3_file_etag(s3_url, timeout=5):
+    try:
+        response = requests.head(s3_url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to get the ETag of {s3_url}: {e}")
         return None
-    response = requests.head(s3_url)
     return response.headers.get("ETag")
 
 
@@ -235,9 +253,11 @@ def get_local_metadata(file_name):
         return None
 
 
-def get_latest_pypi_version(package_name):
+def get_latest_pypi_version(package_name, timeout=5):
     try:
-        response = requests.get(f"https://pypi.org/pypi/{package_name}/json")
+        response = requests.get(
+            f"https://pypi.org/pypi/{package_name}/json", timeout=timeout
+        )
         if response.status_code == 200:
             return response.json()["info"]["version"]
     except requests.exceptions.RequestException as e:
@@ -245,9 +265,13 @@ def get_latest_pypi_version(package_name):
     return None
 
 
-def check_new_pypi_version(package_name="neutron-ai"):
-    """Check if a newer version of the package is available on PyPI."""
-    if not is_internet_available():
+def check_new_pypi_version(package_name="neutron-ai", update_state=None):
+    """Check if a newer version of the package is available on PyPI.
+
+    When `update_state` (from `run_update_checks`) is given, the cached latest
+    version is used instead of asking PyPI again.
+    """
+    if update_state is None and not is_internet_available():
         logging.error("No internet connection available. Skipping version check.")
         return
 
@@ -260,7 +284,10 @@ def check_new_pypi_version(package_name="neutron-ai"):
     print(f"Installed version: {installed_version}")
 
     try:
-        latest_version = get_latest_pypi_version(package_name)
+        if update_state is not None:
+            latest_version = update_state.get("pypi_version")
+        else:
+            latest_version = get_latest_pypi_version(package_name)
         if latest_version is None:
             logging.error(
                 f"Error retrieving latest version of {package_name} from PyPI."
@@ -273,3 +300,74 @@ def check_new_pypi_version(package_name="neutron-ai"):
             )
     except Exception as e:
         logging.error(f"An error occurred while checking for the latest version: {e}")
+
+
+def load_update_state(path=update_state_path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error(f"Error reading update state from {path}: {e}")
+        return {}
+
+
+def save_update_state(state, path=update_state_path):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.error(f"Error saving update state to {path}: {e}")
+
+
+def run_update_checks(
+    offline=False,
+    interval=default_update_check_interval,
+    package_name="neutron-ai",
+    path=update_state_path,
+):
+    """Look up the latest package version and the model ETags, reusing recent results.
+
+    The PyPI lookup and the S3 HEAD requests run in parallel. Results are saved
+    to `path` and reused until they are older than `interval` seconds. A check
+    that failed is tried again after `failed_update_check_retry` seconds. In
+    offline mode no request is made and the last saved results are returned.
+    """
+    state = load_update_state(path)
+    if offline:
+        logging.info("Offline mode is enabled. Skipping update checks.")
+        return state
+    now = time.time()
+    if now - state.get("checked_at", 0) < interval:
+        return state
+    if now - state.get("failed_at", 0) < min(interval, failed_update_check_retry):
+        return state
+
+    urls = [model_s3_url, chroma_s3_url]
+    urls += [manifest.manifest_url_for(url) for url in urls]
+    with ThreadPoolExecutor(max_workers=len(urls) + 1) as executor:
+        pypi_future = executor.submit(get_latest_pypi_version, package_name)
+        etag_futures = {url: executor.submit(get_s3_file_etag, url) for url in urls}
+        pypi_version = pypi_future.result()
+        etags = {url: future.result() for url, future in etag_futures.items()}
+
+    # The manifests are optional, the version and the archives are not
+    succeeded = pypi_version is not None and all(
+        etags[url] for url in (model_s3_url, chroma_s3_url)
+    )
+    previous_etags = state.get("etags", {})
+    new_state = {
+        "checked_at": time.time() if succeeded else state.get("checked_at", 0),
+        "pypi_version": pypi_version or state.get("pypi_version"),
+        # A failed lookup keeps the last known ETag rather than forcing a download
+        "etags": {url: etag or previous_etags.get(url) for url, etag in etags.items()},
+    }
+    if not succeeded:
+        logging.warning("The update check failed, it will be tried again on a later start.")
+        new_state["failed_at"] = time.time()
+    save_update_state(new_state, path)
+    return new_state
@@ -0,0 +1,275 @@
+"""A memory-mapped copy of the knowledge base for fast retrieval.
+
+The embeddings, texts and metadata of the Chroma collection are exported
+to a directory of flat files:
+
+    index.json      version, size, dimension and the version of the source
+    embeddings.npy  float32 matrix, one row per document
+    norms.npy       squared L2 norm of every row
+    offsets.npy     int64 start of every text in texts.bin, plus the end
+    texts.bin       UTF-8 texts, back to back
+    metadatas.json  metadata of every document
+
+The arrays are opened with `mmap`, so loading is instant and worker
+processes on one machine share a single copy through the page cache. Search
+is exact: one matrix product ranks every document, which is fast for a
+knowledge base of this size and picks the same candidates as Chroma's L2
+search. MMR re-ranking is vectorized with NumPy.
+
+To build the index from the Chroma directory:
+
+    neutron-index neutron_chroma.db neutron_index
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from neutron import downloader, utilities
+
+INDEX_VERSION = 1
+INDEX_FILE = "index.json"
+# Written to the Chroma directory by neutron-ingest after every ingestion that
+# changed it, so an index built from the store knows it is out of date
+INGEST_FILE = "ingest.json"
+
+
+def ingest_version(chroma_directory: str) -> Optional[str]:
+    """The version written by the last ingestion into `chroma_directory`, if any."""
+    try:
+        with open(os.path.join(chroma_directory, INGEST_FILE), "r") as f:
+            return json.load(f).get("version")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def source_version(chroma_directory: str) -> Optional[str]:
+    """Identify the state of a Chroma directory, to tell when an index is stale."""
+    etag = utilities.get_local_metadata(os.path.join(chroma_directory, "metadata.json"))
+    if etag:
+        # Documents added by neutron-ingest change the store but not its ETag
+        ingested = ingest_version(chroma_directory)
+        return f"{etag}+{ingested}" if ingested else etag
+    try:
+        stat = os.stat(os.path.join(chroma_directory, "chroma.sqlite3"))
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def build_index(chroma_directory: str, index_directory: str, vector_store=None) -> dict:
+    """Export a Chroma collection to `index_directory`, replacing it as a whole.
+
+    `vector_store` is an open Chroma store to read instead of opening
+    `chroma_directory`. Processes that have the old index open keep reading
+    their mapped files until they reload.
+    """
+    if vector_store is None:
+        from langchain_community.vectorstores import Chroma
+
+        vector_store = Chroma(persist_directory=chroma_directory)
+    records = vector_store._collection.get(
+        include=["embeddings", "documents", "metadatas"]
+    )
+    embeddings = np.asarray(records["embeddings"], dtype=np.float32)
+    if embeddings.ndim != 2:
+        embeddings = embeddings.reshape(len(records["documents"]), -1)
+    texts = [(text or "").encode("utf-8") for text in records["documents"]]
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(text) for text in texts])
+    info = {
+        "version": INDEX_VERSION,
+        "count": int(embeddings.shape[0]),
+        "dimension": int(embeddings.shape[1]),
+        "source_version": source_version(chroma_directory),
+    }
+
+    staging_directory = f"{index_directory}.staging-{os.getpid()}"
+    if os.path.exists(staging_directory):
+        shutil.rmtree(staging_directory)
+    os.makedirs(staging_directory)
+    np.save(os.path.join(staging_directory, "embeddings.npy"), embeddings)
+    np.save(
+        os.path.join(staging_directory, "norms.npy"),
+        np.einsum("ij,ij->i", embeddings, embeddings),
+    )
+    np.save(os.path.join(staging_directory, "offsets.npy"), offsets)
+    with open(os.path.join(staging_directory, "texts.bin"), "wb") as f:
+        f.write(b"".join(texts))
+    with open(os.path.join(staging_directory, "metadatas.json"), "w") as f:
+        json.dump([metadata or {} for metadata in records["metadatas"]], f)
+    # Written last, a directory without it is an unfinished build
+    with open(os.path.join(staging_directory, INDEX_FILE), "w") as f:
+        json.dump(info, f)
+    downloader.swap_directory(staging_directory, index_directory)
+    return info
+
+
+def maximal_marginal_relevance(
+    query: np.ndarray, candidates: np.ndarray, k: int = 4, lambda_mult: float = 0.5
+) -> List[int]:
+    """Pick `k` candidates that are similar to the query but not to each other.
+
+    Same selection as LangChain's helper, with the similarities computed
+    once and the redundancy of every candidate updated in place.
+    """
+    if k <= 0 or len(candidates) == 0:
+        return []
+    candidates = candidates / np.maximum(
+        np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12
+    )
+    query = query / max(np.linalg.norm(query), 1e-12)
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+
+class VectorIndex:
+    """Exact nearest neighbour search over a directory written by `build_index`."""
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, INDEX_FILE), "r") as f:
+            self.info = json.load(f)
+        if self.info.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported vector index version {self.info.get('version')}")
+        self.directory = directory
+        self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(directory, "norms.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        if self.offsets[-1]:
+            self.texts = np.memmap(
+                os.path.join(directory, "texts.bin"), dtype=np.uint8, mode="r"
+            )
+        else:
+            # An empty file cannot be mapped
+            self.texts = np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(directory, "metadatas.json"), "r") as f:
+            self.metadatas = json.load(f)
+
+    def __len__(self) -> int:
+        return self.embeddings.shape[0]
+
+    def document(self, row: int) -> Document:
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return Document(
+            page_content=bytes(self.texts[start:end]).decode("utf-8"),
+            metadata=self.metadatas[row],
+        )
+
+    def nearest(self, queries: np.ndarray, k: int) -> np.ndarray:
+        """Rows of the `k` nearest documents by L2 distance, nearest first, per query."""
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64)
+        # |x - q|^2 ranks like |x|^2 - 2 x.q, as |q|^2 is the same for every row
+        distances = self.norms[None, :] - 2 * (queries @ self.embeddings.T)
+        rows = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(distances, rows, axis=1).argsort(axis=1)
+        return np.take_along_axis(rows, order, axis=1)
+
+    def mmr_search(
+        self,
+        queries: List[List[float]],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+    ) -> List[List[Document]]:
+        """The documents of each query, chosen like Chroma's MMR search.
+
+        The `fetch_k` nearest candidates are narrowed down to `k`, which are
+        returned in order of similarity.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.embeddings.shape[1])
+        results = []
+        for query, rows in zip(queries, self.nearest(queries, fetch_k)):
+            selected = maximal_marginal_relevance(
+                query, np.asarray(self.embeddings[rows]), k=k, lambda_mult=lambda_mult
+            )
+            results.append([self.document(int(rows[i])) for i in sorted(selected)])
+        return results
+
+
+class VectorIndexRetriever:
+    """Stands in for `Chroma.as_retriever(search_type="mmr")`."""
+
+    def __init__(self, index: VectorIndex, embed, **search_kwargs):
+        self.index = index
+        self.embed = embed
+        self.search_kwargs = search_kwargs
+
+    def invoke(self, question: str) -> List[Document]:
+        return self.retrieve_many([self.embed(question)])[0]
+
+    def retrieve_many(self, embeddings: List[List[float]]) -> List[List[Document]]:
+        return self.index.mmr_search(embeddings, **self.search_kwargs)
+
+
+def load_index(index_directory: str, chroma_directory: Optional[str] = None) -> VectorIndex:
+    """Open an index, building it first if it is missing or older than `chroma_directory`."""
+    current = None
+    downloader.recover_directory(index_directory)
+    if os.path.exists(os.path.join(index_directory, INDEX_FILE)):
+        current = VectorIndex(index_directory)
+    if chroma_directory is not None and os.path.isdir(chroma_directory):
+        if current is None or current.info.get("source_version") != source_version(
+            chroma_directory
+        ):
+            start = time.perf_counter()
+            info = build_index(chroma_directory, index_directory)
+            logging.info(
+                f"Built the vector index {index_directory} with {info['count']} documents in {time.perf_counter() - start:.1f}s."
+            )
+            current = VectorIndex(index_directory)
+    if current is None:
+        raise FileNotFoundError(f"No vector index in {index_directory}")
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the Chroma knowledge base to a memory-mapped vector index."
+    )
+    parser.add_argument(
+        "chroma_directory",
+        type=str,
+        nargs="?",
+        default="neutron_chroma.db",
+        help="The Chroma directory to export. Default is neutron_chroma.db.",
+    )
+    parser.add_argument(
+        "index_directory",
+        type=str,
+        nargs="?",
+        default="neutron_index",
+        help="Where to write the index. Default is neutron_index.",
+    )
+    args = parser.parse_args()
+    start = time.perf_counter()
+    info = build_index(args.chroma_directory, args.index_directory)
+    size = sum(
+        os.path.getsize(os.path.join(args.index_directory, name))
+        for name in os.listdir(args.index_directory)
+    )
+    print(
+        f"Wrote {info['count']} documents of dimension {info['dimension']} to {args.index_directory} "
+        f"({size / 1024 / 1024:.1f} MB) in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,578 @@
+"""Run several model replicas in worker processes behind one server.
+
+Each worker process loads its own `InteractiveModel`, pinned to one GPU or
+to its own set of CPU cores, and runs a `BatchScheduler` over it. The server
+process only routes requests: every question goes to the ready worker with
+the fewest requests in flight. Workers that exit are detected, their
+in-flight requests fail, and they are started again with a growing delay.
+
+A session lives on the worker that created it, its ID names that worker.
+The sessions of a worker that exits are lost with it.
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+from neutron.scheduler import DeadlineExceeded, RequestCancelled
+from neutron.sessions import SessionNotFound
+
+# Longest wait between restarts of a worker that keeps crashing
+MAX_RESTART_DELAY = 300
+# A worker that stayed up this long is considered healthy again
+HEALTHY_UPTIME = 60
+# Statistics that are the same on every worker, so they are not summed
+SHARED_STATS = {"prefix_tokens"}
+# Messages that end a streamed answer
+FINAL_MESSAGES = {"end", "error", "cancelled", "deadline"}
+
+
+class WorkerError(Exception):
+    pass
+
+
+class NoWorkerAvailable(WorkerError):
+    pass
+
+
+def _error(kind: str, message: str) -> Exception:
+    if kind == "cancelled":
+        return RequestCancelled(message)
+    if kind == "deadline":
+        return DeadlineExceeded(message)
+    if kind == "not_found":
+        return SessionNotFound(message)
+    return WorkerError(message)
+
+
+def _timeout(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def worker_specs(
+    workers: int, device: str, threads: Optional[int] = None
+) -> List[dict]:
+    """Spread `workers` over the GPUs, or split the CPU cores between them."""
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device.startswith("cuda"):
+        if device != "cuda":
+            return [{"device": device} for _ in range(workers)]
+        count = max(1, torch.cuda.device_count())
+        return [{"device": f"cuda:{index % count}"} for index in range(workers)]
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    per_worker = max(1, len(cores) // workers)
+    specs = []
+    for index in range(workers):
+        cpus = cores[index * per_worker : (index + 1) * per_worker] or cores
+        specs.append(
+            {"device": "cpu", "cpus": cpus, "threads": threads or len(cpus)}
+        )
+    return specs
+
+
+def _worker_main(index: int, spec: dict, requests, responses):
+    """Entry point of a worker process."""
+    # Imported here so the server process never loads a model
+    from neutron.cache import SearchCache
+    from neutron.engine import LocalEngine
+    from neutron.interactive_model import InteractiveModel
+    from neutron.scheduler import BatchScheduler
+    from neutron.sessions import SessionStore
+
+    pid = os.getpid()
+    try:
+        if spec.get("cpus") and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, spec["cpus"])
+        model = InteractiveModel(
+            search_cache=SearchCache(**spec["search_cache"]),
+            device=spec["device"],
+            threads=spec.get("threads"),
+            **spec["model_kwargs"],
+        )
+        scheduler = BatchScheduler(model.generate_batch, **spec["scheduler_kwargs"])
+        if spec.get("warmup"):
+            model.warmup(batch_size=scheduler.max_batch_size)
+        sessions = SessionStore(
+            device=str(model.model.device), **spec.get("session_kwargs", {})
+        )
+        engine = LocalEngine(model, scheduler, sessions)
+    except Exception as e:
+        logging.error(f"Worker {index} failed to load: {e}")
+        responses.put((index, None, "failed", {"pid": pid, "error": str(e)}))
+        return
+    responses.put((index, None, "ready", {"pid": pid, "timings": model.load_timings}))
+
+    cancel_events = {}
+
+    def handle(request_id, kind, payload):
+        # Deadlines travel as seconds left, monotonic clocks are per process
+        timeout = payload.pop("timeout", None)
+        if timeout is not None:
+            payload["deadline"] = time.monotonic() + timeout
+        try:
+            if kind == "ask":
+                cancel_event = cancel_events.setdefault(request_id, threading.Event())
+                result = engine.ask(cancel_event=cancel_event, **payload)
+                responses.put((index, request_id, "result", result))
+            elif kind == "stats":
+                responses.put((index, request_id, "result", engine.stats()))
+            elif kind == "stream":
+                cancel_event = cancel_events.setdefault(request_id, threading.Event())
+                cached, chunks = engine.stream(cancel_event=cancel_event, **payload)
+                responses.put((index, request_id, "start", cached))
+                for text in chunks:
+                    responses.put((index, request_id, "chunk", text))
+                responses.put((index, request_id, "end", None))
+            elif kind == "batch":
+                cancel_event = cancel_events.setdefault(request_id, threading.Event())
+                for result in engine.ask_batch(cancel_event=cancel_event, **payload):
+                    responses.put((index, request_id, "chunk", result))
+                responses.put((index, request_id, "end", None))
+            elif kind == "session_create":
+                responses.put((index, request_id, "result", engine.create_session()))
+            elif kind == "session_get":
+                responses.put((index, request_id, "result", engine.get_session(**payload)))
+            elif kind == "session_delete":
+                result = engine.delete_session(**payload)
+                responses.put((index, request_id, "result", result))
+            elif kind == "session_ask":
+                cancel_event = cancel_events.setdefault(request_id, threading.Event())
+                result = engine.session_ask(cancel_event=cancel_event, **payload)
+                responses.put((index, request_id, "result", result))
+        except SessionNotFound as e:
+            responses.put((index, request_id, "not_found", str(e)))
+        except RequestCancelled as e:
+            responses.put((index, request_id, "cancelled", str(e)))
+        except DeadlineExceeded as e:
+            responses.put((index, request_id, "deadline", str(e)))
+        except Exception as e:
+            logging.error(f"Worker {index} failed to handle {kind}: {e}")
+            responses.put((index, request_id, "error", str(e)))
+        finally:
+            cancel_events.pop(request_id, None)
+
+    # Requests wait on the web search and on their batch, so many run at once
+    executor = ThreadPoolExecutor(max_workers=64)
+    while True:
+        request_id, kind, payload = requests.get()
+        if kind == "stop":
+            engine.stop()
+            break
+        if kind == "cancel":
+            cancel_events.setdefault(request_id, threading.Event()).set()
+            continue
+        executor.submit(handle, request_id, kind, payload)
+
+
+class _Tagged:
+    """Puts messages on a queue shared by the parts of a batch, labelled with their part."""
+
+    def __init__(self, messages: queue.Queue, tag):
+        self.messages = messages
+        self.tag = tag
+
+    def put(self, message):
+        self.messages.put((self.tag, message))
+
+
+class _Worker:
+    def __init__(self, index: int, spec: dict):
+        self.index = index
+        self.spec = spec
+        self.process = None
+        self.requests = None
+        self.ready = False
+        self.in_flight = set()
+        self.started_at = 0.0
+        self.ready_at = 0.0
+        self.restarts = 0
+        self.crashes = 0
+        self.restart_at = None
+        self.error = None
+        self.load_timings = {}
+
+
+class WorkerPool:
+    """Routes requests to model worker processes, see the module docstring.
+
+    It offers the same methods as `LocalEngine`.
+    """
+
+    def __init__(self, specs: List[dict], restart_delay: float = 5.0):
+        self.context = multiprocessing.get_context("spawn")
+        self.responses = self.context.Queue()
+        self.workers = [_Worker(index, spec) for index, spec in enumerate(specs)]
+        self.restart_delay = restart_delay
+        self.pending = {}  # request_id -> (worker, Future or queue.Queue)
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    @property
+    def ready(self) -> bool:
+        return any(worker.ready for worker in self.workers)
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        threading.Thread(target=self._read_responses, daemon=True).start()
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """Wait for one worker to be ready. Returns False if all of them failed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready:
+            if all(worker.error for worker in self.workers):
+                return False
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.requests.put((None, "stop", None))
+                worker.process.join(timeout=10)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+    def _spawn(self, worker: _Worker):
+        worker.requests = self.context.Queue()
+        worker.process = self.context.Process(
+            target=_worker_main,
+            args=(worker.index, worker.spec, worker.requests, self.responses),
+            name=f"neutron-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logging.info(
+            f"Started worker {worker.index} (pid {worker.process.pid}) on {worker.spec['device']}."
+        )
+
+    def _fail_in_flight(self, worker: _Worker, message: str):
+        with self.lock:
+            failed = [self.pending.pop(request_id) for request_id in worker.in_flight]
+            worker.in_flight.clear()
+        for _, target in failed:
+            if isinstance(target, Future):
+                if not target.done():
+                    target.set_exception(WorkerError(message))
+            else:
+                target.put(("error", message))
+
+    def _monitor(self):
+        while not self.stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    if worker.ready and now - worker.ready_at > HEALTHY_UPTIME:
+                        worker.crashes = 0
+                    continue
+                if worker.restart_at is None:
+                    worker.ready = False
+                    worker.crashes += 1
+                    delay = min(
+                        self.restart_delay * 2 ** (worker.crashes - 1), MAX_RESTART_DELAY
+                    )
+                    worker.restart_at = now + delay
+                    message = f"Worker {worker.index} exited with code {worker.process.exitcode}"
+                    worker.error = worker.error or message
+                    logging.error(f"{message}, restarting in {delay:.0f}s.")
+                    self._fail_in_flight(worker, message)
+                elif now >= worker.restart_at:
+                    worker.restarts += 1
+                    self._spawn(worker)
+            time.sleep(0.5)
+
+    def _read_responses(self):
+        while True:
+            index, request_id, kind, payload = self.responses.get()
+            worker = self.workers[index]
+            if request_id is None:
+                # Ignore messages from a process that has since been replaced
+                if worker.process is None or payload["pid"] != worker.process.pid:
+                    continue
+                if kind == "ready":
+                    worker.ready = True
+                    worker.ready_at = time.monotonic()
+                    worker.error = None
+                    worker.load_timings = payload["timings"]
+                    logging.info(f"Worker {index} is ready.")
+                else:
+                    worker.error = payload["error"]
+                continue
+            with self.lock:
+                entry = self.pending.get(request_id)
+                if entry is None:
+                    continue
+                if isinstance(entry[1], Future) or kind in FINAL_MESSAGES:
+                    del self.pending[request_id]
+                    entry[0].in_flight.discard(request_id)
+            target = entry[1]
+            if isinstance(target, Future):
+                if kind == "result":
+                    target.set_result(payload)
+                else:
+                    target.set_exception(_error(kind, payload))
+            else:
+                target.put((kind, payload))
+
+    def _send(self, kind: str, payload: dict, target, worker: Optional[_Worker] = None):
+        request_id = uuid.uuid4().hex
+        with self.lock:
+            if worker is None:
+                candidates = [w for w in self.workers if w.ready]
+                if not candidates:
+                    raise NoWorkerAvailable("No model worker is ready")
+                worker = min(candidates, key=lambda w: len(w.in_flight))
+            self.pending[request_id] = (worker, target)
+            worker.in_flight.add(request_id)
+        worker.requests.put((request_id, kind, payload))
+        return request_id, worker
+
+    def ask(
+        self,
+        question: str,
+        use_cache: bool = True,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> dict:
+        future = Future()
+        payload = {
+            "question": question,
+            "use_cache": use_cache,
+            "timeout": _timeout(deadline),
+        }
+        request_id, worker = self._send("ask", payload, future)
+        return self._result(future, request_id, worker, cancel_event)
+
+    def _result(self, future, request_id, worker, cancel_event=None):
+        while True:
+            try:
+                return future.result(timeout=0.25)
+            except FutureTimeoutError:
+                if cancel_event is not None and cancel_event.is_set():
+                    worker.requests.put((request_id, "cancel", None))
+                    raise RequestCancelled("The request was cancelled")
+
+    def stream(
+        self,
+        question: str,
+        use_cache: bool = True,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> Tuple[bool, Iterator[str]]:
+        messages = queue.Queue()
+        payload = {
+            "question": question,
+            "use_cache": use_cache,
+            "timeout": _timeout(deadline),
+        }
+        request_id, worker = self._send("stream", payload, messages)
+        kind, payload = messages.get()
+        if kind != "start":
+            raise _error(kind, payload)
+        return payload, self._stream(request_id, worker, messages, cancel_event)
+
+    def _stream(self, request_id, worker, messages, cancel_event):
+        finished = False
+        try:
+            while True:
+                kind, payload = messages.get()
+                if kind == "chunk":
+                    yield payload
+                elif kind == "end":
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise _error(kind, payload)
+        finally:
+            if not finished:
+                # The reader stopped early, stop generating on the worker too
+                if cancel_event is not None:
+                    cancel_event.set()
+                worker.requests.put((request_id, "cancel", None))
+                with self.lock:
+                    self.pending.pop(request_id, None)
+                    worker.in_flight.discard(request_id)
+
+    def ask_batch(
+        self,
+        questions: List[str],
+        use_cache: bool = True,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> Iterator[dict]:
+        """Split the questions between the ready workers and merge their results.
+
+        Each worker gets a contiguous part, so it can still embed, retrieve
+        and generate its questions in batches.
+        """
+        with self.lock:
+            ready = [worker for worker in self.workers if worker.ready]
+        if not ready:
+            raise NoWorkerAvailable("No model worker is ready")
+        size = math.ceil(len(questions) / len(ready))
+        messages = queue.Queue()
+        parts = {}
+        for offset, worker in zip(range(0, len(questions), size), ready):
+            payload = {
+                "questions": questions[offset : offset + size],
+                "use_cache": use_cache,
+                "timeout": _timeout(deadline),
+            }
+            request_id, _ = self._send(
+                "batch", payload, _Tagged(messages, offset), worker=worker
+            )
+            remaining = set(range(offset, offset + len(payload["questions"])))
+            parts[offset] = (request_id, worker, remaining)
+        return self._batch_results(questions, parts, messages, cancel_event)
+
+    def _batch_results(self, questions, parts, messages, cancel_event):
+        try:
+            while parts:
+                offset, (kind, payload) = messages.get()
+                _, _, remaining = parts[offset]
+                if kind == "chunk":
+                    payload["index"] += offset
+                    remaining.discard(payload["index"])
+                    yield payload
+                    continue
+                del parts[offset]
+                if kind != "end":
+                    # The questions this part did not get to share its error
+                    message = str(_error(kind, payload))
+                    for index in sorted(remaining):
+                        yield {"index": index, "question": questions[index], "error": message}
+        finally:
+            if parts and cancel_event is not None:
+                cancel_event.set()
+            for request_id, worker, _ in parts.values():
+                worker.requests.put((request_id, "cancel", None))
+                with self.lock:
+                    self.pending.pop(request_id, None)
+                    worker.in_flight.discard(request_id)
+
+    def _session_worker(self, session_id: str) -> Tuple[_Worker, str]:
+        """The worker holding a session, and the session's ID on that worker."""
+        index, _, local_id = session_id.partition("-")
+        if not index.isdigit() or int(index) >= len(self.workers):
+            raise SessionNotFound(f"Session {session_id} does not exist or has expired")
+        worker = self.workers[int(index)]
+        if not worker.ready:
+            raise SessionNotFound(f"Session {session_id} was lost with its worker")
+        return worker, local_id
+
+    def _session_call(
+        self,
+        kind: str,
+        session_id: str,
+        payload: Optional[dict] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> dict:
+        worker, local_id = self._session_worker(session_id)
+        future = Future()
+        request_id, _ = self._send(
+            kind, {"session_id": local_id, **(payload or {})}, future, worker=worker
+        )
+        result = self._result(future, request_id, worker, cancel_event)
+        return {**result, "session_id": session_id}
+
+    def create_session(self) -> dict:
+        future = Future()
+        request_id, worker = self._send("session_create", {}, future)
+        result = self._result(future, request_id, worker)
+        return {**result, "session_id": f"{worker.index}-{result['session_id']}"}
+
+    def get_session(self, session_id: str) -> dict:
+        return self._session_call("session_get", session_id)
+
+    def delete_session(self, session_id: str) -> dict:
+        return self._session_call("session_delete", session_id)
+
+    def session_ask(
+        self,
+        session_id: str,
+        question: str,
+        cancel_event: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> dict:
+        payload = {"question": question, "timeout": _timeout(deadline)}
+        return self._session_call("session_ask", session_id, payload, cancel_event)
+
+    def stats(self, timeout: float = 5.0) -> dict:
+        """Sum the statistics of all ready workers, with the state of each worker."""
+        futures = []
+        for worker in self.workers:
+            if worker.ready:
+                future = Future()
+                try:
+                    self._send("stats", {}, future, worker=worker)
+                    futures.append(future)
+                except NoWorkerAvailable:
+                    pass
+        totals = {}
+        deadline = time.monotonic() + timeout
+        for future in futures:
+            try:
+                _merge_stats(
+                    totals, future.result(timeout=max(0, deadline - time.monotonic()))
+                )
+            except (FutureTimeoutError, WorkerError) as e:
+                logging.error(f"Could not get the statistics of a worker: {e}")
+        for section in totals.values():
+            if isinstance(section, dict) and "hits" in section:
+                lookups = section["hits"] + section["misses"]
+                section["hit_rate"] = section["hits"] / lookups if lookups else 0.0
+        assisted = totals.get("assisted_decoding")
+        if assisted:
+            proposed, steps = assisted["proposed_tokens"], assisted["steps"]
+            assisted["acceptance_rate"] = (
+                assisted["accepted_tokens"] / proposed if proposed else 0.0
+            )
+            assisted["tokens_per_step"] = (
+                assisted["generated_tokens"] / steps if steps else 0.0
+            )
+        totals["workers"] = [
+            {
+                "index": worker.index,
+                "device": worker.spec["device"],
+                "pid": worker.process.pid if worker.process else None,
+                "ready": worker.ready,
+                "in_flight": len(worker.in_flight),
+                "restarts": worker.restarts,
+                "error": worker.error,
+            }
+            for worker in self.workers
+        ]
+        return totals
+
+
+def _merge_stats(totals: Dict, stats: Dict):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            _merge_stats(totals.setdefault(key, {}), value)
+        elif isinstance(value, bool):
+            totals[key] = totals.get(key, False) or value
+        elif key in SHARED_STATS:
+            totals[key] = max(totals.get(key, 0), value)
+        elif isinstance(value, (int, float)):
+            totals[key] = totals.get(key, 0) + value
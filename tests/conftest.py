@@ -0,0 +1,89 @@
+"""Runs neutron-server in this process with the stand-ins of the benchmark.
+
+The server listens on a real socket, so tests can disconnect in the middle of
+a request the way clients do. Nothing is downloaded.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+import requests
+import uvicorn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+import bench_server  # noqa: E402
+from langchain_core.embeddings import DeterministicFakeEmbedding  # noqa: E402
+
+from neutron import server  # noqa: E402
+
+MAX_QUEUE_DEPTH = 2
+MAX_NEW_TOKENS = 64
+AUTH = {"Authorization": "default_token"}
+
+
+def wait_until(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+@pytest.fixture(scope="session")
+def base_url(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("neutron")
+    server.args = server.parser.parse_args(
+        [
+            "--device",
+            "cpu",
+            "--offline",
+            "--no-warmup",
+            "--max-new-tokens",
+            str(MAX_NEW_TOKENS),
+            "--max-queue-depth",
+            str(MAX_QUEUE_DEPTH),
+            "--job-db",
+            str(directory / "jobs.db"),
+        ]
+    )
+    tokenizer = bench_server.build_tokenizer(1024)
+    server.components = {
+        "model": bench_server.build_model(tokenizer, 1024, 2, 64),
+        "tokenizer": tokenizer,
+        "embeddings": DeterministicFakeEmbedding(size=64),
+        "vector_store": bench_server.build_vector_store(str(directory / "chroma")),
+        "search_tool": bench_server.StubSearch(0.0),
+    }
+    port = bench_server.free_port()
+    uvicorn_server = uvicorn.Server(
+        uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{port}"
+    bench_server.wait_until_ready(url, 120)
+    yield url
+    uvicorn_server.should_exit = True
+    thread.join(timeout=30)
+
+
+@pytest.fixture
+def slow_generation(base_url):
+    """Make every forward pass of the model take 50ms, so answers take seconds."""
+    model = server.engine.model.model
+    forward = model.forward
+
+    def slow_forward(*args, **kwargs):
+        time.sleep(0.05)
+        return forward(*args, **kwargs)
+
+    model.forward = slow_forward
+    yield
+    del model.forward
+    # Requests cut short by a test must not leak into the next one
+    assert wait_until(lambda: server.admission.in_flight == 0)
@@ -0,0 +1,51 @@
+import functools
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from neutron import downloader, manifest, utilities
+
+
+@pytest.fixture
+def published(tmp_path):
+    source = tmp_path / "neutron_model"
+    (source / "weights").mkdir(parents=True)
+    (source / "config.json").write_text('{"layers": 2}')
+    (source / "weights" / "model.bin").write_bytes(os.urandom(4096))
+    upload_dir = tmp_path / "upload"
+    manifest.publish(str(source), str(upload_dir))
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(upload_dir))
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield source, upload_dir, f"http://127.0.0.1:{httpd.server_port}/neutron_model.zip"
+    httpd.shutdown()
+
+
+def test_archive_is_verified_against_published_sha256(published, tmp_path):
+    source, upload_dir, url = published
+    assert manifest.fetch_archive_sha256(url) == downloader.file_digest(upload_dir / "neutron_model.zip")
+    target = tmp_path / "installed" / "neutron_model"
+    target.parent.mkdir()
+    utilities.download_and_unzip(url, f"{target}.zip")
+    assert (target / "config.json").read_text() == '{"layers": 2}'
+    assert (target / "weights" / "model.bin").read_bytes() == (source / "weights" / "model.bin").read_bytes()
+
+
+def test_archive_with_wrong_sha256_is_rejected(published, tmp_path):
+    _, upload_dir, url = published
+    (upload_dir / "neutron_model.zip.sha256").write_text(f"{'0' * 64}  neutron_model.zip\n")
+    target = tmp_path / "installed" / "neutron_model"
+    target.parent.mkdir()
+    with pytest.raises(downloader.DownloadError):
+        utilities.download_and_unzip(url, f"{target}.zip")
+    assert not target.exists()
+    assert not os.path.exists(f"{target}.zip.part")
+
+
+def test_unverifiable_download_warns(tmp_path, capsys):
+    path = tmp_path / "archive.zip"
+    path.write_bytes(b"data")
+    assert not downloader.verify_file(str(path), etag='"9b2cf535f27731c974343645a3985328-12"')
+    assert "could not be verified" in capsys.readouterr().err
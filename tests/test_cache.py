@@ -0,0 +1,30 @@
+import json
+
+import requests
+
+from conftest import AUTH
+from neutron import server
+
+BYPASS = {**AUTH, "X-Neutron-Cache": "bypass"}
+
+
+def test_bypassed_batch_is_cached_without_embedding_again(base_url, monkeypatch):
+    cache = server.engine.model.answer_cache
+
+    def embed_question(question):
+        raise AssertionError(f"{question!r} was embedded again")
+
+    monkeypatch.setattr(cache, "embed_question", embed_question)
+    questions = ["What does nmap -sV do?", "How do I list SMB shares?"]
+    response = requests.post(
+        f"{base_url}/ask/batch", json={"questions": questions}, headers=BYPASS, timeout=60
+    )
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.iter_lines() if line]
+    assert all("response" in result for result in results), results
+
+    for question in questions:
+        response = requests.post(
+            f"{base_url}/ask", json={"question": question}, headers=AUTH, timeout=60
+        )
+        assert response.json()["cached"] is True
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+import requests
+from prometheus_client import REGISTRY
+
+from conftest import AUTH, MAX_NEW_TOKENS, MAX_QUEUE_DEPTH, wait_until
+from neutron import server
+
+BYPASS = {**AUTH, "X-Neutron-Cache": "bypass"}
+
+
+def test_stream_disconnect_releases_admission(base_url, slow_generation):
+    # More disconnects than slots, a leaked slot per disconnect would fill them
+    for index in range(MAX_QUEUE_DEPTH + 1):
+        with requests.post(
+            f"{base_url}/ask/stream",
+            json={"question": f"How do I scan host {index} with nmap?"},
+            headers=BYPASS,
+            stream=True,
+            timeout=30,
+        ) as response:
+            assert response.status_code == 200
+            next(response.iter_content(chunk_size=None))
+    assert wait_until(lambda: server.admission.in_flight == 0)
+
+    response = requests.post(
+        f"{base_url}/ask", json={"question": "How do I run gobuster?"}, headers=AUTH, timeout=60
+    )
+    assert response.status_code == 200
+
+
+def test_batch_disconnect_releases_admission(base_url, slow_generation):
+    for index in range(MAX_QUEUE_DEPTH + 1):
+        with requests.post(
+            f"{base_url}/ask/batch",
+            json={"questions": [f"How do I brute force SSH on host {index}?", "What is nikto?"]},
+            headers=BYPASS,
+            stream=True,
+            timeout=60,
+        ) as response:
+            assert response.status_code == 200
+            next(response.iter_lines())
+    assert wait_until(lambda: server.admission.in_flight == 0)
+
+    response = requests.post(
+        f"{base_url}/ask", json={"question": "How do I run hydra?"}, headers=AUTH, timeout=60
+    )
+    assert response.status_code == 200
+
+
+def aborted(reason: str) -> float:
+    labels = {"reason": reason}
+    return REGISTRY.get_sample_value("neutron_aborted_requests_total", labels) or 0.0
+
+
+def disconnect_during(url: str, question: str):
+    """Send a question and give up waiting before it can be answered."""
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        requests.post(url, json={"question": question}, headers=BYPASS, timeout=0.5)
+
+
+def test_ask_disconnect_stops_generation(base_url, slow_generation):
+    before = aborted("cancelled")
+    started = time.monotonic()
+    disconnect_during(f"{base_url}/ask", "How do I crack a hash with john?")
+    assert wait_until(lambda: aborted("cancelled") == before + 1)
+    # A full answer takes MAX_NEW_TOKENS forward passes of 50ms
+    assert time.monotonic() - started < MAX_NEW_TOKENS * 0.05
+    assert wait_until(lambda: server.admission.in_flight == 0)
+
+
+def test_session_disconnect_stops_generation(base_url, slow_generation):
+    session_id = requests.post(f"{base_url}/sessions", headers=AUTH).json()["session_id"]
+    before = aborted("cancelled")
+    disconnect_during(f"{base_url}/sessions/{session_id}/ask", "How do I run sqlmap?")
+    assert wait_until(lambda: aborted("cancelled") == before + 1)
+    # The cut-off turn is not part of the conversation
+    assert requests.get(f"{base_url}/sessions/{session_id}", headers=AUTH).json()["turns"] == []
+
+
+@pytest.fixture
+def failing_generation(base_url):
+    model = server.engine.model.model
+
+    def failing_forward(*args, **kwargs):
+        raise RuntimeError("CUDA out of memory")
+
+    model.forward = failing_forward
+    yield
+    del model.forward
+
+
+@pytest.mark.parametrize("endpoint", ["/ask", "/ask/stream"])
+def test_failed_generation_releases_admission(base_url, failing_generation, endpoint):
+    for index in range(MAX_QUEUE_DEPTH + 1):
+        response = requests.post(
+            f"{base_url}{endpoint}",
+            json={"question": f"How do I enumerate SMB shares on host {index}?"},
+            headers=BYPASS,
+            timeout=30,
+        )
+        assert response.status_code == 500
+    assert wait_until(lambda: server.admission.in_flight == 0)
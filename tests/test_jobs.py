@@ -0,0 +1,56 @@
+import threading
+
+from conftest import wait_until
+from neutron.jobs import JobRunner, JobStore
+from neutron.scheduler import RequestCancelled
+
+
+class BlockingEngine:
+    """Answers once `release` is set, optionally giving up when the job is cancelled."""
+
+    def __init__(self, honours_cancel: bool):
+        self.honours_cancel = honours_cancel
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def ask(self, question, use_cache, cancel_event, deadline):
+        self.started.set()
+        while not self.release.wait(0.01):
+            if self.honours_cancel and cancel_event.is_set():
+                raise RequestCancelled("The job was cancelled")
+        return {"response": f"Answer to {question}"}
+
+
+def start_job(tmp_path, engine):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    runner = JobRunner(store, lambda: engine, concurrency=1)
+    runner.start()
+    job_id = store.submit("What is nmap?")["job_id"]
+    assert engine.started.wait(10)
+    return store, runner, job_id
+
+
+def test_stopped_job_is_queued_again(tmp_path):
+    store, runner, job_id = start_job(tmp_path, BlockingEngine(honours_cancel=True))
+    assert runner.stop(timeout=10)
+    assert store.get(job_id)["status"] == "queued"
+    store.close()
+
+
+def test_store_outlives_a_job_that_does_not_stop(tmp_path):
+    engine = BlockingEngine(honours_cancel=False)
+    store, runner, job_id = start_job(tmp_path, engine)
+    assert not runner.stop(timeout=0.2)
+    engine.release.set()
+    assert wait_until(lambda: not runner.threads[0].is_alive())
+    assert store.get(job_id)["status"] == "done"
+    store.close()
+
+    # A job interrupted by the end of the process is queued again on the next start
+    store = JobStore(str(tmp_path / "jobs.db"))
+    job_id = store.submit("What is gobuster?")["job_id"]
+    assert store.next_job()["job_id"] == job_id
+    store.close()
+    store = JobStore(str(tmp_path / "jobs.db"))
+    assert store.get(job_id)["status"] == "queued"
+    store.close()
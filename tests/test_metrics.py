@@ -0,0 +1,39 @@
+import requests
+import torch
+
+from neutron.metrics import ServerCollector
+from neutron.worker_pool import _merge_stats
+
+
+class ReportingEngine:
+    def __init__(self, stats: dict):
+        self.reported = stats
+
+    def stats(self) -> dict:
+        return self.reported
+
+
+def samples(collector: ServerCollector, name: str) -> dict:
+    return {
+        sample.labels["device"]: sample.value
+        for family in collector.collect()
+        if family.name == name
+        for sample in family.samples
+    }
+
+
+def test_gpu_memory_is_summed_over_workers():
+    totals = {}
+    for allocated in (100, 250):
+        memory = {"allocated_bytes": allocated, "reserved_bytes": 2 * allocated}
+        _merge_stats(totals, {"queue_depth": 0, "gpu_memory": {"0": memory}})
+    collector = ServerCollector(lambda: ReportingEngine(totals))
+    assert samples(collector, "neutron_gpu_memory_allocated_bytes") == {"0": 350}
+    assert samples(collector, "neutron_gpu_memory_reserved_bytes") == {"0": 700}
+
+
+def test_metrics_do_not_initialize_cuda(base_url):
+    response = requests.get(f"{base_url}/metrics")
+    assert response.status_code == 200
+    assert "neutron_queue_depth" in response.text
+    assert not torch.cuda.is_initialized()
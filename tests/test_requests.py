@@ -0,0 +1,24 @@
+import requests
+from prometheus_client import REGISTRY
+
+from conftest import AUTH
+
+
+def request_count(endpoint: str, status: str) -> float:
+    labels = {"endpoint": endpoint, "status": status}
+    return REGISTRY.get_sample_value("neutron_requests_total", labels) or 0.0
+
+
+def test_request_id_is_returned(base_url):
+    response = requests.get(f"{base_url}/healthz", headers={"X-Request-ID": "trace-1"})
+    assert response.headers["X-Request-ID"] == "trace-1"
+    generated = requests.get(f"{base_url}/healthz").headers["X-Request-ID"]
+    assert len(generated) == 32
+
+
+def test_requests_are_counted_by_route_and_status(base_url):
+    before = request_count("/stats", "401"), request_count("/stats", "200")
+    assert requests.get(f"{base_url}/stats").status_code == 401
+    assert requests.get(f"{base_url}/stats", headers=AUTH).status_code == 200
+    assert request_count("/stats", "401") == before[0] + 1
+    assert request_count("/stats", "200") == before[1] + 1